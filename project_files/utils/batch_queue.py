@@ -0,0 +1,142 @@
+import io
+import csv
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+def read_scans(scans_csv):
+    """
+    Rows and column names of a scan request CSV (the text optimize_scan_scheduling reads).
+    """
+    reader = csv.DictReader(io.StringIO(scans_csv))
+    return list(reader), reader.fieldnames or []
+
+
+def write_scans(rows, fieldnames):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=fieldnames, restval="")
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+class BatchRequest:
+    def __init__(self, scans_csv, solver_overrides=None, progress=None):
+        self.rows, self.fieldnames = read_scans(scans_csv)
+        self.scan_ids = [str(row["scan_id"]) for row in self.rows]
+        self.patient_ids = set(str(row.get("patient_id")) for row in self.rows)
+        self.solver_overrides = solver_overrides
+        self.progress = progress
+        self.future = Future()
+
+
+class OptimizationQueue:
+    """
+    Single writer in front of the optimizer. The first request waiting starts a batch;
+    requests arriving within window_secs after it are added until the batch holds
+    max_batch_scans scans, and the whole batch is solved in one call of
+    solve(scans_csv, solver_overrides, stats, progress) (main.do_optimization). Only one
+    solve runs at a time, so concurrent requests no longer race on the stored schedule.
+    Requests with other solver overrides, or with scan_ids or patient_ids already in the
+    batch (one scan per patient and solve, see optimizer Step 7), wait for the next batch. Solver progress of a batch goes to the progress callback of each of
+    its requests.
+    """
+
+    def __init__(self, solve, window_secs=0.2, max_batch_scans=50):
+        self.solve = solve
+        self.window_secs = window_secs
+        self.max_batch_scans = max_batch_scans
+        self.requests = queue.Queue()
+        # Request taken from the queue that did not fit the current batch
+        self.held_back = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.batched_requests = 0
+
+    def submit(self, scans_csv, solver_overrides=None, progress=None):
+        """
+        Queues the scans of one request. Returns a Future of a dict with the request's own
+        entries of the merged schedule ("schedule", None if no solution was found), the
+        scan_ids it left unplaced, the solver statistics of the shared solve ("stats")
+        and the size of the batch.
+        """
+        request = BatchRequest(scans_csv, solver_overrides, progress)
+        self.start()
+        self.requests.put(request)
+        return request.future
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="optimization-queue", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.solve_batch(self.next_batch())
+
+    def next_batch(self):
+        first = self.held_back or self.requests.get()
+        self.held_back = None
+        batch = [first]
+        scan_ids = set(first.scan_ids)
+        patient_ids = set(first.patient_ids)
+        deadline = time.monotonic() + self.window_secs
+        while len(scan_ids) < self.max_batch_scans:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if (request.solver_overrides != first.solver_overrides or not scan_ids.isdisjoint(request.scan_ids)
+                    or not patient_ids.isdisjoint(request.patient_ids)
+                    or len(scan_ids) + len(request.scan_ids) > self.max_batch_scans):
+                self.held_back = request
+                break
+            batch.append(request)
+            scan_ids.update(request.scan_ids)
+            patient_ids.update(request.patient_ids)
+        return batch
+
+    def solve_batch(self, batch):
+        fieldnames = []
+        for request in batch:
+            fieldnames += [f for f in request.fieldnames if f not in fieldnames]
+        scans_csv = write_scans([row for request in batch for row in request.rows], fieldnames)
+        stats = {}
+        listeners = [request.progress for request in batch if request.progress is not None]
+
+        def progress(update):
+            for listener in listeners:
+                listener(update)
+
+        try:
+            schedule = self.solve(scans_csv, batch[0].solver_overrides, stats, progress if listeners else None)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+        entries = {str(entry["scan_id"]): entry for entry in schedule or []}
+        batch_info = {"requests": len(batch), "scans": sum(len(request.scan_ids) for request in batch)}
+        for request in batch:
+            request.future.set_result({
+                "schedule": None if schedule is None else [entries[s] for s in request.scan_ids if s in entries],
+                "unplaced": [s for s in request.scan_ids if s not in entries],
+                "stats": stats,
+                "batch": batch_info,
+            })
+
+    def counters(self):
+        return {
+            "queued": self.requests.qsize() + (self.held_back is not None),
+            "batches": self.batches,
+            "requests": self.batched_requests,
+        }
@@ -0,0 +1,192 @@
+import io
+import os
+import csv
+import json
+import random
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime, timedelta
+from config import machines
+from engines import MODEL_ENGINES
+from optimizer import optimize_scan_scheduling
+
+# Share of each priority in a generated batch
+PRIORITY_MIX = {0: 0.05, 1: 0.15, 2: 0.3, 3: 0.3, 4: 0.1, 5: 0.1}
+# Typical scan lengths in minutes per modality
+DURATIONS = {"CT": [15, 30, 45], "MRI": [30, 45, 60, 90], "X-Ray": [10, 15, 20]}
+# Relative check-in rate per hour of the day, peaking during clinic hours
+HOURLY_ARRIVALS = [1, 1, 1, 1, 1, 2, 4, 8, 10, 10, 10, 9, 8, 9, 10, 10, 9, 7, 5, 4, 3, 2, 2, 1]
+
+SCHEDULE_COLUMNS = ["scan_id", "patient_id", "scan_type", "machine", "start_time", "end_time", "priority", "duration"]
+
+
+def generate_scans(n, seed=0, start=None, days=3, priority_mix=PRIORITY_MIX, modality_mix=None):
+    """
+    Seeded batch of n scan requests in the CSV format optimize_scan_scheduling reads.
+    Check-ins are spread over `days` days from `start` (default: the next full hour)
+    following HOURLY_ARRIVALS; modality_mix weights the scan types (default: equal).
+    """
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    scan_types = list(machines)
+    type_weights = [(modality_mix or {}).get(t, 1) for t in scan_types]
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["scan_id", "scan_type", "duration", "priority", "patient_id", "check_in_date", "check_in_time"])
+    for i in range(n):
+        day = rng.randrange(days)
+        hour = rng.choices(range(24), weights=HOURLY_ARRIVALS)[0]
+        check_in = start + timedelta(days=day, hours=hour, minutes=rng.randrange(60))
+        scan_type = rng.choices(scan_types, weights=type_weights)[0]
+        priority = rng.choices(list(priority_mix), weights=list(priority_mix.values()))[0]
+        writer.writerow([
+            f"B{seed}-{i}", scan_type, rng.choice(DURATIONS.get(scan_type, [30])), priority, 100000 + i,
+            check_in.strftime("%Y-%m-%d"), check_in.strftime("%H:%M"),
+        ])
+    return out.getvalue()
+
+
+def generate_locked_schedule(schedule_csv_path, seed=0, load=0.3, hours=48, start=None):
+    """
+    Writes a stored schedule that books about `load` of every machine's time over the
+    next `hours` hours, so the optimizer has locked intervals to work around.
+    """
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime.now().replace(second=0, microsecond=0)
+    rows = []
+    for scan_type, machine_list in machines.items():
+        for m in machine_list:
+            t = start
+            while t < start + timedelta(hours=hours):
+                duration = rng.choice(DURATIONS.get(scan_type, [30]))
+                if load < 1:
+                    # Idle time chosen so that bookings cover about `load` of the machine
+                    t += timedelta(minutes=int(rng.expovariate(load / (duration * (1 - load)))))
+                end = t + timedelta(minutes=duration)
+                rows.append({
+                    "scan_id": f"L{len(rows)}", "patient_id": 900000 + len(rows), "scan_type": scan_type,
+                    "machine": m, "start_time": t.strftime("%Y-%m-%d %H:%M"),
+                    "end_time": end.strftime("%Y-%m-%d %H:%M"), "priority": rng.choice([1, 2, 3]),
+                    "duration": duration,
+                })
+                t = end
+    with open(schedule_csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SCHEDULE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+@contextlib.contextmanager
+def machine_pool(count):
+    """
+    Temporarily replaces the machines config with `count` machines spread round-robin
+    over the configured modalities (at least one each). config.machines is changed in
+    place, so every module that imported it sees the scaled pool.
+    """
+    original = {t: list(m) for t, m in machines.items()}
+    prefixes = {t: m[0].rsplit("-", 1)[0] for t, m in original.items()}
+    scan_types = list(original)
+    scaled = {t: [] for t in scan_types}
+    for i in range(max(count, len(scan_types))):
+        t = scan_types[i % len(scan_types)]
+        scaled[t].append(f"{prefixes[t]}-{len(scaled[t]) + 1}")
+    machines.clear()
+    machines.update(scaled)
+    try:
+        yield scaled
+    finally:
+        machines.clear()
+        machines.update(original)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(n, machine_count, engine, seed=0, locked_load=0.3, time_limit=30, **optimizer_kwargs):
+    """
+    Runs one optimize_scan_scheduling call on a generated batch against a generated
+    locked schedule and returns its result record. Hints and the solve cache are off so
+    that earlier cases cannot speed up later ones.
+    """
+    record = {"scans": n, "machines": machine_count, "engine": engine, "seed": seed}
+    with machine_pool(machine_count), tempfile.TemporaryDirectory() as tmp:
+        schedule_csv_path = os.path.join(tmp, "schedule.csv")
+        record["locked_rows"] = generate_locked_schedule(schedule_csv_path, seed, locked_load) if locked_load else 0
+        scans = generate_scans(n, seed)
+        stats = {}
+        # The optimizer prints the full schedule; keep it out of the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            schedule = optimize_scan_scheduling(
+                scans, schedule_csv_path, engine=engine, use_hints=False, use_cache=False, stats=stats,
+                solver_overrides={"max_time_in_seconds": time_limit}, **optimizer_kwargs
+            )
+    objective, bound = stats.get("objective"), stats.get("best_bound")
+    record.update({
+        "solved": schedule is not None,
+        "status": stats.get("status"),
+        "objective": objective,
+        "best_bound": bound,
+        "gap": abs(bound - objective) / max(1.0, abs(objective)) if objective is not None and bound is not None else None,
+        "unplaced": len(stats.get("unplaced", [])),
+        "model_size": stats.get("model_size"),
+        "timings": stats.get("timings"),
+    })
+    return record
+
+
+def run_benchmark(sizes=(10, 100, 1000, 10000), machine_counts=(3, 10, 30, 100), engines=("cpsat", "greedy"),
+                  seeds=(0,), locked_load=0.3, time_limit=30, max_model_scans=1000, soft=True, output=None):
+    """
+    Runs every (size, machine count, engine, seed) combination and writes the records as
+    JSON to `output` (default: benchmark_<commit>.json). Engines that build a CP-SAT
+    model are skipped above max_model_scans scans. With soft, overloaded cases still
+    produce a (partial) schedule to time instead of failing the capacity check.
+    """
+    commit = current_commit()
+    results = []
+    for n in sizes:
+        for machine_count in machine_counts:
+            for engine in engines:
+                for seed in seeds:
+                    if engine in MODEL_ENGINES and n > max_model_scans:
+                        continue
+                    record = run_case(n, machine_count, engine, seed, locked_load, time_limit, soft=soft)
+                    results.append(record)
+                    timings = record["timings"] or {}
+                    print(f"{n:>6} scans {machine_count:>4} machines {engine:>9}: {record['status']}, "
+                          f"objective {record['objective']}, gap {record['gap']}, total {timings.get('total')}")
+
+    output = output or f"benchmark_{commit or 'local'}.json"
+    with open(output, "w") as f:
+        json.dump({"commit": commit, "created": datetime.now().isoformat(), "results": results}, f, indent=2)
+    print(f"Benchmark results written to {output}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark for optimize_scan_scheduling")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--machines", type=int, nargs="+", default=[3, 10, 30, 100])
+    parser.add_argument("--engines", nargs="+", default=["cpsat", "greedy"])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--locked-load", type=float, default=0.3)
+    parser.add_argument("--time-limit", type=float, default=30)
+    parser.add_argument("--max-model-scans", type=int, default=1000)
+    parser.add_argument("--hard", action="store_true", help="solve without soft assignment")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.machines, args.engines, args.seeds, args.locked_load, args.time_limit,
+                  args.max_model_scans, not args.hard, args.output)
@@ -0,0 +1,147 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+EPOCH = datetime(1970, 1, 1)
+# Keys of a schedule entry, in the order the optimizer writes them
+ENTRY_FIELDS = ["scan_id", "patient_id", "scan_type", "machine", "start_time", "end_time", "priority", "duration"]
+# Keys every entry needs to be placed in time; from_records checks these and the ones its caller reads
+TIME_FIELDS = ["machine", "start_time", "end_time"]
+# Priority of entries read without one
+MISSING_PRIORITY = -1
+
+
+def column_minutes(time_strs):
+    """
+    Integer minutes since EPOCH of a list of "%Y-%m-%d %H:%M" strings, parsed as one array.
+    """
+    if len(time_strs) == 0:
+        return []
+    return np.asarray(time_strs, dtype="datetime64[m]").astype(np.int64).tolist()
+
+
+def minute_strings(minutes):
+    """
+    "%Y-%m-%d %H:%M" strings of a list of minutes since EPOCH, formatted as one array.
+    """
+    if len(minutes) == 0:
+        return []
+    values = np.asarray(minutes, dtype=np.int64).astype("datetime64[m]")
+    return [s.replace("T", " ") for s in np.datetime_as_string(values, unit="m").tolist()]
+
+
+def intern(values):
+    """
+    Small integer codes of values and the table of distinct values (in order of first
+    appearance) they index.
+    """
+    codes, names = pd.factorize(pd.Series(values, dtype=object), sort=False)
+    return codes.astype(np.int16), list(names)
+
+
+class CompactSchedule:
+    """
+    A schedule as columns instead of one dict of strings per entry: start and end in
+    integer minutes since EPOCH, machine and scan type as codes into interned name
+    tables, priority and duration as small integers, and scan_id and patient_id as the
+    values they had. Times are parsed once when the schedule is read (from_records,
+    from_frame) and formatted again only by to_records; the stages in between (the
+    occupancy index, the plots, the Excel agenda) work on the integer columns.
+    """
+
+    DTYPE = np.dtype([("start", np.int64), ("end", np.int64), ("machine", np.int16), ("scan_type", np.int16),
+                      ("priority", np.int8), ("duration", np.int32)])
+
+    def __init__(self, table, scan_ids, patient_ids, machines, scan_types):
+        self.table = table              # structured array of DTYPE, one row per entry
+        self.scan_ids = scan_ids        # object array
+        self.patient_ids = patient_ids  # object array
+        self.machines = machines        # machine code -> name
+        self.scan_types = scan_types    # scan type code -> name
+
+    @classmethod
+    def from_columns(cls, scan_ids, patient_ids, scan_types, machines, starts, ends, priorities, durations=None):
+        table = np.empty(len(scan_ids), dtype=cls.DTYPE)
+        table["start"] = starts
+        table["end"] = ends
+        table["machine"], machine_names = intern(machines)
+        table["scan_type"], scan_type_names = intern(scan_types)
+        table["priority"] = np.asarray(priorities, dtype=np.int64)
+        table["duration"] = table["end"] - table["start"] if durations is None else np.asarray(durations, dtype=np.int64)
+        return cls(table, np.asarray(scan_ids, dtype=object), np.asarray(patient_ids, dtype=object), machine_names,
+                   scan_type_names)
+
+    @classmethod
+    def from_records(cls, schedule, required=ENTRY_FIELDS[:-1]):
+        """
+        Compact form of schedule entries: dicts with machine, start_time, end_time and the
+        keys in required (raises KeyError naming the missing ones). Other missing keys
+        default to None (scan_id, patient_id), "" (scan_type) or MISSING_PRIORITY
+        (priority); a missing duration is taken from the times.
+        """
+        fields = TIME_FIELDS + [f for f in required if f not in TIME_FIELDS]
+        missing = [f for f in fields if any(f not in entry for entry in schedule)]
+        if missing:
+            raise KeyError(f"Schedule entries without {', '.join(missing)}")
+        durations = [entry.get("duration") for entry in schedule]
+        return cls.from_columns(
+            [entry.get("scan_id") for entry in schedule], [entry.get("patient_id") for entry in schedule],
+            [entry.get("scan_type", "") for entry in schedule], [entry["machine"] for entry in schedule],
+            column_minutes([entry["start_time"] for entry in schedule]),
+            column_minutes([entry["end_time"] for entry in schedule]),
+            [int(entry.get("priority", MISSING_PRIORITY)) for entry in schedule],
+            None if any(d is None or d != d for d in durations) else durations
+        )
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Compact form of a stored schedule DataFrame (see schedule_store.load_frame).
+        """
+        return cls.from_columns(
+            df["scan_id"].tolist(), df["patient_id"].tolist(), df["scan_type"].tolist(), df["machine"].tolist(),
+            column_minutes(df["start_time"].tolist()), column_minutes(df["end_time"].tolist()),
+            df["priority"].astype(int).tolist(),
+            df["duration"].astype(int).tolist() if "duration" in df and not df["duration"].isna().any() else None
+        )
+
+    def __len__(self):
+        return len(self.table)
+
+    def select(self, mask):
+        """
+        The entries where mask (a boolean array or index array) holds, sharing the name tables.
+        """
+        return CompactSchedule(self.table[mask], self.scan_ids[mask], self.patient_ids[mask], self.machines,
+                               self.scan_types)
+
+    def machine_names(self):
+        return np.asarray(self.machines, dtype=object)[self.table["machine"]] if len(self) else np.array([], object)
+
+    def scan_type_names(self):
+        return np.asarray(self.scan_types, dtype=object)[self.table["scan_type"]] if len(self) else np.array([], object)
+
+    def to_records(self):
+        """
+        The entries as today's schedule dicts (keys in ENTRY_FIELDS order, times as strings).
+        """
+        columns = zip(
+            self.scan_ids.tolist(), self.patient_ids.tolist(), self.scan_type_names().tolist(),
+            self.machine_names().tolist(), minute_strings(self.table["start"]), minute_strings(self.table["end"]),
+            self.table["priority"].tolist(), self.table["duration"].tolist()
+        )
+        return [dict(zip(ENTRY_FIELDS, values)) for values in columns]
+
+    def to_frame(self):
+        return pd.DataFrame(self.to_records(), columns=ENTRY_FIELDS)
+
+
+def as_compact(schedule, required=ENTRY_FIELDS[:-1]):
+    """
+    schedule as a CompactSchedule, parsing it only if it is still a list of dicts (which
+    need the keys in required, see CompactSchedule.from_records).
+    """
+    if isinstance(schedule, CompactSchedule):
+        return schedule
+    return CompactSchedule.from_records(schedule, required)
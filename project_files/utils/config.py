@@ -1,5 +1,107 @@
+import os
+
 machines = {
     "CT": ["CT-1", "CT-2", "CT-3"],
     "MRI": ["MRI-1", "MRI-2", "MRI-3"],
     "X-Ray": ["XRay-1", "XRay-2"]
 }
+
+# Scheduling engine used by main.do_optimization (see engines.ENGINES): "cpsat" (one model),
+# "rolling", "parallel", "greedy" (list scheduling, no model) or "portfolio" (greedy vs CP-SAT)
+scheduling_engine = "cpsat"
+# Batches with more new scans than this go to surge_engine (None: never)
+surge_batch_size = 500
+surge_engine = "greedy"
+# Rolling-horizon window length and look-ahead overlap, in minutes
+rolling_window_mins = 1440
+rolling_overlap_mins = 0
+# Seed the solver with the stored/previous placement of each scan, and optionally pin
+# those hints for a fast first solve before relaxing
+use_warm_start_hints = True
+fix_hints_first = False
+# Book small batches straight into free gaps (insertion.insert_scans) and only run the full
+# optimizer when a scan would start more than max_insertion_delay_mins late or has no gap
+incremental_insertion = True
+max_insertion_delay_mins = 120
+max_insertion_batch = 5
+# CP-SAT model builder: "classic" or "lean" (compact domains, no big-M)
+model_builder = "classic"
+
+# CP-SAT parameters for every solve. The SOLVER_* environment variables set them per
+# deployment; optimize_scan_scheduling(solver_overrides=...) changes them per request.
+solver_settings = {
+    "max_time_in_seconds": float(os.getenv("SOLVER_TIME_LIMIT", 30)),
+    "num_search_workers": int(os.getenv("SOLVER_WORKERS", 8)),
+    "relative_gap_limit": float(os.getenv("SOLVER_RELATIVE_GAP", 0.0)),
+    "random_seed": int(os.getenv("SOLVER_SEED", 0)),
+    "log_search_progress": os.getenv("SOLVER_LOG", "0") == "1",
+}
+# Tighter budgets applied when a batch contains scans of these priorities (most urgent wins)
+priority_solver_settings = {
+    0: {"max_time_in_seconds": 2.0, "relative_gap_limit": 0.05},
+    1: {"max_time_in_seconds": 5.0, "relative_gap_limit": 0.02},
+}
+# Anytime solving: return the first feasible CP-SAT schedule and publish the improved one
+# from the background. True, False, or "urgent" (only for batches with anytime_priorities)
+anytime_solving = "urgent"
+anytime_priorities = [0, 1]
+# Release the first solution only once it is within this relative gap of the bound (None: any)
+anytime_good_enough_gap = None
+
+schedule_csv_file = 'current_schedule_multiple_machines.csv'
+# Where the schedule is stored: a .db/.sqlite path selects the SQLite store (import the
+# CSV once with `python schedule_store.py <csv> <db>`), anything else the CSV file
+schedule_store_path = os.getenv("SCHEDULE_STORE", schedule_csv_file)
+# A solve whose stored schedule was changed by another writer before it published is read,
+# solved and merged again against the new version, up to this many times in all
+store_write_attempts = 3
+# /optimize requests arriving within this many seconds of each other are solved as one
+# batch (of at most optimize_batch_max_scans scans) by a single writer thread
+optimize_batch_window_secs = float(os.getenv("OPTIMIZE_BATCH_WINDOW", 0.2))
+optimize_batch_max_scans = 50
+# Whisper transcription. whisper_base_url points the client at another OpenAI-compatible
+# server (None: api.openai.com), e.g. the stand-in of whisper_benchmark.py. Recordings longer
+# than whisper_chunk_secs are cut into chunks at pauses (a stretch of whisper_min_silence_ms
+# quieter than the recording's average by whisper_silence_offset_db, searched for in the
+# last whisper_silence_search_secs before each limit) that are transcribed concurrently.
+whisper_base_url = os.getenv("WHISPER_BASE_URL")
+whisper_max_connections = 8
+whisper_chunk_secs = 60
+whisper_silence_search_secs = 15
+whisper_min_silence_ms = 400
+whisper_silence_offset_db = 16
+# RAG extraction answers are cached per normalized transcript, and optionally reused for a
+# transcript whose embedding has at least rag_semantic_threshold cosine similarity to a cached
+# one and the same numbers and priority tokens (None: exact matches only, the default for
+# clinical dictations); rag_cache_size answers are kept for up to rag_cache_ttl_secs
+rag_cache_size = 256
+rag_cache_ttl_secs = 24 * 3600
+rag_semantic_threshold = None
+# RAG retrieval: "pinecone" (the hosted index) or "local" (a LocalVectorIndex per index name,
+# exported to local_index_dir/<index> with `python local_vector_index.py <index> <that dir>`,
+# memory-mapped, with local_index_nprobe lists probed if it was built with --ivf-lists). rag_embeddings is
+# "openai" or "hashing" (offline stand-in; needs an index exported with --embeddings hashing).
+# rag_llm_base_url points the chat model at another OpenAI-compatible server.
+rag_retriever = os.getenv("RAG_RETRIEVER", "pinecone")
+local_index_dir = os.getenv("LOCAL_VECTOR_INDEX", "vector_index")
+local_index_nprobe = 8
+rag_embeddings = os.getenv("RAG_EMBEDDINGS", "openai")
+rag_llm_base_url = os.getenv("RAG_LLM_BASE_URL")
+# Background jobs (POST /jobs/optimize): worker threads, and finished jobs kept for polling
+job_workers = 2
+max_jobs_kept = 200
+# Processes drawing the per-day schedule PNGs (None: one per CPU); unchanged days are skipped
+plot_workers = None
+# Rendered /schedule/plot responses kept per schedule version and request
+plot_cache_size = 64
+# Bulk ingestion (POST /scans/ingest): scans accepted per upload, rejected lines reported
+ingest_max_scans = 20000
+ingest_max_errors = 100
+# Merged schedules of this many recent solves are kept to answer identical requests
+# (retries) without solving again; they are dropped as soon as the stored schedule changes
+solve_cache_size = 32
+# Entries placed by the most recent solves kept as warm-start hints (see optimizer.last_solution)
+last_solution_size = 5000
+# Let the optimizer leave scans unplaced (at a priority-weighted penalty) when a batch
+# overloads the machines, returning a partial schedule instead of no solution
+soft_assignment = False
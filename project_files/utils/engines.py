@@ -0,0 +1,139 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optimizer import (
+    solve_placements, solve_anytime, solve_rolling_horizon, solve_parallel, schedule_objective
+)
+from insertion import occupied_by_machine, place_new_scans
+
+# Every engine takes (new_scans_data, locked_intervals, horizon, hints, stats, settings, **options)
+# and returns {scan_id: (machine, start_mins)}, or None if it found no schedule. options hold
+# the orchestrator's keyword arguments (builder, fix_hints, window_mins, ...); each engine
+# picks the ones it uses and ignores the rest.
+
+
+def cpsat_engine(new_scans_data, locked_intervals, horizon, hints=None, stats=None, settings=None,
+                 builder="classic", fix_hints=False, anytime=False, good_enough_gap=None, on_final=None,
+                 soft=False, progress=None, **options):
+    """
+    One CP-SAT model over the whole horizon; with anytime, see optimizer.solve_anytime.
+    """
+    if anytime:
+        return solve_anytime(
+            new_scans_data, locked_intervals, horizon, on_final, hints, good_enough_gap, stats, settings, builder,
+            soft, progress
+        )
+    return solve_placements(
+        new_scans_data, locked_intervals, horizon, hints, fix_hints, stats, settings, builder, soft, progress
+    )
+
+
+def rolling_engine(new_scans_data, locked_intervals, horizon, hints=None, stats=None, settings=None,
+                   builder="classic", window_mins=1440, overlap_mins=0, compare_monolithic=False, soft=False,
+                   progress=None, **options):
+    """
+    CP-SAT window by window (see optimizer.solve_rolling_horizon). With compare_monolithic
+    the monolithic model is also solved and the objective lost is recorded in stats.
+    """
+    placements = solve_rolling_horizon(
+        new_scans_data, locked_intervals, horizon, window_mins, overlap_mins, hints, stats, builder, settings, soft,
+        progress
+    )
+    if placements is not None and compare_monolithic and stats is not None:
+        stats["objective"] = schedule_objective(new_scans_data, placements, soft)
+        monolithic = solve_placements(
+            new_scans_data, locked_intervals, horizon, settings=settings, builder=builder, soft=soft
+        )
+        if monolithic is not None:
+            stats["monolithic_objective"] = schedule_objective(new_scans_data, monolithic, soft)
+            stats["objective_loss"] = stats["monolithic_objective"] - stats["objective"]
+    return placements
+
+
+def parallel_engine(new_scans_data, locked_intervals, horizon, hints=None, stats=None, settings=None,
+                    builder="classic", soft=False, **options):
+    """
+    One CP-SAT process per modality (see optimizer.solve_parallel).
+    """
+    return solve_parallel(
+        new_scans_data, locked_intervals, horizon, hints=hints, stats=stats, builder=builder, settings=settings,
+        soft=soft
+    )
+
+
+def greedy_engine(new_scans_data, locked_intervals, horizon, hints=None, stats=None, settings=None, **options):
+    """
+    Priority list scheduling: in the (priority, check_in_mins) order of load_scan_requests,
+    each scan takes the earliest legal gap on its eligible machines (see
+    insertion.place_new_scans). No model is built, so thousands of scans take well under
+    a second. Scans left without a gap before their deadline are listed in stats["unplaced"]
+    and the rest is returned.
+    """
+    start = time.perf_counter()
+    ordered = sorted(new_scans_data, key=lambda s: (int(s["priority"]), s["check_in_mins"]))
+    placements, unplaced = place_new_scans(ordered, occupied_by_machine(locked_intervals), horizon)
+    if stats is not None:
+        stats["status"] = "FEASIBLE" if not unplaced else "PARTIAL"
+        stats["wall_time"] = time.perf_counter() - start
+        stats["unplaced"] = unplaced
+    if unplaced:
+        print(f"Greedy engine could not place {len(unplaced)} scans: {unplaced}")
+    return placements
+
+
+def portfolio_engine(new_scans_data, locked_intervals, horizon, hints=None, stats=None, settings=None,
+                     builder="classic", soft=False, progress=None, **options):
+    """
+    Races the greedy engine against CP-SAT in two threads. CP-SAT stops at its
+    max_time_in_seconds, which is the deadline, and the best complete result wins;
+    a tie goes to CP-SAT. If neither places every scan, the greedy partial schedule is used.
+    With soft, partial results compete too, scored with the unplaced-scan penalty.
+    """
+    greedy_stats, cpsat_stats = {}, {}
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        greedy = pool.submit(greedy_engine, new_scans_data, locked_intervals, horizon, stats=greedy_stats)
+        cpsat = pool.submit(
+            solve_placements, new_scans_data, locked_intervals, horizon, hints, False, cpsat_stats, settings, builder,
+            soft, progress
+        )
+        results = {"greedy": greedy.result(), "cpsat": cpsat.result()}
+
+    objectives = {}
+    for name, placements in results.items():
+        if placements is not None and (soft or len(placements) == len(new_scans_data)):
+            objectives[name] = schedule_objective(new_scans_data, placements, soft)
+    if objectives:
+        winner = max(["cpsat", "greedy"], key=lambda name: objectives.get(name, float("-inf")))
+    else:
+        winner = "greedy"
+
+    if stats is not None:
+        stats.update(cpsat_stats if winner == "cpsat" else greedy_stats)
+        stats["portfolio"] = {
+            "winner": winner,
+            "objectives": objectives,
+            "greedy_wall_time": greedy_stats.get("wall_time"),
+            "cpsat_status": cpsat_stats.get("status"),
+        }
+    return results[winner]
+
+
+ENGINES = {
+    "cpsat": cpsat_engine,
+    "rolling": rolling_engine,
+    "parallel": parallel_engine,
+    "greedy": greedy_engine,
+    "portfolio": portfolio_engine,
+}
+
+# Engines that solve the hard CP-SAT model and find nothing when it is infeasible; the
+# optimizer's capacity_check stops them early. greedy and portfolio return partial schedules.
+MODEL_ENGINES = {"cpsat", "rolling", "parallel"}
+
+
+def get_engine(name):
+    """
+    Looks up a scheduling engine by name.
+    """
+    if name not in ENGINES:
+        raise ValueError(f"Unknown scheduling engine: {name}")
+    return ENGINES[name]
@@ -1,51 +1,207 @@
+import numpy as np
 import openpyxl
+from bisect import bisect_right
+from copy import copy
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, PatternFill
 from openpyxl.utils import get_column_letter
-from datetime import datetime
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
+from datetime import datetime, timedelta
+from compact_schedule import EPOCH, as_compact
 
+MINUTES_PER_DAY = 24 * 60
+# Row of each minute of the day is minute + FIRST_ROW (row 1 holds the machine names)
+FIRST_ROW = 2
+TIME_LABELS = [f"{m // 60:02}:{m % 60:02}" for m in range(MINUTES_PER_DAY)]
+# Fill of the labels of overlapping bookings (see check_for_overlaps)
+CONFLICT_FILL = PatternFill("solid", fgColor="FFC7CE")
+# Keys the agenda reads from entry dicts besides machine and times
+AGENDA_FIELDS = ["patient_id", "scan_type"]
 
-def create_machine_agenda_excel(schedule, output_excel_file="machine_agenda.xlsx"):
+
+def day_number(day):
     """
-    Creates an Excel file that represents the daily planner with machine schedules in a structured format.
+    Days since EPOCH of a date, datetime or "%Y-%m-%d" string.
     """
-    # Initialize a new workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Daily Planner"
+    if isinstance(day, str):
+        day = datetime.strptime(day, "%Y-%m-%d")
+    if isinstance(day, datetime):
+        day = day.date()
+    return (day - EPOCH.date()).days
 
-    # Define time slots (1-minute intervals across 24 hours)
-    time_slots = [datetime.strptime(f"{h:02}:{m:02}", "%H:%M") for h in range(24) for m in range(60)]
-    time_strs = [t.strftime("%H:%M") for t in time_slots]
 
-    # Get unique machine names in sorted order
-    machines_order = sorted(set(entry["machine"] for entry in schedule))
+def agenda_blocks(schedule, machines_order, first_day=None, last_day=None):
+    """
+    Bookings of a schedule (a CompactSchedule, or entry dicts with machine, start_time,
+    end_time and AGENDA_FIELDS) as blocks of rows per day sheet:
+    {day: {column: [(first_row, last_row, label), ...]}}, sorted by first row. A booking
+    running past midnight gets a block on each day it covers. Days outside
+    first_day..last_day (day numbers, None: open) are left out. The rows are computed and
+    sorted as arrays; only the final tuples are built one by one.
+    """
+    schedule = as_compact(schedule, AGENDA_FIELDS)
+    if not len(schedule):
+        return {}
+    columns = {machine: col for col, machine in enumerate(machines_order, start=2)}
+    machine_columns = np.array([columns[machine] for machine in schedule.machines])
+    labels, label_ranks = np.unique(
+        [f"{p} ({t})" for p, t in zip(schedule.patient_ids.tolist(), schedule.scan_type_names().tolist())],
+        return_inverse=True
+    )
 
-    # Write column headers
-    ws["A1"] = "Time"
-    for col_idx, machine in enumerate(machines_order, start=2):
-        ws.cell(row=1, column=col_idx, value=machine)
+    # One block per booking and day it covers
+    starts = schedule.table["start"]
+    ends = np.maximum(schedule.table["end"], starts + 1)
+    spans = (ends - 1) // MINUTES_PER_DAY - starts // MINUTES_PER_DAY + 1
+    booking = np.repeat(np.arange(len(starts)), spans)
+    day = starts[booking] // MINUTES_PER_DAY + np.arange(len(booking)) - np.repeat(np.cumsum(spans) - spans, spans)
+    keep = np.ones(len(booking), dtype=bool)
+    if first_day is not None:
+        keep &= day >= first_day
+    if last_day is not None:
+        keep &= day <= last_day
+    booking, day = booking[keep], day[keep]
+    midnight = day * MINUTES_PER_DAY
+    first_row = np.maximum(starts[booking], midnight) - midnight + FIRST_ROW
+    last_row = np.minimum(ends[booking], midnight + MINUTES_PER_DAY) - 1 - midnight + FIRST_ROW
+    col = machine_columns[schedule.table["machine"][booking]]
+    label_rank = label_ranks[booking]
 
-    # Fill time slots in first column
-    for row_idx, time_str in enumerate(time_strs, start=2):
-        ws.cell(row=row_idx, column=1, value=time_str)
+    order = np.lexsort((label_rank, last_row, first_row, col, day))
+    day, col = day[order].tolist(), col[order].tolist()
+    blocks = zip(first_row[order].tolist(), last_row[order].tolist(), labels[label_rank[order]].tolist())
+    days = {}
+    for d, c, block in zip(day, col, blocks):
+        days.setdefault(d, {}).setdefault(c, []).append(block)
+    return days
 
-    # Populate the machine schedule
-    for entry in schedule:
-        machine = entry["machine"]
-        start_time = datetime.strptime(entry["start_time"], "%Y-%m-%d %H:%M")
-        end_time = datetime.strptime(entry["end_time"], "%Y-%m-%d %H:%M")
 
-        start_idx = time_strs.index(start_time.strftime("%H:%M")) + 2
-        end_idx = time_strs.index(end_time.strftime("%H:%M")) + 2
-        col_idx = machines_order.index(machine) + 2
+def split_conflicts(blocks):
+    """
+    Splits the blocks of each column (sorted by first row) into the ones that are merged in
+    the column and the ones that overlap an earlier block there, since merged ranges may
+    not share rows. Returns the kept blocks as {column: [block, ...]}, the overlapping ones
+    as [(column, block), ...] in order of first row, and the (column, first_row) of the
+    kept blocks they overlap.
+    """
+    kept = {}
+    conflicts = []
+    for col, column_blocks in blocks.items():
+        column_kept = kept[col] = []
+        covered = FIRST_ROW - 1
+        for block in column_blocks:
+            if block[0] <= covered:
+                conflicts.append((col, block))
+            else:
+                column_kept.append(block)
+                covered = block[1]
+    # Kept blocks of a column are disjoint, so their last rows are sorted too
+    kept_ends = {col: [block[1] for block in column_kept] for col, column_kept in kept.items() if column_kept}
+    overlapped = set()
+    for col, (first_row, last_row, _) in conflicts:
+        column_kept = kept[col]
+        i = bisect_right(kept_ends[col], first_row - 1)
+        while i < len(column_kept) and column_kept[i][0] <= last_row:
+            overlapped.add((col, column_kept[i][0]))
+            i += 1
+    conflicts.sort(key=lambda conflict: (conflict[1][0], conflict[0]))
+    return kept, conflicts, overlapped
 
-        cell_value = f"{entry['patient_id']} ({entry['scan_type']})"
 
-        for row in range(start_idx, end_idx):
-            ws.cell(row=row, column=col_idx, value=cell_value)
+def conflict_lanes(conflicts):
+    """
+    Spreads overlapping bookings over as few extra columns as possible so that the
+    bookings in one of them do not overlap: [lane, ...] parallel to conflicts.
+    """
+    lane_ends = []
+    lanes = []
+    for _, (first_row, last_row, _) in conflicts:
+        lane = next((i for i, end in enumerate(lane_ends) if end < first_row), len(lane_ends))
+        if lane == len(lane_ends):
+            lane_ends.append(last_row)
+        lane_ends[lane] = last_row
+        lanes.append(lane)
+    return lanes
+
 
-    # Adjust column widths
-    for col in range(1, len(machines_order) + 2):
+def write_day_sheet(wb, title, machines_order, blocks):
+    """
+    Streams one day of the agenda into a new write-only sheet: a row per minute, each
+    booking's label in its first row and merged down over the rows it occupies. A booking
+    that overlaps an earlier one on its machine keeps its true rows but goes to a
+    "Conflicts" column after the machines, labelled with the machine; it and the bookings
+    it overlaps are highlighted.
+    """
+    kept, conflicts, overlapped = split_conflicts(blocks)
+    lanes = conflict_lanes(conflicts)
+    lane_count = max(lanes) + 1 if lanes else 0
+    first_lane_col = len(machines_order) + 2
+
+    ws = wb.create_sheet(title)
+    # Column widths and panes have to be set before the first row is written
+    for col in range(1, first_lane_col + lane_count):
         ws.column_dimensions[get_column_letter(col)].width = 20
+    ws.freeze_panes = "B2"
+    ws.append(["Time"] + machines_order + ["Conflicts"] * lane_count)
+
+    # Labels at the top of their block; the styles are resolved once and copied to every label
+    template = WriteOnlyCell(ws)
+    template.alignment = Alignment(vertical="top", wrap_text=True)
+    conflict_template = WriteOnlyCell(ws)
+    conflict_template.alignment = Alignment(vertical="top", wrap_text=True)
+    conflict_template.fill = CONFLICT_FILL
+    labels = {}
+    merged = set()
+
+    def add_label(col, first_row, last_row, label, style):
+        cell = WriteOnlyCell(ws, value=label)
+        cell._style = copy(style._style)
+        labels.setdefault(first_row, {})[col] = cell
+        if last_row > first_row:
+            merged.add(CellRange(min_col=col, min_row=first_row, max_col=col, max_row=last_row))
+
+    for col, column_blocks in kept.items():
+        for first_row, last_row, label in column_blocks:
+            style = conflict_template if (col, first_row) in overlapped else template
+            add_label(col, first_row, last_row, label, style)
+    for (col, (first_row, last_row, label)), lane in zip(conflicts, lanes):
+        add_label(first_lane_col + lane, first_row, last_row, f"{machines_order[col - 2]}: {label}",
+                  conflict_template)
+
+    for row, time_label in enumerate(TIME_LABELS, start=FIRST_ROW):
+        row_labels = labels.get(row)
+        if not row_labels:
+            ws.append([time_label])
+            continue
+        values = [time_label] + [None] * (max(row_labels) - 1)
+        for col, cell in row_labels.items():
+            values[col - 1] = cell
+        ws.append(values)
+    # Built as a whole: adding ranges one by one checks each against all earlier ones
+    ws.merged_cells = MultiCellRange(merged)
+
+
+def create_machine_agenda_excel(schedule, output_excel_file="machine_agenda.xlsx", start_date=None, end_date=None):
+    """
+    Creates an Excel file that represents the daily planner with machine schedules in a structured format.
+    One sheet per day (named by its date), optionally only the days from start_date to
+    end_date; every sheet has the machines of the whole schedule as columns. The workbook
+    is written in openpyxl's write-only mode, one day at a time. Entry dicts need machine,
+    start_time, end_time and AGENDA_FIELDS.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    schedule = as_compact(schedule, AGENDA_FIELDS)
+    machines_order = sorted(set(schedule.machine_names().tolist()))
+    days = agenda_blocks(
+        schedule, machines_order,
+        day_number(start_date) if start_date is not None else None,
+        day_number(end_date) if end_date is not None else None
+    )
+    for day in sorted(days):
+        title = (EPOCH + timedelta(days=day)).strftime("%Y-%m-%d")
+        write_day_sheet(wb, title, machines_order, days.pop(day))
+    if not wb.worksheets:
+        write_day_sheet(wb, "Daily Planner", machines_order, {})
 
     # Save Excel file
     wb.save(output_excel_file)
@@ -2,23 +2,42 @@ import os
 import sys
 import csv
 import io
+import json
+import asyncio
+import hashlib
 import subprocess
 import logging
 from io import BytesIO
+from typing import Optional
+from datetime import datetime, timedelta
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 # Import your processing functions
-from stateful_scheduling import search_with_rag as rag
-from realtime_whisper import audio_processing as ts
+from stateful_scheduling import search_with_rag as rag, rag_cache_counters
+from realtime_whisper import transcribe_audio
 from main import do_optimization as opt
+from config import schedule_store_path, optimize_batch_window_secs, optimize_batch_max_scans
+from config import job_workers, max_jobs_kept
+from schedule_store import schedule_version, is_superseded, open_store, time_window
+from solve_cache import solve_cache
+from batch_queue import OptimizationQueue, write_scans
+from scan_ingest import SCAN_FIELDS, IngestError, UploadTooLarge, ingest_stream
+from jobs import JobManager, sse_stream
+from visualizer import render_day, timeline, plot_cache
 
 g_ts = None
 index = 'scheduler-vectorised'
 
+# Single writer for /optimize: concurrent requests are batched into one solve
+optimization_queue = OptimizationQueue(opt, optimize_batch_window_secs, optimize_batch_max_scans)
+# Background optimization jobs (/jobs/...)
+job_manager = JobManager(job_workers, max_jobs_kept)
+
 app = FastAPI()
 sys.dont_write_bytecode = True
 logging.basicConfig(level=logging.INFO)
@@ -35,6 +54,17 @@ app.add_middleware(
 class TranscriptionRequest(BaseModel):
     transcription: str
 
+# Optional per-request CP-SAT settings for /optimize; unset fields keep the deployment defaults
+class SolverSettings(BaseModel):
+    max_time_in_seconds: Optional[float] = None
+    num_search_workers: Optional[int] = None
+    relative_gap_limit: Optional[float] = None
+    random_seed: Optional[int] = None
+    log_search_progress: Optional[bool] = None
+
+class OptimizeRequest(BaseModel):
+    solver: Optional[SolverSettings] = None
+
 # Response model for /optimize
 class ScheduleEntry(BaseModel):
     scan_id: str
@@ -61,8 +91,8 @@ async def record_and_transcribe(file: UploadFile = File(...)):
         #using buffer here to avoid having to save to database
         dat = BytesIO(audio_data)
         dat.seek(0)
-        #generating transcript using method in realtime_whisper.py
-        transcript = ts(dat, file.filename)
+        #generating transcript using method in realtime_whisper.py (long recordings are chunked and transcribed concurrently)
+        transcript = await transcribe_audio(dat, file.filename)
         # If transcript is a dict or object, extract the text (adjust based on your ts output)
         transcript_text = transcript.get("text") if isinstance(transcript, dict) else transcript.text
         global g_ts
@@ -82,19 +112,33 @@ def process_transcription():
     result = rag(index, g_ts)
     return {"result": result}
 
-@app.post("/optimize")
-def optimize_workflow():
+def format_schedule(optimized_schedule):
+    try:
+        return [
+            {
+                "scan_id": entry["scan_id"],
+                "scan_type": entry["scan_type"],
+                "duration": int(entry["duration"]),
+                "priority": int(entry["priority"]),
+                "patient_id": int(entry["patient_id"]),
+                "start_time": entry.get("start_time", ""),
+                "machine": entry.get("machine", entry["scan_type"]),
+            }
+            for entry in optimized_schedule
+        ]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error formatting schedule: {e}")
+
+def optimize_transcription(transcription, solver_overrides=None, job=None):
     """
-    Optimize the workflow based on the recorded transcription.
-    Uses the stored transcript rather than a hardcoded fake.
+    RAG extraction, solve (through optimization_queue) and formatting of one transcription:
+    the work of /optimize and of optimization jobs. A job also gets status changes and
+    the solver's progress.
     """
-    global g_ts
-    if not g_ts:
-        raise HTTPException(status_code=400, detail="No recorded transcript found")
-
-    transcription = g_ts
     logging.info(f"Received transcription for optimization: {transcription}")
-    
+    if job is not None:
+        job.set_status("extracting")
+
     # Process the transcription using RAG (returns CSV string)
     processed_csv = rag(index, transcription)
     if not processed_csv:
@@ -110,7 +154,13 @@ def optimize_workflow():
  #     raise HTTPException(status_code=500, detail=f"Error converting CSV: {e}")
 
  # # Optimize the workflow using the opt() function
-    optimized_csv = opt(processed_csv)
+    if job is not None:
+        job.set_status("solving")
+    result = optimization_queue.submit(
+        processed_csv, solver_overrides, job.progress if job is not None else None
+    ).result()
+    solver_stats = result["stats"]
+    optimized_csv = result["schedule"]
     if isinstance(optimized_csv, str):
         try:
             csv_reader = csv.DictReader(io.StringIO(optimized_csv))
@@ -121,24 +171,265 @@ def optimize_workflow():
         optimized_schedule = optimized_csv
 
     # Format the output schedule.
-    try:
-        formatted_schedule = [
-            {
-                "scan_id": entry["scan_id"],
-                "scan_type": entry["scan_type"],
-                "duration": int(entry["duration"]),
-                "priority": int(entry["priority"]),
-                "patient_id": int(entry["patient_id"]),
-                "start_time": entry.get("start_time", ""),
-                "machine": entry.get("machine", entry["scan_type"]),
-            }
-            for entry in optimized_schedule
-        ]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error formatting schedule: {e}")
+    formatted_schedule = format_schedule(optimized_schedule)
 
     logging.info(f"Optimized schedule: {formatted_schedule}")
-    return {"schedule": formatted_schedule}
+    return {
+        "schedule": formatted_schedule,
+        "solver": solver_stats,
+        "version": solver_stats.get("schedule_version"),
+        "unplaced": result["unplaced"],
+        "batch": result["batch"],
+    }
+
+
+@app.post("/optimize")
+def optimize_workflow(request: Optional[OptimizeRequest] = None):
+    """
+    Optimize the workflow based on the recorded transcription.
+    Uses the stored transcript rather than a hardcoded fake.
+    An optional body can override the solver settings for this request; the solver
+    status and statistics are returned next to the schedule, together with the
+    version of the stored schedule (see /schedule/status).
+    Requests are solved through optimization_queue, so the schedule holds this request's
+    scans and the statistics are those of the batch it was solved in.
+    Blocks until the schedule is saved; /jobs/optimize runs the same work in the background.
+    """
+    global g_ts
+    if not g_ts:
+        raise HTTPException(status_code=400, detail="No recorded transcript found")
+    solver_overrides = request.solver.model_dump() if request and request.solver else None
+    return optimize_transcription(g_ts, solver_overrides)
+
+
+@app.post("/jobs/optimize", status_code=202)
+def start_optimization_job(request: Optional[OptimizeRequest] = None):
+    """
+    Starts /optimize for the recorded transcription as a background job and returns its
+    id at once. Poll /jobs/{job_id} for the status and final result, or follow
+    /jobs/{job_id}/events for status changes and solver progress.
+    """
+    global g_ts
+    if not g_ts:
+        raise HTTPException(status_code=400, detail="No recorded transcript found")
+    solver_overrides = request.solver.model_dump() if request and request.solver else None
+    job = job_manager.submit(optimize_transcription, g_ts, solver_overrides)
+    return {"job_id": job.id, "status": job.status}
+
+
+def solve_ingested(scans, solver_overrides=None, job=None):
+    """
+    One solve (through optimization_queue) of the scans of a bulk upload, formatted like
+    /optimize. Runs as a job for background ingestion.
+    """
+    if job is not None:
+        job.set_status("solving")
+    result = optimization_queue.submit(
+        write_scans(scans, SCAN_FIELDS), solver_overrides, job.progress if job is not None else None
+    ).result()
+    if result["schedule"] is None:
+        raise HTTPException(status_code=422, detail="No feasible schedule for the ingested scans")
+    return {
+        "schedule": format_schedule(result["schedule"]),
+        "solver": result["stats"],
+        "version": result["stats"].get("schedule_version"),
+        "unplaced": result["unplaced"],
+    }
+
+
+@app.post("/scans/ingest")
+async def ingest_scans(request: Request, format: Optional[str] = None, background: bool = False,
+                       strict: bool = False):
+    """
+    Bulk scan requests, e.g. a day's referral backlog, as a CSV (with the columns of a
+    scan request) or NDJSON (one JSON object per scan) request body. The format follows
+    the Content-Type (text/csv, application/x-ndjson) unless given as ?format=csv|ndjson.
+    The body is parsed and validated line by line as it streams in; invalid lines are
+    rejected and reported ("ingest"), as is a second scan for the same patient, and the
+    valid scans solved together in one solve.
+    With ?strict=true any rejected line fails the upload (422) before solving. With
+    ?background=true the solve runs as a job (see /jobs/{job_id}) and the response only
+    carries its id.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "ndjson" if "json" in content_type else "csv"
+    try:
+        ingestor = await ingest_stream(request.stream(), format)
+    except IngestError as e:
+        raise HTTPException(status_code=413 if isinstance(e, UploadTooLarge) else 400, detail=str(e))
+    summary = ingestor.summary()
+    logging.info(f"Ingested {summary['accepted']} scans, rejected {summary['rejected']} lines")
+    if not ingestor.scans or (strict and ingestor.rejected):
+        raise HTTPException(status_code=422, detail=summary)
+
+    if background:
+        job = job_manager.submit(solve_ingested, ingestor.scans)
+        return {"ingest": summary, "job_id": job.id, "status": job.status}
+    result = await asyncio.to_thread(solve_ingested, ingestor.scans)
+    return dict(result, ingest=summary)
+
+
+def find_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """
+    Status of a job (queued, extracting, solving, done or failed), its latest solver
+    progress, and its result or error once finished.
+    """
+    return find_job(job_id).snapshot()
+
+
+@app.get("/jobs/{job_id}/events")
+def job_events(job_id: str, last_event_id: Optional[int] = Header(None)):
+    """
+    Server-Sent Events of a job: "status" on every stage change, "progress" for every
+    incumbent (objective, best_bound, solver_time, elapsed), then "done" with the result
+    or "failed" with the error. Reconnecting clients resume after their Last-Event-ID.
+    """
+    return StreamingResponse(
+        sse_stream(find_job(job_id), last_event_id or 0), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.get("/schedule/status")
+def schedule_status(version: Optional[str] = None):
+    """
+    Reports the current version of the stored schedule. With the version returned by
+    /optimize it also tells whether that schedule has since been replaced, e.g. by the
+    improved result of an anytime solve.
+    """
+    status = {"current_version": schedule_version(schedule_store_path)}
+    if version is not None:
+        status["superseded"] = is_superseded(schedule_store_path, version)
+    return status
+
+
+@app.get("/schedule/window")
+def schedule_window(hours: Optional[int] = None, days: Optional[int] = None, machine: Optional[str] = None):
+    """
+    Stored entries starting from now over the next `hours` and/or `days` (default: the
+    48-hour locked window), optionally for one machine.
+    """
+    if hours is None and days is None:
+        hours = 48
+    start, end = time_window(datetime.now(), hours, days)
+    return {"start": start, "end": end, "schedule": open_store(schedule_store_path).rows_between(start, end, machine)}
+
+
+PLOT_MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml", "json": "application/json"}
+
+
+def minute_of_day(value, name):
+    try:
+        hours, minutes = value.split(":")
+        minute = int(hours) * 60 + int(minutes)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be HH:MM")
+    if not 0 <= minute <= 1440:
+        raise HTTPException(status_code=400, detail=f"{name} must be within the day")
+    return minute
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+@app.get("/schedule/plot")
+def schedule_plot(day: str, format: str = "png", machines: Optional[str] = None, start: Optional[str] = None,
+                  end: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    """
+    Agenda of the stored schedule for one day (YYYY-MM-DD) as a PNG, an SVG or a JSON
+    timeline, optionally for some machines (comma-separated) and a time range (start/end
+    as HH:MM; bookings overlapping it are shown). Rendered on request and cached per
+    schedule version: the ETag changes only with the schedule or the request, and a
+    client sending it back in If-None-Match gets 304 Not Modified without a render.
+    """
+    if format not in PLOT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(PLOT_MEDIA_TYPES)}")
+    try:
+        day_start = datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="day must be YYYY-MM-DD")
+    window = None
+    if start is not None or end is not None:
+        window = (minute_of_day(start or "00:00", "start"), minute_of_day(end or "24:00", "end"))
+        if window[0] >= window[1]:
+            raise HTTPException(status_code=400, detail="start must be before end")
+    machine_set = sorted(set(m.strip() for m in machines.split(",") if m.strip())) if machines else None
+
+    def tag(version):
+        key = json.dumps([version, day, format, machine_set, window])
+        return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+    etag = tag(schedule_version(schedule_store_path))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    cached = plot_cache.get(etag)
+    if cached is None:
+        rows = open_store(schedule_store_path).rows_between(*time_window(day_start, days=1))
+        # The schedule may have been replaced while it was read: tag what was read
+        version = schedule_version(schedule_store_path)
+        etag = headers["ETag"] = tag(version)
+        if machine_set:
+            rows = [row for row in rows if row["machine"] in machine_set]
+        if window is not None:
+            window_start, window_end = time_window(
+                day_start + timedelta(minutes=window[0]), hours=(window[1] - window[0]) / 60
+            )
+            rows = [row for row in rows if row["start_time"] < window_end and row["end_time"] > window_start]
+        if format == "json":
+            body = json.dumps({"day": day, "version": version, "bookings": timeline(rows)}).encode()
+        elif not rows and window is None:
+            raise HTTPException(status_code=404, detail=f"No bookings on {day}")
+        else:
+            body = render_day(rows, day, format, window, machine_set)
+        cached = (PLOT_MEDIA_TYPES[format], body)
+        plot_cache.put(etag, cached)
+    return Response(cached[1], media_type=cached[0], headers=headers)
+
+
+@app.get("/schedule/plot/cache")
+def schedule_plot_cache():
+    """
+    Size and hit/miss/eviction counters of the rendered plot cache.
+    """
+    return plot_cache.counters()
+
+
+@app.get("/optimize/cache")
+def optimize_cache():
+    """
+    Size and hit/miss/eviction counters of the solve cache.
+    """
+    return solve_cache.counters()
+
+
+@app.get("/rag/cache")
+def rag_cache():
+    """
+    Size and hit/miss/eviction counters of the exact and semantic RAG answer caches.
+    """
+    return rag_cache_counters()
+
+
+@app.get("/optimize/queue")
+def optimize_queue():
+    """
+    Requests waiting in the optimization queue and the batches solved so far.
+    """
+    return optimization_queue.counters()
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))  # Default to 10000 if PORT is not set
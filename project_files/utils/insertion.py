@@ -0,0 +1,207 @@
+from bisect import bisect_right
+from datetime import datetime
+from schedule_store import schedule_version
+from solve_cache import solve_key, cached_schedule, remember_schedule
+from optimizer import (
+    DEADLINE_MINS, last_solution, load_scan_requests, load_existing_schedule, eligible_machines,
+    earliest_start, planning_horizon, locked_intervals_from_schedule, placements_to_schedule,
+    merge_and_save, schedule_once, retry_on_conflict, latest_starts, resolve_solver_settings
+)
+
+
+def occupied_by_machine(intervals):
+    """
+    Groups (machine, start_mins, duration, scan_id) intervals into sorted
+    [(start, end), ...] lists per machine.
+    """
+    occupied = {}
+    for m, start, duration, _ in intervals:
+        occupied.setdefault(m, []).append((start, start + duration))
+    for m in occupied:
+        occupied[m].sort()
+    return occupied
+
+
+def earliest_gap(busy, lower_bound, duration, priority):
+    """
+    First start >= lower_bound at which the scan fits between the busy intervals of one
+    machine. P4/P5 scans only start inside the allowed part of the day (see
+    optimizer.earliest_start). A Priority 0 scan only waits for the scan in progress
+    and is allowed to overlap later bookings, which the merge step's repair moves.
+    """
+    t = earliest_start(lower_bound, priority)
+    # Intervals sorted by start on one machine do not overlap, so their ends are sorted too
+    ends = [end for _, end in busy]
+    i = bisect_right(ends, t)
+    if priority == 0:
+        if i < len(busy) and busy[i][0] < t:
+            return busy[i][1]
+        return t
+
+    while i < len(busy):
+        start, end = busy[i]
+        if t + duration <= start:
+            break
+        t = earliest_start(max(t, end), priority)
+        i = bisect_right(ends, t, i)
+    return t
+
+
+def merged_blocks(busy):
+    """
+    Coalesces overlapping or touching intervals into disjoint [(start, end), ...] blocks.
+    A gap search over the blocks finds the same starts as over the single bookings, but
+    skips a run of back-to-back bookings in one step.
+    """
+    blocks = []
+    for start, end in busy:
+        if blocks and start <= blocks[-1][1]:
+            blocks[-1] = (blocks[-1][0], max(blocks[-1][1], end))
+        else:
+            blocks.append((start, end))
+    return blocks
+
+
+def add_to_blocks(blocks, start, end):
+    """
+    Adds one interval to sorted disjoint blocks, merging it with the blocks it touches.
+    """
+    i = bisect_right(blocks, (start, end))
+    lo, hi = i, i
+    while lo > 0 and blocks[lo - 1][1] >= start:
+        lo -= 1
+    while hi < len(blocks) and blocks[hi][0] <= end:
+        hi += 1
+    if lo < hi:
+        start = min(start, blocks[lo][0])
+        end = max(end, blocks[hi - 1][1])
+    blocks[lo:hi] = [(start, end)]
+
+
+def place_new_scans(new_scans_data, occupied, horizon):
+    """
+    Greedily books each scan, in (priority, check-in) order, at the machine offering the
+    earliest legal start. Returns ({scan_id: (machine, start_mins)}, unplaced scan_ids).
+    """
+    placements = {}
+    unplaced = []
+    booked_patients = set()
+    # Priority 0 scans need the single bookings (they only wait for the scan in
+    # progress); everything else searches the merged blocks
+    blocks = {m: merged_blocks(busy) for m, busy in occupied.items()}
+    for s in new_scans_data:
+        priority = int(s["priority"])
+        duration = int(s["duration"])
+        # --- Step 7: one scan per patient ---
+        if s["patient_id"] in booked_patients:
+            unplaced.append(s["scan_id"])
+            continue
+
+        latest_start = s["check_in_mins"] + DEADLINE_MINS.get(priority, horizon)
+        best = None
+        for m in eligible_machines(s["scan_type"], priority):
+            busy = occupied.get(m, []) if priority == 0 else blocks.get(m, [])
+            st = earliest_gap(busy, s["check_in_mins"], duration, priority)
+            if st <= latest_start and (best is None or st < best[1]):
+                best = (m, st)
+
+        if best is None:
+            unplaced.append(s["scan_id"])
+            continue
+        m, st = best
+        placements[s["scan_id"]] = best
+        booked_patients.add(s["patient_id"])
+        busy = occupied.setdefault(m, [])
+        busy.insert(bisect_right(busy, (st, st + duration)), (st, st + duration))
+        add_to_blocks(blocks.setdefault(m, []), st, st + duration)
+    return placements, unplaced
+
+
+def insert_scans(scans, schedule_csv_path, max_delay_mins=120, max_batch=5, stats=None, **optimizer_kwargs):
+    """
+    Places a few new scans directly into free gaps of the stored schedule without building
+    a CP-SAT model. Every scan must start within max_delay_mins of its earliest legal
+    start (its objective loss against an empty machine); otherwise, or when a scan has
+    no legal gap before its deadline, or when the batch holds more than max_batch scans,
+    the whole batch falls back to optimize_scan_scheduling with optimizer_kwargs.
+    Like the optimizer, an identical request against an unchanged store returns the cached
+    schedule (unless optimizer_kwargs sets use_cache=False), a request whose scans are
+    all stored already returns the stored schedule without writing it again, and a batch
+    whose write lost to another writer is placed again against the new version (see
+    optimizer.retry_on_conflict).
+    Returns the merged schedule from the first day of the batch on, or None if no
+    solution was found or it could not be saved.
+    """
+    return retry_on_conflict(lambda attempt_stats: insert_once(scans, schedule_csv_path, max_delay_mins, max_batch,
+                                                                attempt_stats, **optimizer_kwargs), stats)
+
+
+def insert_once(scans, schedule_csv_path, max_delay_mins, max_batch, stats, **optimizer_kwargs):
+    """
+    One read, place and merge pass of insert_scans (the fallback is one pass of the
+    optimizer). Nothing is written if the store moved on from the version it read.
+    """
+    scans_data_all, reference_datetime = load_scan_requests(scans)
+    store_version = schedule_version(schedule_csv_path)
+    existing_schedule, _, locked_ids, existing = load_existing_schedule(
+        schedule_csv_path, datetime.now(), reference_datetime
+    )
+
+    use_cache = optimizer_kwargs.get("use_cache", True)
+    if use_cache:
+        cache_key = solve_key(
+            scans_data_all, resolve_solver_settings(scans_data_all, optimizer_kwargs.get("solver_overrides")),
+            ["insertion", max_delay_mins, max_batch]
+        )
+        cached = cached_schedule(cache_key, store_version)
+        if cached is not None:
+            stats.update(cached["stats"])
+            stats["cache"] = "hit"
+            print("Returning the cached schedule of an identical request.")
+            return [dict(row) for row in cached["schedule"]]
+        stats["cache"] = "miss"
+
+    # Scans already in the stored schedule keep their booking, as in the merge step
+    skip_ids = set(row["scan_id"] for row in existing_schedule) | locked_ids
+    new_scans_data = [s for s in scans_data_all if s["scan_id"] not in skip_ids]
+    if not new_scans_data:
+        # A retry of a request that was already booked: nothing to place, nothing to publish
+        print("All scans of the request are already scheduled.")
+        stats["engine"] = "insertion"
+        stats["schedule_version"] = store_version
+        return [dict(row) for row in existing_schedule]
+
+    reason = None
+    if len(new_scans_data) > max_batch:
+        reason = "batch too large"
+    else:
+        horizon = planning_horizon(new_scans_data)
+        occupied = occupied_by_machine(
+            locked_intervals_from_schedule(existing, reference_datetime, after=0)
+        )
+        placements, unplaced = place_new_scans(new_scans_data, occupied, horizon)
+        delays = {
+            s["scan_id"]: placements[s["scan_id"]][1] - earliest_start(s["check_in_mins"], int(s["priority"]))
+            for s in new_scans_data if s["scan_id"] in placements
+        }
+        if unplaced:
+            reason = "no legal gap"
+        elif delays and max(delays.values()) > max_delay_mins:
+            reason = "delay above bound"
+
+    if reason:
+        print(f"Insertion fell back to the full optimizer: {reason}")
+        stats["insertion_fallback"] = reason
+        return schedule_once(scans, schedule_csv_path, stats=stats, **optimizer_kwargs)
+
+    stats["engine"] = "insertion"
+    stats["delay_mins"] = delays
+    new_schedule = placements_to_schedule(new_scans_data, placements, reference_datetime)
+    for entry in new_schedule:
+        last_solution.put(entry["scan_id"], entry)
+    merged = merge_and_save(existing_schedule, new_schedule, schedule_csv_path, store_version, stats,
+                            base_version=store_version, deadlines=latest_starts(new_scans_data, reference_datetime),
+                            locked_ids=locked_ids)
+    if use_cache and merged is not None:
+        remember_schedule(cache_key, stats["schedule_version"], [dict(row) for row in merged], stats)
+    return merged
@@ -0,0 +1,130 @@
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED = ("done", "failed")
+
+
+class Job:
+    """
+    One background job: its status, its result or error, and a numbered event log
+    (status changes and solver progress) that /jobs/{id}/events streams. The newest
+    max_events events are kept.
+    """
+
+    def __init__(self, max_events=500):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.last_progress = None
+        self.events = deque(maxlen=max_events)
+        self.event_count = 0
+        self.changed = threading.Condition()
+
+    def publish(self, event, data):
+        with self.changed:
+            if self.status in FINISHED:
+                # e.g. an anytime solve still improving in the background
+                return
+            self.event_count += 1
+            self.events.append((self.event_count, event, data))
+            self.changed.notify_all()
+
+    def set_status(self, status):
+        self.publish("status", {"status": status, "elapsed": time.time() - self.created})
+        self.status = status
+
+    def progress(self, update):
+        """
+        Solver progress callback (see optimizer.SolutionTimer).
+        """
+        update = dict(update, elapsed=time.time() - self.created)
+        self.last_progress = update
+        self.publish("progress", update)
+
+    def finish(self, result=None, error=None):
+        self.publish("failed" if error else "done", {"error": error} if error else result)
+        with self.changed:
+            self.result, self.error = result, error
+            self.status = "failed" if error else "done"
+            self.finished = time.time()
+            self.changed.notify_all()
+
+    def events_after(self, last_id, timeout=15):
+        """
+        Events numbered above last_id, waiting up to timeout seconds for one to arrive.
+        An empty list means a timeout or a finished job with nothing left to send.
+        """
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.event_count > last_id or self.status in FINISHED, timeout
+            )
+            return [e for e in self.events if e[0] > last_id]
+
+    def snapshot(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "elapsed": (self.finished or time.time()) - self.created,
+            "progress": self.last_progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+def sse_stream(job, last_id=0, keepalive_secs=15):
+    """
+    Server-Sent Events for a job, starting after event last_id (the Last-Event-ID of a
+    reconnecting client). Ends once the job has finished and its events have been sent.
+    """
+    while True:
+        events = job.events_after(last_id, keepalive_secs)
+        if not events:
+            if job.status in FINISHED:
+                return
+            yield ": keepalive\n\n"
+            continue
+        for event_id, event, data in events:
+            last_id = event_id
+            yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class JobManager:
+    """
+    Runs work(*args, job=job) for each submitted job on a small thread pool and keeps the
+    last max_jobs jobs for polling; the oldest finished jobs are dropped first.
+    """
+
+    def __init__(self, max_workers=2, max_jobs=200):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, work, *args):
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+            for job_id in [j for j, old in self.jobs.items() if old.status in FINISHED]:
+                if len(self.jobs) <= self.max_jobs:
+                    break
+                del self.jobs[job_id]
+        self.executor.submit(self.run, job, work, args)
+        return job
+
+    def run(self, job, work, args):
+        try:
+            job.finish(work(*args, job=job))
+        except Exception as e:
+            job.finish(error=str(e))
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
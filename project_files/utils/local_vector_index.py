@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from typing import Any
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+# Files of an index directory
+VECTORS = "vectors.npy"
+DOCUMENTS = "documents.jsonl"
+META = "meta.json"
+IVF_CENTROIDS = "ivf_centroids.npy"
+IVF_ORDER = "ivf_order.npy"
+IVF_OFFSETS = "ivf_offsets.npy"
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Positions of the k highest scores, best first.
+    """
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def assign_lists(vectors, centroids, batch=65536):
+    return np.concatenate([
+        np.argmax(vectors[i:i + batch] @ centroids.T, axis=1) for i in range(0, len(vectors), batch)
+    ])
+
+
+def train_ivf(vectors, n_lists, iterations=10, seed=0, points_per_list=64):
+    """
+    Spherical k-means over unit vectors, trained on a sample of points_per_list vectors
+    per list. Returns (centroids, list of each vector).
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(len(vectors), n_lists * points_per_list),
+                                                   replace=False))])
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(iterations):
+        assignment = assign_lists(sample, centroids)
+        sums = np.stack([np.bincount(assignment, sample[:, d], n_lists) for d in range(sample.shape[1])], axis=1)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = normalize_rows(sums)
+    return centroids, assign_lists(vectors, centroids)
+
+
+class LocalVectorIndex:
+    """
+    Embeddings of a document collection in a directory: unit vectors in a NumPy file that
+    is memory-mapped rather than read, and the documents as JSON lines. Queries score all
+    vectors with one matrix-vector product (cosine similarity). An index built with
+    ivf_lists also holds an inverted file (k-means lists); queries then only score the
+    vectors in the nprobe lists closest to the query, an approximate search for large
+    collections.
+    """
+
+    def __init__(self, directory, nprobe=8):
+        self.directory = directory
+        with open(os.path.join(directory, META)) as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(directory, VECTORS), mmap_mode="r")
+        with open(os.path.join(directory, DOCUMENTS)) as f:
+            self.documents = [json.loads(line) for line in f]
+        self.nprobe = nprobe
+        self.centroids = None
+        if os.path.exists(os.path.join(directory, IVF_CENTROIDS)):
+            self.centroids = np.load(os.path.join(directory, IVF_CENTROIDS))
+            self.order = np.load(os.path.join(directory, IVF_ORDER), mmap_mode="r")
+            self.offsets = np.load(os.path.join(directory, IVF_OFFSETS))
+
+    @classmethod
+    def build(cls, directory, vectors, documents, embedding="unknown", ivf_lists=None, nprobe=8):
+        """
+        Writes an index of vectors (one row per document) and documents (dicts with
+        page_content and metadata) to directory and opens it.
+        """
+        vectors = normalize_rows(vectors)
+        if len(vectors) != len(documents):
+            raise ValueError(f"{len(vectors)} vectors for {len(documents)} documents")
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, VECTORS), vectors)
+        with open(os.path.join(directory, DOCUMENTS), "w") as f:
+            for doc in documents:
+                f.write(json.dumps({"page_content": doc["page_content"], "metadata": doc.get("metadata", {})}) + "\n")
+        for name in (IVF_CENTROIDS, IVF_ORDER, IVF_OFFSETS):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        if ivf_lists:
+            centroids, assignment = train_ivf(vectors, min(ivf_lists, len(vectors)))
+            order = np.argsort(assignment, kind="stable")
+            offsets = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+            np.save(os.path.join(directory, IVF_CENTROIDS), centroids)
+            np.save(os.path.join(directory, IVF_ORDER), order)
+            np.save(os.path.join(directory, IVF_OFFSETS), offsets)
+        with open(os.path.join(directory, META), "w") as f:
+            json.dump({"count": len(vectors), "dim": vectors.shape[1] if len(vectors) else 0,
+                       "embedding": embedding, "ivf_lists": ivf_lists}, f)
+        return cls(directory, nprobe)
+
+    def search(self, vector, k=4):
+        """
+        [(score, document), ...] of the k documents most similar to vector, best first.
+        """
+        query = normalize_rows(vector)
+        if query.shape[-1] != self.meta["dim"]:
+            raise ValueError(f"Query has {query.shape[-1]} dimensions, the index {self.meta['dim']}")
+        if self.centroids is None:
+            candidates = None
+            scores = self.vectors @ query
+        else:
+            lists = top_k(self.centroids @ query, self.nprobe)
+            # Sorted, so the rows are read from the memory map in file order
+            candidates = np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists]))
+            scores = self.vectors[candidates] @ query
+        best = top_k(scores, k)
+        ids = best if candidates is None else candidates[best]
+        return [(float(scores[b]), self.documents[i]) for b, i in zip(best, ids)]
+
+    def as_retriever(self, embeddings, k=4):
+        return LocalRetriever(index=self, embeddings=embeddings, k=k)
+
+
+class LocalRetriever(BaseRetriever):
+    """
+    LangChain retriever over a LocalVectorIndex; drop-in for a vector store's as_retriever().
+    """
+    index: Any
+    embeddings: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [
+            Document(page_content=doc["page_content"], metadata=dict(doc["metadata"], score=score))
+            for score, doc in self.index.search(self.embeddings.embed_query(query), self.k)
+        ]
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Offline embedding stand-in: words and word pairs hashed into `dim` signed buckets.
+    No model and no network, so only useful with an index embedded the same way
+    (see export --embeddings hashing).
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = text.lower().split()
+        for token in words + [a + " " + b for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        return normalize_rows(vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def export_pinecone(index_name, directory, api_key=None, text_key="text", embeddings=None, ivf_lists=None,
+                    batch=100):
+    """
+    Copies every vector and its document (metadata[text_key] as the text, the rest as
+    metadata) of a Pinecone index, all namespaces, into a LocalVectorIndex at directory.
+    With embeddings the documents are embedded again with it instead of copying the
+    stored vectors, e.g. with HashingEmbeddings for an index that works fully offline.
+    """
+    from pinecone import Pinecone
+
+    index = Pinecone(api_key=api_key or os.getenv("PINECONE_API_KEY")).Index(index_name)
+    vectors, documents = [], []
+    for namespace in index.describe_index_stats().namespaces or {"": None}:
+        for ids in index.list(namespace=namespace):
+            for i in range(0, len(ids), batch):
+                fetched = index.fetch(ids=ids[i:i + batch], namespace=namespace).vectors
+                for s_id in ids[i:i + batch]:
+                    metadata = dict(fetched[s_id].metadata or {})
+                    text = metadata.pop(text_key, "")
+                    metadata.update({"id": s_id, "namespace": namespace})
+                    vectors.append(fetched[s_id].values)
+                    documents.append({"page_content": text, "metadata": metadata})
+    label = f"pinecone:{index_name}"
+    if embeddings is not None:
+        vectors = embeddings.embed_documents([doc["page_content"] for doc in documents])
+        label = type(embeddings).__name__
+    return LocalVectorIndex.build(directory, vectors, documents, label, ivf_lists)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a Pinecone index into a local vector index")
+    parser.add_argument("index_name")
+    parser.add_argument("directory")
+    parser.add_argument("--embeddings", choices=["copy", "hashing"], default="copy",
+                        help="copy the stored vectors, or re-embed the texts with the offline stand-in")
+    parser.add_argument("--ivf-lists", type=int, help="also build an approximate index with this many lists")
+    parser.add_argument("--text-key", default="text")
+    args = parser.parse_args()
+    if not os.getenv("PINECONE_API_KEY"):
+        print("PINECONE_API_KEY is not set")
+        sys.exit(1)
+    exported = export_pinecone(
+        args.index_name, args.directory, text_key=args.text_key,
+        embeddings=HashingEmbeddings() if args.embeddings == "hashing" else None, ivf_lists=args.ivf_lists
+    )
+    print(f"Exported {exported.meta['count']} vectors of {args.index_name} to {args.directory}")
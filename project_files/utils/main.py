@@ -1,23 +1,45 @@
 # Developed by Joshua Balisch and Dylan Rouse
 # BMG 5109: Medical Systems Innovation and Design
 
-from optimizer import optimize_scan_scheduling
+from optimizer import optimize_scan_scheduling, stored_occupancy
+from insertion import insert_scans
 from visualizer import plot_schedule_by_day
 from utils import print_schedule, check_for_overlaps
 from excel_export import create_machine_agenda_excel
+from compact_schedule import CompactSchedule
+from config import scheduling_engine, rolling_window_mins, rolling_overlap_mins
+from config import use_warm_start_hints, fix_hints_first, model_builder
+from config import incremental_insertion, max_insertion_delay_mins, max_insertion_batch
+from config import anytime_solving, anytime_good_enough_gap, schedule_store_path
+from config import surge_batch_size, surge_engine, soft_assignment
 
-def do_optimization(scan_input):
+def do_optimization(scan_input, solver_overrides=None, stats=None, progress=None):
+    if stats is None:
+        stats = {}
    # scans_csv_file = 'scans.csv'
-    schedule_csv_file = 'current_schedule_multiple_machines.csv'
     print("old input")
     print(scan_input)
-    new_schedule = optimize_scan_scheduling(scan_input, schedule_csv_file)
+    optimizer_kwargs = dict(
+        engine=scheduling_engine,
+        window_mins=rolling_window_mins, overlap_mins=rolling_overlap_mins,
+        use_hints=use_warm_start_hints, fix_hints=fix_hints_first, builder=model_builder,
+        solver_overrides=solver_overrides, anytime=anytime_solving, good_enough_gap=anytime_good_enough_gap,
+        surge_batch_size=surge_batch_size, surge_engine=surge_engine, soft=soft_assignment, progress=progress
+    )
+    if incremental_insertion:
+        new_schedule = insert_scans(
+            scan_input, schedule_store_path, max_insertion_delay_mins, max_insertion_batch, stats, **optimizer_kwargs
+        )
+    else:
+        new_schedule = optimize_scan_scheduling(scan_input, schedule_store_path, stats=stats, **optimizer_kwargs)
     
     if new_schedule:
         print_schedule(new_schedule)
-        plot_schedule_by_day(new_schedule)
-        create_machine_agenda_excel(new_schedule)
-        check_for_overlaps(new_schedule)
+        # Parsed once for the plots and the agenda
+        compact = CompactSchedule.from_records(new_schedule)
+        plot_schedule_by_day(compact)
+        create_machine_agenda_excel(compact)
+        check_for_overlaps(new_schedule, stored_occupancy(schedule_store_path, stats.get("schedule_version")))
         return new_schedule
 
     else:
@@ -1,87 +1,61 @@
-from datetime import datetime, timedelta
+from occupancy import OccupancyIndex, to_time_str
 
-def bump_priority_zero(schedule):
-    """
-    For each machine, if a Priority 0 scan is scheduled, bump any subsequent appointment
-    that starts before its end. This ensures Priority 0 scans can take effect immediately
-    if possible, without interrupting an ongoing scan.
-    """
-    # Group by machine
-    machine_sched = {}
-    for appt in schedule:
-        m = appt["machine"]
-        machine_sched.setdefault(m, []).append(appt)
-
-    for m, appts in machine_sched.items():
-        # Sort chronologically
-        appts.sort(key=lambda a: datetime.strptime(a["start_time"], "%Y-%m-%d %H:%M"))
-        i = 0
-        while i < len(appts):
-            appt = appts[i]
-            if int(appt["priority"]) == 0:
-                p0_end = datetime.strptime(appt["end_time"], "%Y-%m-%d %H:%M")
-                j = i + 1
-                while j < len(appts):
-                    next_appt = appts[j]
-                    next_start = datetime.strptime(next_appt["start_time"], "%Y-%m-%d %H:%M")
-                    next_duration = timedelta(minutes=int(next_appt["duration"]))
-                    if next_start < p0_end:
-                        # Bump the next appointment to start after Priority 0 ends
-                        new_start = p0_end
-                        new_end = new_start + next_duration
-                        next_appt["start_time"] = new_start.strftime("%Y-%m-%d %H:%M")
-                        next_appt["end_time"] = new_end.strftime("%Y-%m-%d %H:%M")
-                        p0_end = new_end
-                        j += 1
-                    else:
-                        break
-                i = j
-            else:
-                i += 1
-        machine_sched[m] = appts
+# A maintenance block follows every MAINTENANCE_EVERY scans on a machine
+MAINTENANCE_EVERY = 20
+MAINTENANCE_MINS = 60
 
-    # Recombine
-    merged = []
-    for m in machine_sched:
-        merged.extend(machine_sched[m])
-    merged.sort(key=lambda x: (x["machine"], datetime.strptime(x["start_time"], "%Y-%m-%d %H:%M")))
-    return merged
 
-
-def insert_maintenance_blocks(schedule):
+def insert_maintenance_blocks(schedule, index=None, since=None, pinned=()):
     """
-    Inserts a 60-minute maintenance block after every 20 non-maintenance scans per machine.
-    Returns a new schedule with maintenance entries added.
+    Inserts a 60-minute maintenance block after every 20 non-maintenance scans per machine,
+    counting from the machine's last block, so blocks already in the schedule are kept and
+    a schedule that already has its blocks gets none. With since, only blocks starting at
+    or after that minute are added. A block starts at the end of the 20th scan, or later if
+    a booking that cannot move is there (a Priority 0 scan, another block or one of the
+    pinned scan_ids); bookings it overlaps otherwise are left to the repair.
+    Returns a new schedule with maintenance entries added (and added to index, if given).
     """
-    machine_schedules = {}
-    for entry in schedule:
-        m = entry["machine"]
-        machine_schedules.setdefault(m, []).append(entry)
+    if index is None:
+        index = OccupancyIndex.from_schedule(schedule)
+    by_id = {entry["scan_id"]: entry for entry in schedule}
+    pinned = set(pinned)
 
-    for m in machine_schedules:
-        machine_schedules[m].sort(key=lambda x: datetime.strptime(x["start_time"], "%Y-%m-%d %H:%M"))
+    def immovable(s_id):
+        entry = by_id[s_id]
+        return s_id in pinned or entry["scan_type"] == "maintenance" or int(entry["priority"]) == 0
 
-    final_schedule = []
-    for m, entries in machine_schedules.items():
+    for m in index.machines():
+        ids = list(index.ids[m])
         count = 0
-        for entry in entries:
-            if entry["scan_type"] != "maintenance":
-                count += 1
-            final_schedule.append(entry)
-            if count > 0 and count % 20 == 0:
-                maint_start = datetime.strptime(entry["end_time"], "%Y-%m-%d %H:%M")
-                maint_end = maint_start + timedelta(minutes=60)
-                maint_entry = {
-                    "scan_id": f"maintenance_{m}_{count}",
-                    "patient_id": "Maintenance",
-                    "scan_type": "maintenance",
-                    "machine": m,
-                    "start_time": maint_start.strftime("%Y-%m-%d %H:%M"),
-                    "end_time": maint_end.strftime("%Y-%m-%d %H:%M"),
-                    "priority": 0,
-                    "duration": 60
-                }
-                final_schedule.append(maint_entry)
-
-    final_schedule.sort(key=lambda x: (x["machine"], datetime.strptime(x["start_time"], "%Y-%m-%d %H:%M")))
-    return final_schedule
+        for i, s_id in enumerate(ids):
+            if by_id[s_id]["scan_type"] == "maintenance":
+                count = 0
+                continue
+            count += 1
+            followed = i + 1 < len(ids) and by_id[ids[i + 1]]["scan_type"] == "maintenance"
+            if count < MAINTENANCE_EVERY or followed:
+                continue
+            count = 0
+            maint_start = index.entries[s_id][2]
+            while True:
+                blocking = [o for o in index.overlaps(m, maint_start, maint_start + MAINTENANCE_MINS) if immovable(o)]
+                if not blocking:
+                    break
+                maint_start = max(index.entries[o][2] for o in blocking)
+            if since is not None and maint_start < since:
+                continue
+            maint_end = maint_start + MAINTENANCE_MINS
+            maint_entry = {
+                "scan_id": f"maintenance_{m}_{maint_start}",
+                "patient_id": "Maintenance",
+                "scan_type": "maintenance",
+                "machine": m,
+                "start_time": to_time_str(maint_start),
+                "end_time": to_time_str(maint_end),
+                "priority": 0,
+                "duration": MAINTENANCE_MINS
+            }
+            by_id[maint_entry["scan_id"]] = maint_entry
+            index.insert(maint_entry["scan_id"], m, maint_start, maint_end, first=True)
+
+    return [by_id[s_id] for s_id in index.ordered_ids()]
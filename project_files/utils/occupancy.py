@@ -0,0 +1,152 @@
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import numpy as np
+from compact_schedule import TIME_FORMAT, EPOCH, as_compact
+
+# Sorts before every seq in a (start, seq) key
+NO_SEQ = float("-inf")
+
+
+def to_minutes(time_str):
+    """
+    Integer minutes since EPOCH of a "%Y-%m-%d %H:%M" string.
+    """
+    return (datetime.strptime(time_str, TIME_FORMAT) - EPOCH) // timedelta(minutes=1)
+
+
+def to_time_str(minutes):
+    return (EPOCH + timedelta(minutes=int(minutes))).strftime(TIME_FORMAT)
+
+
+class OccupancyIndex:
+    """
+    Occupied intervals per machine in integer minutes, kept sorted by (start, seq) where
+    seq is the insertion order (so ties keep the order entries were added in). Entries
+    are keyed by scan_id. Lookups are binary searches; overlap and free-gap queries only
+    look at intervals starting within the machine's longest duration before the query,
+    so they stay O(log n + k) even when a schedule holds overlapping bookings.
+    """
+
+    def __init__(self):
+        self.keys = {}      # machine -> sorted [(start, seq), ...]
+        self.ends = {}      # machine -> end minute per position
+        self.ids = {}       # machine -> scan_id per position
+        self.entries = {}   # scan_id -> (machine, start, end, seq)
+        self.max_duration = {}
+        self.seq = 0
+        self.version = None
+
+    @classmethod
+    def from_schedule(cls, schedule):
+        """
+        Index of schedule entries (a CompactSchedule, or dicts with scan_id, machine,
+        start_time and end_time), built with one sort per machine. Entries with the same
+        start keep their order in schedule. Raises ValueError if a scan_id occurs twice,
+        since entries are keyed by it.
+        """
+        index = cls()
+        schedule = as_compact(schedule, ["scan_id"])
+        scan_ids = schedule.scan_ids.tolist()
+        if len(set(scan_ids)) != len(scan_ids):
+            seen = set()
+            duplicates = sorted(set(str(s) for s in scan_ids if s in seen or seen.add(s)))
+            raise ValueError(f"Duplicate scan_ids in schedule: {', '.join(duplicates[:10])}")
+        table = schedule.table
+        for code, m in enumerate(schedule.machines):
+            positions = np.flatnonzero(table["machine"] == code)
+            # seq follows the chronological order, so moves that keep it keep the positions
+            positions = positions[np.argsort(table["start"][positions], kind="stable")]
+            starts = table["start"][positions].tolist()
+            ends = table["end"][positions].tolist()
+            ids = schedule.scan_ids[positions].tolist()
+            seqs = range(index.seq + 1, index.seq + 1 + len(positions))
+            index.seq += len(positions)
+            index.keys[m] = list(zip(starts, seqs))
+            index.entries.update(zip(ids, zip([m] * len(ids), starts, ends, seqs)))
+            index.ends[m] = ends
+            index.ids[m] = ids
+            index.max_duration[m] = max(end - start for start, end in zip(starts, ends))
+        return index
+
+    def copy(self):
+        index = OccupancyIndex()
+        index.keys = {m: list(keys) for m, keys in self.keys.items()}
+        index.ends = {m: list(ends) for m, ends in self.ends.items()}
+        index.ids = {m: list(ids) for m, ids in self.ids.items()}
+        index.entries = dict(self.entries)
+        index.max_duration = dict(self.max_duration)
+        index.seq = self.seq
+        index.version = self.version
+        return index
+
+    def machines(self):
+        return sorted(m for m in self.ids if self.ids[m])
+
+    def __contains__(self, scan_id):
+        return scan_id in self.entries
+
+    def insert(self, scan_id, machine, start, end, seq=None, first=False):
+        """
+        Adds an interval; an entry with the same scan_id is replaced. It goes after the
+        entries with the same start, or before them with first.
+        """
+        if scan_id in self.entries:
+            self.delete(scan_id)
+        if seq is None:
+            self.seq += 1
+            seq = -self.seq if first else self.seq
+        keys = self.keys.setdefault(machine, [])
+        i = bisect_left(keys, (start, seq))
+        keys.insert(i, (start, seq))
+        self.ends.setdefault(machine, []).insert(i, end)
+        self.ids.setdefault(machine, []).insert(i, scan_id)
+        self.entries[scan_id] = (machine, start, end, seq)
+        self.max_duration[machine] = max(self.max_duration.get(machine, 0), end - start)
+
+    def delete(self, scan_id):
+        machine, start, _, seq = self.entries.pop(scan_id)
+        i = bisect_left(self.keys[machine], (start, seq))
+        del self.keys[machine][i], self.ends[machine][i], self.ids[machine][i]
+
+    def move(self, scan_id, start, end):
+        """
+        Moves an entry to a new interval on the same machine, keeping its tie order.
+        """
+        machine, _, _, seq = self.entries[scan_id]
+        self.delete(scan_id)
+        self.insert(scan_id, machine, start, end, seq)
+
+    def overlaps(self, machine, start, end):
+        """
+        scan_ids of the intervals on machine that intersect [start, end).
+        """
+        keys = self.keys.get(machine, [])
+        # seq is negative for entries inserted first, so bound the ties with -inf
+        lo = bisect_left(keys, (start - self.max_duration.get(machine, 0), NO_SEQ))
+        hi = bisect_left(keys, (end, NO_SEQ))
+        ends, ids = self.ends.get(machine, []), self.ids.get(machine, [])
+        return [ids[i] for i in range(lo, hi) if ends[i] > start]
+
+    def next_free_gap(self, machine, after, duration):
+        """
+        Earliest start >= after at which [start, start + duration) is free on machine.
+        """
+        t = after
+        while True:
+            conflicts = self.overlaps(machine, t, t + duration)
+            if not conflicts:
+                return t
+            t = max(self.entries[s_id][2] for s_id in conflicts)
+
+    def overlapping_neighbours(self, machine):
+        """
+        (earlier, later) scan_id pairs of consecutive intervals on machine that overlap.
+        """
+        keys, ends, ids = self.keys.get(machine, []), self.ends.get(machine, []), self.ids.get(machine, [])
+        return [(ids[i], ids[i + 1]) for i in range(len(keys) - 1) if keys[i + 1][0] < ends[i]]
+
+    def ordered_ids(self):
+        """
+        All scan_ids ordered by (machine, start).
+        """
+        return [s_id for m in self.machines() for s_id in self.ids[m]]
@@ -1,86 +1,306 @@
 import os
+import time
+import threading
+import multiprocessing
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from ortools.sat.python import cp_model
 from datetime import datetime, timedelta
-from maintenance import bump_priority_zero, insert_maintenance_blocks
-from config import machines
-from utils import minutes_to_datetime
+from maintenance import insert_maintenance_blocks
+from config import machines, solver_settings, priority_solver_settings, anytime_priorities
+from config import last_solution_size, store_write_attempts
+from schedule_store import TIME_FORMAT, apply_changes, schedule_version, load_schedule_frame
+from solve_cache import LRUCache, solve_key, cached_schedule, remember_schedule
+from occupancy import OccupancyIndex
+from compact_schedule import CompactSchedule, EPOCH, as_compact, minute_strings
 import io
+from bisect import bisect_left
+from itertools import accumulate
 
-def optimize_scan_scheduling(scans, schedule_csv_path):
-    model = cp_model.CpModel()
-    current_time = datetime.now()
-    #print((scans))
-    print("hello")
+# Latest allowed start, in minutes after check-in, per priority (P0 is bounded by the horizon)
+DEADLINE_MINS = {1: 1440, 2: 10080, 3: 43200, 4: 86400, 5: 345600}
+# Objective penalty per unplaced scan in soft mode, multiplied by (6 - priority)
+UNPLACED_PENALTY = 1000000
+
+# Entries placed by recent solves, by scan_id, reused as warm-start hints
+last_solution = LRUCache(last_solution_size)
+# Outcome of the background part of each anytime solve, keyed by the version it started from
+background_solves = {}
+
+# OccupancyIndex of the last schedule published to each store path (see stored_occupancy).
+# Cached indexes are never modified; merges work on a copy.
+published_occupancy = {}
+occupancy_lock = threading.Lock()
+
+
+def frame_records(df):
+    """
+    DataFrame rows as a list of dicts, like df.to_dict('records') but built from whole
+    columns, which is several times faster on long schedules.
+    """
+    columns = list(df.columns)
+    return [dict(zip(columns, values)) for values in zip(*(df[c].tolist() for c in columns))]
+
+
+def load_scan_requests(scans):
+    """
+    Parses the CSV string of new scan requests.
+    Returns the scans sorted by (priority, check_in_mins) and the reference datetime
+    that all minute offsets are measured from: midnight of the earliest check-in's day,
+    so an offset modulo 1440 is the minute of the day on the clock, as it is for the
+    minutes since EPOCH of the stored schedule (see earliest_start).
+    """
     scans_df = pd.read_csv(io.StringIO(scans))
-    #print(type(scans_df))
-    # --- Step 1: Load New Scan Requests ---
-  # scans_df = pd.read_csv(scans)
     scans_df = scans_df.dropna(subset=["check_in_date", "check_in_time"])
     scans_df["check_in_datetime"] = pd.to_datetime(
         scans_df["check_in_date"] + " " + scans_df["check_in_time"],
         format="%Y-%m-%d %H:%M"
     )
-    
-    # --- Step 2: Determine Reference and Offsets ---
-    reference_datetime = scans_df["check_in_datetime"].min()
+
+    reference_datetime = scans_df["check_in_datetime"].min().normalize()
     scans_df["check_in_mins"] = ((scans_df["check_in_datetime"] - reference_datetime)
                                   .dt.total_seconds() // 60).astype(int)
     scans_df["priority"] = scans_df["priority"].astype(int)
-    scans_data_all = scans_df.to_dict('records')
-    scans_data_all.sort(key=lambda s: (s["priority"], s["check_in_mins"]))
+    scans_df = scans_df.sort_values(["priority", "check_in_mins"], kind="stable")
+    scans_data_all = frame_records(scans_df)
+    return scans_data_all, reference_datetime
 
-    # --- Step 3: Load Existing Schedule ---
-    existing_schedule = []
-    locked_schedule = []
-    locked_ids = set()
-
-    if os.path.exists(schedule_csv_path):
-        existing_df = pd.read_csv(schedule_csv_path)
-        for _, row in existing_df.iterrows():
-            if row["scan_type"] == "maintenance":
+
+def load_existing_schedule(schedule_csv_path, current_time, since=None):
+    """
+    Loads the stored schedule and splits off the entries starting within the next 48
+    hours, which are locked in place. With since (a datetime) only the entries still
+    running at or after it, and those the maintenance count needs, are read by a window
+    query on the store (see schedule_store.load_schedule_frame), so the history before a
+    batch is neither loaded nor written back. The rows are parsed
+    once into a CompactSchedule, so long schedule histories load without per-row passes.
+    Returns the entries (dicts), the locked entries (a CompactSchedule), the locked
+    scan_ids and the loaded schedule as a CompactSchedule.
+    """
+    existing_df = load_schedule_frame(schedule_csv_path, None if since is None else since.strftime(TIME_FORMAT))
+    if existing_df is None:
+        empty = as_compact([])
+        return [], empty, set(), empty
+    existing = CompactSchedule.from_frame(existing_df)
+    lock_until = (current_time + timedelta(hours=48) - EPOCH) / timedelta(minutes=1)
+    locked_mask = existing.table["start"] < lock_until
+
+    existing_schedule = frame_records(existing_df)
+    locked_ids = set(existing_df["scan_id"][locked_mask])
+    return existing_schedule, existing.select(locked_mask), locked_ids, existing
+
+
+def standby_machine_for(scan_type):
+    """
+    Returns the standby machine of a modality (the last one listed), or None if it has only one.
+    """
+    machine_list = machines[scan_type]
+    return machine_list[-1] if len(machine_list) > 1 else None
+
+
+def eligible_machines(scan_type, priority):
+    """
+    Machines a scan may be booked on: the standby machine is reserved for Priority 1.
+    """
+    standby = standby_machine_for(scan_type)
+    return [m for m in machines[scan_type] if m != standby or priority == 1]
+
+
+def planning_horizon(new_scans_data):
+    return (max([s["check_in_mins"] for s in new_scans_data]) if new_scans_data else 0) + 1440
+
+
+def earliest_start(check_in_mins, priority):
+    """
+    Lowest start the model allows for a scan. P4/P5 starts are held to minutes 240-1199 of
+    the day (the only value the Step 6 peak indicator can take). check_in_mins counts from
+    a midnight: the batch reference (see load_scan_requests) or EPOCH, so the solver,
+    insertion and the repair all apply the window to the time on the clock.
+    """
+    if priority not in [4, 5]:
+        return check_in_mins
+    minute_of_day = check_in_mins % 1440
+    if minute_of_day < 240:
+        return check_in_mins + (240 - minute_of_day)
+    if minute_of_day > 1199:
+        return check_in_mins + (1440 - minute_of_day) + 240
+    return check_in_mins
+
+
+def locked_intervals_from_schedule(locked_schedule, reference_datetime, after=None):
+    """
+    Converts locked schedule rows (a CompactSchedule or entry dicts) to
+    (machine, start_mins, duration, scan_id) tuples relative to the reference datetime;
+    the minute offsets are computed as one array.
+    With after, intervals ending at or before that minute are dropped: no new scan starts
+    before its check-in, so past bookings cannot conflict and would only bloat the model.
+    """
+    locked = as_compact(locked_schedule)
+    if not len(locked):
+        return []
+    reference = (reference_datetime - EPOCH) // timedelta(minutes=1)
+    locked_start = locked.table["start"] - reference
+    duration = locked.table["duration"].astype(int)
+    machine_names, scan_ids = locked.machine_names(), locked.scan_ids
+    if after is not None:
+        keep = locked_start + duration > after
+        machine_names, scan_ids = machine_names[keep], scan_ids[keep]
+        locked_start, duration = locked_start[keep], duration[keep]
+    return list(zip(machine_names.tolist(), locked_start.tolist(), duration.tolist(), scan_ids.tolist()))
+
+
+def latest_end(s, horizon):
+    """
+    Latest minute a scan can end: its deadline (P0: the horizon) plus its duration.
+    """
+    priority = int(s["priority"])
+    if priority == 0:
+        return max(s["check_in_mins"], horizon) + int(s["duration"])
+    return s["check_in_mins"] + DEADLINE_MINS.get(priority, horizon) + int(s["duration"])
+
+
+def latest_starts(new_scans_data, reference_datetime):
+    """
+    {scan_id: latest start in minutes since EPOCH} of the new scans with a deadline (all
+    but P0), for the Priority 0 repair of the merge step.
+    """
+    reference = (reference_datetime - EPOCH) // timedelta(minutes=1)
+    return {
+        s["scan_id"]: reference + s["check_in_mins"] + DEADLINE_MINS[int(s["priority"])]
+        for s in new_scans_data if int(s["priority"]) in DEADLINE_MINS
+    }
+
+
+def locked_minutes(locked_intervals, machine_set, release):
+    """
+    Returns busy(d): the minutes of [release, d) the locked intervals occupy on the
+    machines in machine_set, answered from prefix sums in O(log n).
+    """
+    blocks = []
+    for m in machine_set:
+        merged = []
+        for start, end in sorted((max(st, release), st + dur) for mm, st, dur, _ in locked_intervals if mm == m):
+            if start >= end:
                 continue
-            existing_schedule.append(row)
-            start_dt = datetime.strptime(row["start_time"], "%Y-%m-%d %H:%M")
-            if start_dt < (current_time + timedelta(hours=48)):
-                locked_schedule.append(row)
-                locked_ids.add(row["scan_id"])
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        blocks += merged
+    starts = sorted(b[0] for b in blocks)
+    ends = sorted(b[1] for b in blocks)
+    start_sums = [0] + list(accumulate(starts))
+    end_sums = [0] + list(accumulate(ends))
 
-    # --- Step 4: Filter for New Scans ---
-    new_scans_data = [s for s in scans_data_all if s["scan_id"] not in locked_ids]
+    def busy(d):
+        # Every block started before d contributes d - start, minus d - end once it has ended
+        i, j = bisect_left(starts, d), bisect_left(ends, d)
+        return (i * d - start_sums[i]) - (j * d - end_sums[j])
+    return busy
 
+
+def capacity_check(new_scans_data, locked_intervals, horizon):
+    """
+    Fast necessary conditions for the hard model, checked before any model is built:
+    every patient has at most one new scan (Step 7), and for every set of machines the
+    scans restricted to it fit, deadline by deadline, into the free machine minutes
+    between their earliest check-in and that deadline. P4/P5 time-of-day windows are
+    ignored, so passing does not prove feasibility, but failing proves infeasibility.
+    Returns a list of problems; empty if none was found.
+    """
+    problems = []
+    scans_by_patient = {}
     for s in new_scans_data:
-        s["priority"] = int(s["priority"])
+        scans_by_patient.setdefault(s["patient_id"], []).append(s["scan_id"])
+    for p_id, scan_ids in scans_by_patient.items():
+        if len(scan_ids) > 1:
+            problems.append({"reason": "patient", "patient_id": p_id, "scan_ids": scan_ids})
 
-    standby_machines = {}
-    for scan_type, machine_list in machines.items():
-        if len(machine_list) > 1:
-            standby_machines[scan_type] = machine_list[-1]
+    by_machines = {}
+    for s in new_scans_data:
+        by_machines.setdefault(tuple(eligible_machines(s["scan_type"], int(s["priority"]))), []).append(s)
+    for machine_set in by_machines:
+        # Scans whose eligible machines all lie in machine_set compete for its capacity
+        scans = [s for key, group in by_machines.items() if set(key) <= set(machine_set) for s in group]
+        release = min(s["check_in_mins"] for s in scans)
+        busy = locked_minutes(locked_intervals, machine_set, release)
+        demand = 0
+        for count, s in enumerate(sorted(scans, key=lambda s: latest_end(s, horizon)), 1):
+            demand += int(s["duration"])
+            deadline = latest_end(s, horizon)
+            capacity = len(machine_set) * (deadline - release) - busy(deadline)
+            if demand > capacity:
+                problems.append({
+                    "reason": "capacity", "machines": list(machine_set), "deadline_mins": deadline,
+                    "demand_mins": demand, "capacity_mins": capacity, "scans": count,
+                })
+                break
+    return problems
 
-    # --- Step 5: Define Planning Horizon ---
-    horizon = (max([s["check_in_mins"] for s in new_scans_data]) if new_scans_data else 0) + 1440
+
+def add_patient_and_overlap_constraints(model, new_scans_data, assignment, intervals, locked_intervals):
+    """
+    Steps 7-8, shared by both model builders.
+    """
+    # --- Step 7: Ensure One Scan per Patient ---
+    patient_to_assignments = {}
+    for s in new_scans_data:
+        p_id, s_id = s["patient_id"], s["scan_id"]
+        patient_to_assignments.setdefault(p_id, [])
+        for m in assignment[s_id]:
+            patient_to_assignments[p_id].append(assignment[s_id][m])
+    for p_id, assigns in patient_to_assignments.items():
+        model.Add(sum(assigns) <= 1)
+
+    # --- Step 8: No-Overlap Constraints ---
+    locked_intervals_by_machine = {m: [] for m in sum(machines.values(), [])}
+    for m, locked_start, dur, locked_id in locked_intervals:
+        iv = model.NewIntervalVar(locked_start, dur, locked_start + dur, f"locked_{locked_id}_{m}")
+        locked_intervals_by_machine[m].append(iv)
+
+    for cat, m_list in machines.items():
+        for m in m_list:
+            machine_intervals = []
+            for s in new_scans_data:
+                s_id = s["scan_id"]
+                if m in intervals.get(s_id, {}):
+                    machine_intervals.append(intervals[s_id][m])
+            machine_intervals += locked_intervals_by_machine.get(m, [])
+            if machine_intervals:
+                model.AddNoOverlap(machine_intervals)
+
+
+def build_model(new_scans_data, locked_intervals, horizon, builder="classic", soft=False):
+    """
+    Builds the CP-SAT model for the given scans around the locked intervals.
+    builder="lean" selects build_lean_model, which states the same rules more compactly.
+    With soft a scan may stay unassigned at a penalty of UNPLACED_PENALTY * (6 - priority),
+    so an overloaded batch still yields a partial schedule instead of being infeasible.
+    Returns (model, assignment, start_vars).
+    """
+    if builder == "lean":
+        return build_lean_model(new_scans_data, locked_intervals, horizon, soft)
+    if builder != "classic":
+        raise ValueError(f"Unknown model builder: {builder}")
+    model = cp_model.CpModel()
 
     # --- Step 6: Create Decision Variables ---
-    assignment, start_vars, intervals, aux = {}, {}, {}, {}
+    assignment, start_vars, intervals, aux, peak_indicators = {}, {}, {}, {}, {}
     for s in new_scans_data:
         s_id = s["scan_id"]
-        p_id = s["patient_id"]
         priority = int(s["priority"])
         duration = int(s["duration"])
-        check_in = s["check_in_datetime"]
         check_in_mins = s["check_in_mins"]
 
         assignment[s_id], start_vars[s_id], intervals[s_id] = {}, {}, {}
         if priority == 0:
             aux[s_id] = {}
+        if priority in [4, 5]:
+            peak_indicators[s_id] = {}
 
-        deadline_map = {1: 1440, 2: 10080, 3: 43200, 4: 86400, 5: 345600}
-        deadline = deadline_map.get(priority, horizon)
-
-        for m in machines[s["scan_type"]]:
-            if m in standby_machines.get(s["scan_type"], []) and priority != 1:
-                continue
+        deadline = DEADLINE_MINS.get(priority, horizon)
 
+        for m in eligible_machines(s["scan_type"], priority):
             st = model.NewIntVar(check_in_mins, check_in_mins + deadline, f"start_{s_id}_{m}")
             assignment[s_id][m] = model.NewBoolVar(f"assign_{s_id}_{m}")
             start_vars[s_id][m] = st
@@ -99,8 +319,7 @@ def optimize_scan_scheduling(scans, schedule_csv_path):
                 model.Add(minute_of_day < 240).OnlyEnforceIf(peak_indicator.Not())
                 model.Add(minute_of_day > 1199).OnlyEnforceIf(peak_indicator.Not())
 
-                s["peak_indicators"] = s.get("peak_indicators", {})
-                s["peak_indicators"][m] = peak_indicator
+                peak_indicators[s_id][m] = peak_indicator
 
             intervals[s_id][m] = model.NewOptionalIntervalVar(
                 st, duration, st + duration, assignment[s_id][m], f"interval_{s_id}_{m}"
@@ -113,44 +332,17 @@ def optimize_scan_scheduling(scans, schedule_csv_path):
                 model.Add(aux[s_id][m] <= M * assignment[s_id][m])
                 model.Add(aux[s_id][m] >= st - M * (1 - assignment[s_id][m]))
 
-        if assignment[s_id]:
+        if assignment[s_id] and soft:
+            model.Add(sum(assignment[s_id][m] for m in assignment[s_id]) <= 1)
+        elif assignment[s_id]:
             model.Add(sum(assignment[s_id][m] for m in assignment[s_id]) == 1)
 
-    # --- Step 7: Ensure One Scan per Patient ---
-    patient_to_assignments = {}
-    for s in new_scans_data:
-        p_id, s_id = s["patient_id"], s["scan_id"]
-        patient_to_assignments.setdefault(p_id, [])
-        for m in assignment[s_id]:
-            patient_to_assignments[p_id].append(assignment[s_id][m])
-    for p_id, assigns in patient_to_assignments.items():
-        model.Add(sum(assigns) <= 1)
-
-    # --- Step 8: No-Overlap Constraints ---
-    locked_intervals_by_machine = {m: [] for m in sum(machines.values(), [])}
-    for ls in locked_schedule:
-        locked_start_dt = datetime.strptime(ls["start_time"], "%Y-%m-%d %H:%M")
-        locked_start = int((locked_start_dt - reference_datetime).total_seconds() // 60)
-        dur = int(ls["duration"])
-        iv = model.NewIntervalVar(locked_start, dur, locked_start + dur, f"locked_{ls['scan_id']}_{ls['machine']}")
-        locked_intervals_by_machine[ls["machine"]].append(iv)
-
-    for cat, m_list in machines.items():
-        for m in m_list:
-            machine_intervals = []
-            for s in new_scans_data:
-                s_id = s["scan_id"]
-                if m in intervals.get(s_id, {}):
-                    machine_intervals.append(intervals[s_id][m])
-            machine_intervals += locked_intervals_by_machine.get(m, [])
-            if machine_intervals:
-                model.AddNoOverlap(machine_intervals)
+    add_patient_and_overlap_constraints(model, new_scans_data, assignment, intervals, locked_intervals)
 
     # --- Step 9: Objective Function ---
     objective_terms = []
     for s in new_scans_data:
         s_id = s["scan_id"]
-        check_in_bias = s["check_in_mins"]
         for m in assignment[s_id]:
             st = start_vars[s_id][m]
             if s["priority"] == 0:
@@ -159,40 +351,708 @@ def optimize_scan_scheduling(scans, schedule_csv_path):
                 weight = (6 - int(s["priority"])) * 10000
                 term = weight * assignment[s_id][m] - st
                 if int(s["priority"]) in [4, 5]:
-                    peak_indicator = s["peak_indicators"][m]
-                    term -= 100000 * peak_indicator
+                    peak_indicator = peak_indicators[s_id][m]
+                    term = cp_model.LinearExpr.WeightedSum(
+                        [assignment[s_id][m], st, peak_indicator], [weight, -1, -100000]
+                    )
                 objective_terms.append(term)
-    model.Maximize(sum(objective_terms))
+        if soft:
+            penalty = UNPLACED_PENALTY * (6 - int(s["priority"]))
+            objective_terms.append(cp_model.LinearExpr.WeightedSum(
+                list(assignment[s_id].values()), [penalty] * len(assignment[s_id])
+            ))
+            objective_terms.append(-penalty)
+    # LinearExpr.Sum rather than `-=`/sum(): mixing these expression types with the
+    # arithmetic operators raises a TypeError on the pinned OR-Tools (9.12)
+    model.Maximize(cp_model.LinearExpr.Sum(objective_terms))
+
+    return model, assignment, start_vars
+
+
+def start_domain(check_in_mins, priority, horizon):
+    """
+    Allowed start minutes of a scan as a Domain. For P4/P5 these are the minutes 240-1199
+    of every day between check-in and deadline, which is exactly what the classic
+    builder's modulo/peak constraints allow. P0 starts are capped by the horizon, as the
+    classic builder's aux variable does.
+    """
+    if priority == 0:
+        return cp_model.Domain(check_in_mins, max(check_in_mins, horizon))
+    latest_start = check_in_mins + DEADLINE_MINS.get(priority, horizon)
+    if priority not in [4, 5]:
+        return cp_model.Domain(check_in_mins, latest_start)
+    windows = []
+    day = (check_in_mins // 1440) * 1440
+    while day + 240 <= latest_start:
+        lower, upper = max(day + 240, check_in_mins), min(day + 1199, latest_start)
+        if lower <= upper:
+            windows.append([lower, upper])
+        day += 1440
+    return cp_model.Domain.FromIntervals(windows)
+
+
+def build_lean_model(new_scans_data, locked_intervals, horizon, soft=False):
+    """
+    Same scheduling rules as the classic builder with far fewer variables: one start
+    variable per scan shared by its optional intervals on every eligible machine, the
+    P4/P5 start-of-day rule as a precomputed domain instead of a modulo variable plus
+    reified constraints, and the P0 start term read straight off the shared start
+    variable instead of big-M aux variables. The objective carries the constant terms
+    the classic model contributes through its unassigned machines and peak indicators,
+    so both builders report the same objective value. soft: see build_model.
+    Returns (model, assignment, start_vars), where start_vars[s_id][m] is the shared variable.
+    """
+    model = cp_model.CpModel()
+
+    assignment, start_vars, intervals = {}, {}, {}
+    objective_terms = []
+    objective_offset = 0
+    for s in new_scans_data:
+        s_id = s["scan_id"]
+        priority = int(s["priority"])
+        duration = int(s["duration"])
+        machine_list = eligible_machines(s["scan_type"], priority)
+
+        assignment[s_id], start_vars[s_id], intervals[s_id] = {}, {}, {}
+        if not machine_list:
+            continue
+        st = model.NewIntVarFromDomain(start_domain(s["check_in_mins"], priority, horizon), f"start_{s_id}")
+        for m in machine_list:
+            assignment[s_id][m] = model.NewBoolVar(f"assign_{s_id}_{m}")
+            start_vars[s_id][m] = st
+            intervals[s_id][m] = model.NewOptionalIntervalVar(
+                st, duration, st + duration, assignment[s_id][m], f"interval_{s_id}_{m}"
+            )
+        # Exactly one machine is assigned, so the reward is a constant and only -start varies
+        if soft and priority == 0:
+            # An unplaced P0 scan adds nothing, as with the classic builder's aux variables
+            placed = model.NewBoolVar(f"placed_{s_id}")
+            model.Add(sum(assignment[s_id].values()) == placed)
+            placed_start = model.NewIntVar(min(0, s["check_in_mins"]), max(s["check_in_mins"], horizon),
+                                           f"placed_start_{s_id}")
+            model.Add(placed_start == st).OnlyEnforceIf(placed)
+            model.Add(placed_start == 0).OnlyEnforceIf(placed.Not())
+            objective_terms.append(-placed_start)
+        else:
+            objective_terms.append(-st)
+        reward = 100000 if priority == 0 else (6 - priority) * 10000
+        if soft:
+            # The reward and penalty only apply if the scan is placed at all
+            penalty = UNPLACED_PENALTY * (6 - priority)
+            model.AddAtMostOne(assignment[s_id].values())
+            objective_terms.append(cp_model.LinearExpr.WeightedSum(
+                list(assignment[s_id].values()), [reward + penalty] * len(machine_list)
+            ))
+            objective_offset -= penalty
+        else:
+            model.AddExactlyOne(assignment[s_id].values())
+            objective_offset += reward
+        if priority != 0:
+            lower_bound = earliest_start(s["check_in_mins"], priority)
+            objective_offset -= (len(machine_list) - 1) * lower_bound
+            if priority in [4, 5]:
+                objective_offset -= 100000 * len(machine_list)
+
+    add_patient_and_overlap_constraints(model, new_scans_data, assignment, intervals, locked_intervals)
+
+    objective_terms.append(objective_offset)
+    model.Maximize(cp_model.LinearExpr.Sum(objective_terms))
+    return model, assignment, start_vars
+
+
+def model_size(model):
+    """
+    Variable and constraint counts of a built model.
+    """
+    proto = model.Proto()
+    return {"variables": len(proto.variables), "constraints": len(proto.constraints)}
+
+
+class SolutionTimer(cp_model.CpSolverSolutionCallback):
+    """
+    Records how long the solver took to find its first feasible solution. With progress,
+    every incumbent is also reported as progress({"objective", "best_bound", "solver_time",
+    "solutions"}).
+    """
+
+    def __init__(self, progress=None):
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.first_solution_time = None
+        self.solution_count = 0
+        self.progress = progress
+
+    def on_solution_callback(self):
+        if self.first_solution_time is None:
+            self.first_solution_time = self.WallTime()
+        self.solution_count += 1
+        if self.progress is not None:
+            self.progress({
+                "objective": self.ObjectiveValue(),
+                "best_bound": self.BestObjectiveBound(),
+                "solver_time": self.WallTime(),
+                "solutions": self.solution_count,
+            })
+
+
+def hint_model(model, assignment, start_vars, hints):
+    """
+    Passes the hinted (machine, start_mins) of each scan to the solver. Hints outside a
+    scan's eligible machines or start domain are skipped. Returns the number of hinted scans.
+    """
+    hinted = 0
+    for s_id, (hint_machine, hint_start) in hints.items():
+        if hint_machine not in assignment.get(s_id, {}):
+            continue
+        domain = start_vars[s_id][hint_machine].Proto().domain
+        if not any(domain[i] <= hint_start <= domain[i + 1] for i in range(0, len(domain), 2)):
+            continue
+        for m in assignment[s_id]:
+            model.AddHint(assignment[s_id][m], m == hint_machine)
+        model.AddHint(start_vars[s_id][hint_machine], hint_start)
+        hinted += 1
+    return hinted
+
+
+def resolve_solver_settings(new_scans_data, overrides=None):
+    """
+    CP-SAT settings for a batch: the deployment defaults from config.solver_settings,
+    tightened by priority_solver_settings for the most urgent priority in the batch,
+    then any per-request overrides (None values are ignored).
+    """
+    settings = dict(solver_settings)
+    if new_scans_data:
+        most_urgent = min(int(s["priority"]) for s in new_scans_data)
+        settings.update(priority_solver_settings.get(most_urgent, {}))
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def apply_solver_settings(solver, settings, log_lines=None):
+    """
+    Copies the settings onto the solver's parameters. With log_search_progress the
+    search log is captured into log_lines instead of being printed.
+    """
+    for key, value in settings.items():
+        if key == "log_search_progress":
+            continue
+        setattr(solver.parameters, key, value)
+    if settings.get("log_search_progress") and log_lines is not None:
+        solver.parameters.log_search_progress = True
+        solver.parameters.log_to_stdout = False
+        solver.log_callback = log_lines.append
+
+
+def solver_statistics(solver, status):
+    """
+    Status and search statistics of a finished solve.
+    """
+    statistics = {
+        "status": solver.StatusName(status),
+        "wall_time": solver.WallTime(),
+        "num_conflicts": solver.NumConflicts(),
+        "num_branches": solver.NumBranches(),
+    }
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        statistics["objective"] = solver.ObjectiveValue()
+        statistics["best_bound"] = solver.BestObjectiveBound()
+    return statistics
+
+
+def solve_placements(new_scans_data, locked_intervals, horizon, hints=None, fix_hints=False,
+                     stats=None, settings=None, builder="classic", soft=False, progress=None):
+    """
+    Builds and solves the model. Returns {scan_id: (machine, start_mins)} for every assigned
+    scan, or None if no feasible schedule exists. progress receives every incumbent (see SolutionTimer).
+    settings are CP-SAT parameters (see resolve_solver_settings); by default they are
+    resolved from config for this batch.
+    hints maps scan_id to a previous (machine, start_mins) used as a solution hint. With
+    fix_hints the hinted scans are first pinned to their hints for a fast solve, whose
+    solution then seeds the full solve. With soft, scans may be left out (see build_model).
+    """
+    build_start = time.perf_counter()
+    model, assignment, start_vars = build_model(new_scans_data, locked_intervals, horizon, builder, soft)
+    hinted = hint_model(model, assignment, start_vars, hints) if hints else 0
+    if stats is not None:
+        stats["model_size"] = model_size(model)
+        stats["build_time"] = time.perf_counter() - build_start
 
     # --- Step 10: Solve Model ---
+    if settings is None:
+        settings = resolve_solver_settings(new_scans_data)
+    log_lines = []
     solver = cp_model.CpSolver()
-    status = solver.Solve(model)
+    apply_solver_settings(solver, settings, log_lines)
+    if hinted and fix_hints:
+        fixed_solver = cp_model.CpSolver()
+        apply_solver_settings(fixed_solver, settings)
+        fixed_solver.parameters.fix_variables_to_their_hinted_value = True
+        fixed_status = fixed_solver.Solve(model)
+        if stats is not None:
+            stats["fixed_hint_status"] = fixed_solver.StatusName(fixed_status)
+            stats["fixed_hint_time"] = fixed_solver.WallTime()
+        if fixed_status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            # Relax: re-hint every scan with the pinned solve's assignment
+            model.ClearHints()
+            for s_id in assignment:
+                for m in assignment[s_id]:
+                    model.AddHint(assignment[s_id][m], fixed_solver.Value(assignment[s_id][m]))
+                    if fixed_solver.Value(assignment[s_id][m]):
+                        model.AddHint(start_vars[s_id][m], fixed_solver.Value(start_vars[s_id][m]))
+
+    timer = SolutionTimer(progress)
+    status = solver.Solve(model, timer)
+    if stats is not None:
+        stats.update(solver_statistics(solver, status))
+        stats["hinted_scans"] = hinted
+        stats["time_to_first_feasible"] = timer.first_solution_time
+        stats["settings"] = settings
+        if log_lines:
+            stats["log"] = log_lines
     if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
         return None
 
     # --- Step 11: Extract Solution ---
+    return read_placements(solver.Value, assignment, start_vars)
+
+
+def read_placements(value, assignment, start_vars):
+    """
+    Reads {scan_id: (machine, start_mins)} from a solver or solution callback's Value.
+    """
+    placements = {}
+    for s_id in assignment:
+        for m in assignment[s_id]:
+            if value(assignment[s_id][m]):
+                placements[s_id] = (m, value(start_vars[s_id][m]))
+    return placements
+
+
+class AnytimeCallback(SolutionTimer):
+    """
+    Captures the first solution (or the first within good_enough_gap of the bound)
+    and signals `ready` so the caller can return it while the search carries on.
+    """
+
+    def __init__(self, assignment, start_vars, good_enough_gap=None, progress=None):
+        SolutionTimer.__init__(self, progress)
+        self.assignment = assignment
+        self.start_vars = start_vars
+        self.good_enough_gap = good_enough_gap
+        self.first_placements = None
+        self.ready = threading.Event()
+
+    def on_solution_callback(self):
+        SolutionTimer.on_solution_callback(self)
+        if self.ready.is_set():
+            return
+        if self.good_enough_gap is not None:
+            objective = self.ObjectiveValue()
+            gap = abs(self.BestObjectiveBound() - objective) / max(1.0, abs(objective))
+            if gap > self.good_enough_gap:
+                return
+        self.first_placements = read_placements(self.Value, self.assignment, self.start_vars)
+        self.ready.set()
+
+
+def solve_anytime(new_scans_data, locked_intervals, horizon, on_final, hints=None, good_enough_gap=None,
+                  stats=None, settings=None, builder="classic", soft=False, progress=None):
+    """
+    Starts the solve in a background thread and returns as soon as a first (or good
+    enough) solution exists. When the search finishes or times out, on_final is called
+    from the background thread with (placements, statistics) of the final solution.
+    If no early solution was released, the caller gets the final placements instead and
+    on_final is not called. Returns None if no feasible schedule exists.
+    """
+    build_start = time.perf_counter()
+    model, assignment, start_vars = build_model(new_scans_data, locked_intervals, horizon, builder, soft)
+    hinted = hint_model(model, assignment, start_vars, hints) if hints else 0
+    build_time = time.perf_counter() - build_start
+    if settings is None:
+        settings = resolve_solver_settings(new_scans_data)
+    solver = cp_model.CpSolver()
+    apply_solver_settings(solver, settings)
+    callback = AnytimeCallback(assignment, start_vars, good_enough_gap, progress)
+    outcome = {}
+
+    def run():
+        status = solver.Solve(model, callback)
+        statistics = solver_statistics(solver, status)
+        final = None
+        if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            final = read_placements(solver.Value, assignment, start_vars)
+        if not callback.ready.is_set():
+            outcome["final"], outcome["statistics"] = final, statistics
+            callback.ready.set()
+            return
+        on_final(final, statistics)
+
+    threading.Thread(target=run, daemon=True).start()
+    callback.ready.wait()
+
+    if stats is not None:
+        stats["model_size"] = model_size(model)
+        stats["build_time"] = build_time
+        stats["hinted_scans"] = hinted
+        stats["time_to_first_feasible"] = callback.first_solution_time
+        stats["settings"] = settings
+    if "statistics" in outcome:
+        if stats is not None:
+            stats.update(outcome["statistics"])
+        return outcome["final"]
+    if stats is not None:
+        stats["status"] = "FEASIBLE"
+        stats["anytime"] = "improving in background"
+    return callback.first_placements
+
+
+def warm_start_metrics(new_scans_data, locked_intervals, horizon, hints, builder="classic", settings=None):
+    """
+    Solves the same model with and without hints and returns the time to first feasible
+    solution (in seconds) for both.
+    """
+    metrics = {}
+    for label, solve_hints in (("without_hints", None), ("with_hints", hints)):
+        run_stats = {}
+        solve_placements(
+            new_scans_data, locked_intervals, horizon, solve_hints,
+            stats=run_stats, settings=settings, builder=builder
+        )
+        metrics[label] = run_stats.get("time_to_first_feasible")
+        metrics[label + "_status"] = run_stats.get("status")
+    metrics["hinted_scans"] = run_stats.get("hinted_scans", 0)
+    return metrics
+
+
+def compare_builders(new_scans_data, locked_intervals, horizon, settings=None):
+    """
+    Builds and solves the same input with both model builders and reports model size,
+    solve time, status and objective for each.
+    """
+    report = {}
+    for builder in ("classic", "lean"):
+        run_stats = {}
+        start = datetime.now()
+        solve_placements(new_scans_data, locked_intervals, horizon, stats=run_stats, settings=settings, builder=builder)
+        report[builder] = {
+            "model_size": run_stats["model_size"],
+            "seconds": (datetime.now() - start).total_seconds(),
+            "status": run_stats["status"],
+            "objective": run_stats.get("objective"),
+        }
+    return report
+
+
+def schedule_hints(schedule_rows, reference_datetime):
+    """
+    Converts schedule entries (stored rows or a previous result) into
+    {scan_id: (machine, start_mins)} hints relative to the reference datetime.
+    """
+    return {
+        s_id: (m, st) for m, st, _, s_id in locked_intervals_from_schedule(schedule_rows, reference_datetime)
+    }
+
+
+def placements_to_schedule(new_scans_data, placements, reference_datetime):
+    """
+    Turns solver placements into schedule entries with formatted start and end times.
+    """
+    placed = [s for s in new_scans_data if s["scan_id"] in placements]
+    # Times are formatted as two arrays of minutes since EPOCH rather than entry by entry
+    reference = (reference_datetime - EPOCH) // timedelta(minutes=1)
+    starts = [reference + placements[s["scan_id"]][1] for s in placed]
+    start_times = minute_strings(starts)
+    end_times = minute_strings([st + int(s["duration"]) for st, s in zip(starts, placed)])
     new_schedule = []
+    for s, start_time, end_time in zip(placed, start_times, end_times):
+        new_schedule.append({
+            "scan_id": s["scan_id"],
+            "patient_id": s["patient_id"],
+            "scan_type": s["scan_type"],
+            "machine": placements[s["scan_id"]][0],
+            "start_time": start_time,
+            "end_time": end_time,
+            "priority": s["priority"],
+            "duration": s["duration"]
+        })
+    return new_schedule
+
+
+def schedule_objective(new_scans_data, placements, soft=False):
+    """
+    Evaluates the Step 9 objective for a set of placements, so that schedules produced by
+    different solve modes can be compared with the monolithic model's objective value.
+    Unassigned machines contribute their start variable's lower bound, as in the solver.
+    With soft, unplaced scans also cost their UNPLACED_PENALTY.
+    """
+    total = 0
     for s in new_scans_data:
         s_id = s["scan_id"]
-        for m in assignment[s_id]:
-            if solver.Value(assignment[s_id][m]):
-                st = solver.Value(start_vars[s_id][m])
-                new_schedule.append({
-                    "scan_id": s_id,
-                    "patient_id": s["patient_id"],
-                    "scan_type": s["scan_type"],
-                    "machine": m,
-                    "start_time": minutes_to_datetime(st, reference_datetime),
-                    "end_time": minutes_to_datetime(st + int(s["duration"]), reference_datetime),
-                    "priority": s["priority"],
-                    "duration": s["duration"]
-                })
+        priority = int(s["priority"])
+        machine_list = eligible_machines(s["scan_type"], priority)
+        assigned = placements.get(s_id)
+        if soft and not assigned:
+            total -= UNPLACED_PENALTY * (6 - priority)
+        if priority == 0:
+            if assigned:
+                total += 100000 - assigned[1]
+            continue
+        lower_bound = earliest_start(s["check_in_mins"], priority)
+        for m in machine_list:
+            if assigned and assigned[0] == m:
+                total += (6 - priority) * 10000 - assigned[1]
+            else:
+                total -= lower_bound
+            if priority in [4, 5]:
+                total -= 100000
+    return total
+
+
+def solve_rolling_horizon(new_scans_data, locked_intervals, horizon, window_mins=1440, overlap_mins=0,
+                          hints=None, stats=None, builder="classic", settings=None, soft=False, progress=None):
+    """
+    Solves the scans one time window at a time instead of in a single model.
+    Each window's model holds the scans checked in before the window end plus overlap_mins
+    of look-ahead, together with any scans pushed from earlier windows. Only placements
+    starting inside the window are committed; they become locked intervals for the
+    following windows and everything else is pushed to the next window. With soft, a scan
+    a window's model leaves unassigned is given up, as later windows only have less room.
+    Returns {scan_id: (machine, start_mins)}, or None if some window is infeasible.
+    """
+    pending = list(new_scans_data)
+    locked = list(locked_intervals)
+    placements = {}
+    unplaced = set()
+    windows_solved = 0
+    wall_time = 0.0
+    build_time = 0.0
+    window_start = 0
+
+    while pending:
+        earliest_pending = min(s["check_in_mins"] for s in pending)
+        if earliest_pending >= window_start + window_mins:
+            # Skip empty windows
+            window_start += ((earliest_pending - window_start) // window_mins) * window_mins
+        window_end = window_start + window_mins
+
+        released = [s for s in pending if s["check_in_mins"] < window_end + overlap_mins]
+        # Locked intervals that end before any released scan can start cannot conflict
+        window_locked = [iv for iv in locked if iv[1] + iv[2] > earliest_pending]
+
+        window_stats = {}
+        window_placements = solve_placements(
+            released, window_locked, horizon, hints, stats=window_stats, settings=settings, builder=builder,
+            soft=soft, progress=progress
+        )
+        windows_solved += 1
+        wall_time += window_stats["wall_time"]
+        build_time += window_stats["build_time"]
+        if window_placements is None:
+            if stats is not None:
+                stats["status"] = window_stats["status"]
+                stats["rolling"] = {
+                    "windows": windows_solved, "failed_window_start": window_start, "wall_time": wall_time
+                }
+            return None
 
+        for s in released:
+            s_id = s["scan_id"]
+            if s_id not in window_placements:
+                unplaced.add(s_id)
+                continue
+            m, st = window_placements[s_id]
+            if st < window_end:
+                placements[s_id] = (m, st)
+                locked.append((m, st, int(s["duration"]), s_id))
+
+        pending = [s for s in pending if s["scan_id"] not in placements and s["scan_id"] not in unplaced]
+        window_start = window_end
+
+    if stats is not None:
+        # Each window may be optimal, but the stitched schedule is only known to be feasible
+        stats["status"] = "FEASIBLE"
+        stats["build_time"] = build_time
+        stats["rolling"] = {
+            "windows": windows_solved,
+            "wall_time": wall_time,
+            "window_mins": window_mins,
+            "overlap_mins": overlap_mins,
+        }
+    return placements
+
+
+def modality_groups(new_scans_data):
+    """
+    Groups scan types that must be solved together. Modalities never share machines, so
+    the only coupling is the one-scan-per-patient rule: a patient with new scans in
+    several modalities puts those modalities in the same group.
+    Returns a list of sets of scan types.
+    """
+    parent = {}
+
+    def find(t):
+        while parent[t] != t:
+            parent[t] = parent[parent[t]]
+            t = parent[t]
+        return t
+
+    patient_types = {}
+    for s in new_scans_data:
+        parent.setdefault(s["scan_type"], s["scan_type"])
+        patient_types.setdefault(s["patient_id"], set()).add(s["scan_type"])
+
+    for scan_types in patient_types.values():
+        first, *rest = sorted(scan_types)
+        for t in rest:
+            parent[find(t)] = find(first)
+
+    groups = {}
+    for t in parent:
+        groups.setdefault(find(t), set()).add(t)
+    return list(groups.values())
+
+
+def solve_group(scans, locked, horizon, hints, settings, builder, soft=False):
+    """
+    Worker for solve_parallel: solves one group and returns (placements, stats).
+    """
+    group_stats = {}
+    placements = solve_placements(
+        scans, locked, horizon, hints, stats=group_stats, settings=settings, builder=builder, soft=soft
+    )
+    return placements, group_stats
+
+
+def solve_parallel(new_scans_data, locked_intervals, horizon, max_workers=None, hints=None, stats=None,
+                   builder="classic", settings=None, soft=False):
+    """
+    Solves each modality in its own process. Modalities coupled through a patient with
+    scans in both are re-grouped and solved as one model (see modality_groups), so the
+    combined placements satisfy every constraint of the monolithic model and the
+    objectives add up to the monolithic one.
+    Returns {scan_id: (machine, start_mins)}, or None if any group is infeasible.
+    """
+    groups = modality_groups(new_scans_data)
+    jobs = []
+    for scan_types in groups:
+        group_machines = set(m for t in scan_types for m in machines[t])
+        jobs.append((
+            [s for s in new_scans_data if s["scan_type"] in scan_types],
+            [iv for iv in locked_intervals if iv[0] in group_machines],
+            {s_id: h for s_id, h in (hints or {}).items() if h[0] in group_machines},
+        ))
+
+    cpu_count = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = min(len(jobs), cpu_count) or 1
+    if settings is None:
+        settings = resolve_solver_settings(new_scans_data)
+    # Share the cores between the processes instead of letting every CP-SAT use all of them
+    process_settings = dict(settings)
+    process_settings["num_search_workers"] = max(1, cpu_count // max_workers)
+
+    if len(jobs) <= 1:
+        outcomes = [
+            solve_group(scans, locked, horizon, group_hints, settings, builder, soft)
+            for scans, locked, group_hints in jobs
+        ]
+    else:
+        # Spawned, not forked: the server's threads may hold locks at fork time
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [
+                executor.submit(solve_group, scans, locked, horizon, group_hints, process_settings, builder, soft)
+                for scans, locked, group_hints in jobs
+            ]
+            outcomes = [f.result() for f in futures]
+    results = [result for result, _ in outcomes]
+
+    if stats is not None:
+        statuses = [group_stats["status"] for _, group_stats in outcomes]
+        stats["status"] = next(
+            (st for st in statuses if st not in ("OPTIMAL", "FEASIBLE")),
+            "OPTIMAL" if all(st == "OPTIMAL" for st in statuses) else "FEASIBLE"
+        )
+        stats["parallel"] = {
+            "groups": [sorted(t) for t in groups],
+            "processes": max_workers if len(jobs) > 1 else 0,
+            "group_stats": [
+                {k: group_stats.get(k) for k in ("status", "objective", "best_bound", "wall_time")}
+                for _, group_stats in outcomes
+            ],
+        }
+
+    placements = {}
+    for result in results:
+        if result is None:
+            return None
+        placements.update(result)
+    return placements
+
+
+def stored_occupancy(schedule_csv_path, version=None, existing_schedule=None):
+    """
+    OccupancyIndex of the schedule the store held at `version`: a copy of the index cached
+    when that schedule was published, brought in line with existing_schedule (the loaded
+    rows) by dropping the entries they lack. Without a cached
+    index for that version it is built from existing_schedule, or None is returned if
+    existing_schedule is not given.
+    """
+    with occupancy_lock:
+        cached = published_occupancy.get(os.path.abspath(schedule_csv_path))
+    if cached is not None and version is not None and cached.version == version:
+        if existing_schedule is None:
+            return cached.copy()
+        index = cached.copy()
+        row_ids = set(row["scan_id"] for row in existing_schedule)
+        for s_id in index.entries.keys() - row_ids:
+            index.delete(s_id)
+        if len(index.entries) == len(row_ids) == len(existing_schedule):
+            return index
+    if existing_schedule is None:
+        return None
+    return OccupancyIndex.from_schedule(existing_schedule)
+
+
+def merge_and_save(existing_schedule, new_schedule, schedule_csv_path, expected_version=None, stats=None,
+                   base_version=None, deadlines=None, locked_ids=(), stored_rows=None):
+    """
+    Merges the new entries into the existing schedule, adds the maintenance blocks due from
+    the earliest new entry on, repairs it around those blocks and the new Priority 0 scans
+    (see repair.CascadeRepair; deadlines as in latest_starts), and atomically writes
+    the changes to the schedule store. Stored blocks are kept and the locked_ids bookings
+    never move, so merging no new entries changes nothing.
+    Only the entries that differ from stored_rows (the rows the store holds for this part
+    of the schedule; by default existing_schedule as loaded) are written, and only stored_rows
+    missing from the result are deleted, so rows outside the loaded window are untouched.
+    base_version is the store version existing_schedule was loaded at; the occupancy
+    index cached for it is updated with the new entries instead of being rebuilt.
+    With expected_version nothing is written if the store has changed since that version,
+    and stats["store_conflict"] is set.
+    Returns the merged schedule, or None if it was not written; the new store version
+    and the merge and write times are recorded in stats.
+    """
+    merge_start = time.perf_counter()
+    if stored_rows is None:
+        stored_rows = existing_schedule
+    stored = {row["scan_id"]: dict(row) for row in stored_rows}
     # --- Step 12: Merge new scans with existing ones ---
+    index = stored_occupancy(schedule_csv_path, base_version, existing_schedule)
     existing_ids = set(row["scan_id"] for row in existing_schedule)
-    all_scans = existing_schedule + [s for s in new_schedule if s["scan_id"] not in existing_ids]
-    all_scans = bump_priority_zero(all_scans)
-    all_scans = insert_maintenance_blocks(all_scans)
+    added = [s for s in new_schedule if s["scan_id"] not in existing_ids]
+    compact_added = as_compact(added)
+    for s_id, machine, start, end in zip(compact_added.scan_ids.tolist(), compact_added.machine_names().tolist(),
+                                         compact_added.table["start"].tolist(), compact_added.table["end"].tolist()):
+        index.insert(s_id, machine, start, end)
+    # repair imports this module, so it is looked up at call time
+    from repair import repair_priority_zero
+    all_scans = existing_schedule + added
+    if added:
+        # Maintenance blocks go in first and stay fixed, so the repair moves what they overlap
+        since = int(compact_added.table["start"].min())
+        all_scans = insert_maintenance_blocks(all_scans, index, since, locked_ids)
+    new_ids = [entry["scan_id"] for entry in all_scans if entry["scan_id"] not in existing_ids]
+    all_scans = repair_priority_zero(all_scans, index, deadlines, stats, locked_ids, new_ids)
 
     # --- Step 13: Clean and Save Final Schedule ---
     cleaned_schedule = []
@@ -202,7 +1062,236 @@ def optimize_scan_scheduling(scans, schedule_csv_path):
             cleaned_entry[key] = str(value) if isinstance(value, dict) else value
         cleaned_schedule.append(cleaned_entry)
 
-    pd.DataFrame(cleaned_schedule).to_csv(schedule_csv_path, index=False)
-    print(type(cleaned_schedule))
-    print(cleaned_schedule)
+    write_start = time.perf_counter()
+    changed = [entry for entry in cleaned_schedule if stored.get(entry["scan_id"]) != entry]
+    removed = stored.keys() - set(entry["scan_id"] for entry in cleaned_schedule)
+    version = apply_changes(schedule_csv_path, changed, sorted(removed, key=str), expected_version)
+    if version is None:
+        if stats is not None:
+            stats["store_conflict"] = True
+        return None
+    index.version = version
+    with occupancy_lock:
+        published_occupancy[os.path.abspath(schedule_csv_path)] = index
+    if stats is not None:
+        stats["schedule_version"] = version
+        stats["merge_time"] = write_start - merge_start
+        stats["write_time"] = time.perf_counter() - write_start
     return cleaned_schedule
+
+
+def retry_on_conflict(attempt, stats=None):
+    """
+    Runs attempt(stats) until it does not end in a store conflict (stats["store_conflict"],
+    see merge_and_save), at most config.store_write_attempts times, each time with stats
+    cleared. The number of attempts is recorded in stats["attempts"].
+    Returns the result of the last attempt, or None if every attempt lost its write.
+    """
+    if stats is None:
+        stats = {}
+    for n in range(1, store_write_attempts + 1):
+        stats.clear()
+        result = attempt(stats)
+        stats["attempts"] = n
+        if not stats.get("store_conflict"):
+            return result
+        print("The stored schedule changed during the solve; solving again against the new version.")
+    print(f"Schedule not saved: the store kept changing over {store_write_attempts} attempts.")
+    return None
+
+
+def optimize_scan_scheduling(scans, schedule_csv_path, stats=None, **options):
+    """
+    Schedules the new scans around the stored schedule and saves the merged result.
+    The stored schedule is read, solved against and written at one store version; when
+    another writer got in first the whole pass is repeated against the new version (see
+    retry_on_conflict). options are those of schedule_once:
+    engine names one of engines.ENGINES: "cpsat" solves one model over the whole horizon;
+    "rolling" solves window by window (see solve_rolling_horizon), "parallel" solves the
+    modalities in separate processes (see solve_parallel), "greedy" books scans by list
+    scheduling without a model and "portfolio" races greedy against CP-SAT. Batches of
+    more than surge_batch_size new scans use surge_engine instead. With compare_monolithic the monolithic
+    model is also solved so the objective lost by the rolling horizon is recorded in stats.
+    With use_hints the stored schedule and the previous solve seed the solver (fix_hints:
+    see solve_placements). builder picks the classic or lean CP-SAT model (see build_model).
+    solver_overrides replace individual CP-SAT settings for this call (see
+    resolve_solver_settings); the settings used, the solver status and search
+    statistics are recorded in stats, and the seconds spent per stage (parse, prep,
+    build, solve, post, write, total) in stats["timings"].
+    With anytime=True (or "urgent" when the batch holds a priority listed in
+    config.anytime_priorities) the cpsat engine returns and stores its first feasible
+    (or good_enough_gap) schedule, then publishes the improved schedule from the
+    background unless the store has changed in the meantime (see solve_anytime).
+    With use_cache an identical request (same scans, machines, settings and engine
+    options) against the store version its solve published returns the cached schedule
+    without solving (see solve_cache); stats["cache"] records the hit or miss.
+    A capacity pre-check (see capacity_check) runs first; its problems are recorded in
+    stats["capacity_check"] and, unless soft is set, make engines that solve the hard
+    model return None at once instead of leaving CP-SAT to prove infeasibility. With soft, scans may be left
+    unplaced at a priority-weighted penalty (see build_model) and are listed in
+    stats["unplaced"] next to the partial schedule.
+    progress receives every incumbent of the CP-SAT engines (see SolutionTimer); the
+    parallel engine solves in other processes and reports none.
+    Returns the merged schedule from the first day of the batch on (the part that was
+    loaded and merged), or None if no solution was found or it could not be saved.
+    """
+    return retry_on_conflict(lambda attempt_stats: schedule_once(scans, schedule_csv_path, stats=attempt_stats,
+                                                                  **options), stats)
+
+
+def schedule_once(scans, schedule_csv_path, engine="cpsat", window_mins=1440,
+                  overlap_mins=0, compare_monolithic=False, use_hints=True,
+                  fix_hints=False, builder="classic", solver_overrides=None, anytime=False,
+                  good_enough_gap=None, surge_batch_size=None, surge_engine="greedy", use_cache=True,
+                  soft=False, stats=None, progress=None):
+    """
+    One read, solve and merge pass of optimize_scan_scheduling. Nothing is written if
+    the store moved on from the version it read (stats["store_conflict"] is set).
+    """
+    current_time = datetime.now()
+    stage_start = time.perf_counter()
+    timings = {}
+    print("hello")
+    # --- Step 1-2: Load New Scan Requests and Offsets ---
+    scans_data_all, reference_datetime = load_scan_requests(scans)
+
+    # --- Step 3: Load Existing Schedule ---
+    store_version = schedule_version(schedule_csv_path)
+    # Bookings that ended before the batch's first day do not constrain it
+    existing_schedule, locked_schedule, locked_ids, _ = load_existing_schedule(
+        schedule_csv_path, current_time, reference_datetime
+    )
+
+    timings["parse"] = time.perf_counter() - stage_start
+
+    # --- Step 4: Filter for New Scans ---
+    new_scans_data = [s for s in scans_data_all if s["scan_id"] not in locked_ids]
+
+    for s in new_scans_data:
+        s["priority"] = int(s["priority"])
+
+    # --- Step 5: Define Planning Horizon ---
+    horizon = planning_horizon(new_scans_data)
+    # Minute 0 is midnight before the earliest check-in of the batch
+    locked_intervals = locked_intervals_from_schedule(locked_schedule, reference_datetime, after=0)
+
+    hints = None
+    if use_hints:
+        new_ids = set(s["scan_id"] for s in new_scans_data)
+        hint_rows = [row for row in existing_schedule if row["scan_id"] in new_ids]
+        hint_rows += [row for row in (last_solution.get(s["scan_id"]) for s in new_scans_data) if row is not None]
+        hints = schedule_hints(hint_rows, reference_datetime)
+
+    settings = resolve_solver_settings(new_scans_data, solver_overrides)
+
+    if anytime == "urgent":
+        anytime = any(s["priority"] in anytime_priorities for s in new_scans_data)
+    first_published = threading.Event()
+    # Version and rows of the first schedule this pass published, the base of the improvement
+    first = {}
+
+    def publish_improvement(final_placements, statistics):
+        # Runs on the anytime solver thread once the search has finished
+        first_published.wait()
+        version = first.get("version")
+        if version is None:
+            return
+        record = {"status": statistics["status"], "objective": statistics.get("objective")}
+        background_solves[version] = record
+        if final_placements is None or final_placements == placements:
+            record["published_version"] = None
+            return
+        final_schedule = placements_to_schedule(new_scans_data, final_placements, reference_datetime)
+        final_stats = {}
+        published = merge_and_save(
+            [row.copy() for row in existing_schedule], final_schedule, schedule_csv_path, version, final_stats,
+            store_version, latest_starts(new_scans_data, reference_datetime), locked_ids, first["schedule"]
+        )
+        record["published_version"] = final_stats.get("schedule_version")
+        if published is None:
+            print("Improved schedule discarded: the stored schedule changed during the solve.")
+            return
+        for entry in final_schedule:
+            last_solution.put(entry["scan_id"], entry)
+        if use_cache:
+            cached_stats = dict(stats, **statistics)
+            cached_stats["schedule_version"] = record["published_version"]
+            cached_stats.pop("anytime", None)
+            remember_schedule(cache_key, record["published_version"], [dict(row) for row in published], cached_stats)
+
+    # The background publisher waits for the first schedule, also when the solve fails
+    try:
+        if stats is None:
+            stats = {}
+        stats["timings"] = timings
+        if surge_batch_size is not None and len(new_scans_data) > surge_batch_size:
+            engine = surge_engine
+
+        if use_cache:
+            options = [engine, window_mins, overlap_mins, use_hints, fix_hints, builder, anytime, good_enough_gap, soft]
+            # Settings resolved for the whole request: the part of it still unlocked shrinks on retries
+            request_settings = resolve_solver_settings(scans_data_all, solver_overrides)
+            cache_key = solve_key(scans_data_all, request_settings, options)
+            cached = cached_schedule(cache_key, store_version)
+            if cached is not None:
+                stats.update(cached["stats"])
+                stats["cache"] = "hit"
+                print("Returning the cached schedule of an identical request.")
+                return [dict(row) for row in cached["schedule"]]
+            stats["cache"] = "miss"
+
+        stats["engine"] = engine
+        stats["settings"] = settings
+        # engines imports this module, so the registry is looked up at call time
+        from engines import get_engine, MODEL_ENGINES
+        solve = get_engine(engine)
+        problems = capacity_check(new_scans_data, locked_intervals, horizon)
+        stats["capacity_check"] = problems
+        if problems and not soft and engine in MODEL_ENGINES:
+            stats["status"] = "INFEASIBLE"
+            print(f"Capacity check failed, the batch cannot be scheduled: {problems}")
+            return None
+        timings["prep"] = time.perf_counter() - stage_start - timings["parse"]
+        engine_start = time.perf_counter()
+        placements = solve(
+            new_scans_data, locked_intervals, horizon, hints, stats, settings,
+            builder=builder, fix_hints=fix_hints, window_mins=window_mins, overlap_mins=overlap_mins,
+            compare_monolithic=compare_monolithic, anytime=anytime, good_enough_gap=good_enough_gap,
+            on_final=publish_improvement, soft=soft, progress=progress
+        )
+        engine_time = time.perf_counter() - engine_start
+        timings["build"] = stats.get("build_time")
+        timings["solve"] = engine_time - (timings["build"] or 0)
+        if placements is not None and "objective" not in stats:
+            stats["objective"] = schedule_objective(new_scans_data, placements, soft)
+        if placements is not None and soft:
+            stats["unplaced"] = [s["scan_id"] for s in new_scans_data if s["scan_id"] not in placements]
+            if stats["unplaced"]:
+                print(f"Scans left unplaced: {stats['unplaced']}")
+
+        if placements is None:
+            return None
+
+        post_start = time.perf_counter()
+        new_schedule = placements_to_schedule(new_scans_data, placements, reference_datetime)
+        for entry in new_schedule:
+            last_solution.put(entry["scan_id"], entry)
+        cleaned_schedule = merge_and_save(
+            [row.copy() for row in existing_schedule], new_schedule, schedule_csv_path, store_version, stats,
+            base_version=store_version, deadlines=latest_starts(new_scans_data, reference_datetime),
+            locked_ids=locked_ids
+        )
+        if cleaned_schedule is None:
+            return None
+        first["version"] = stats["schedule_version"]
+        first["schedule"] = cleaned_schedule
+        timings["write"] = stats["write_time"]
+        timings["post"] = time.perf_counter() - post_start - timings["write"]
+        timings["total"] = time.perf_counter() - stage_start
+        if use_cache:
+            remember_schedule(cache_key, stats["schedule_version"], [dict(row) for row in cleaned_schedule], stats)
+        print(type(cleaned_schedule))
+        print(cleaned_schedule)
+        return cleaned_schedule
+    finally:
+        first_published.set()
@@ -1,35 +1,151 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import io
-from dotenv import load_dotenv
 import os
+import asyncio
+import weakref
+import httpx
+from dotenv import load_dotenv
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.silence import detect_silence
+from config import whisper_base_url, whisper_max_connections, whisper_chunk_secs, whisper_silence_search_secs
+from config import whisper_min_silence_ms, whisper_silence_offset_db
 
+load_dotenv()
 
-def audio_processing(file_buffer, filename="audio.webm"):
+_client = None
+# One pooled async client per event loop (the server has one; tests may start several)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def whisper_client():
     """
-    Transcribes an audio file using whisper-1 and returns the detected text.
+    Process-wide OpenAI client, created on first use.
     """
-    # Reset the file buffer so we read from the beginning.
-    file_buffer.seek(0)
-    
-    load_dotenv()
-    api_key = os.getenv("OPENAI_API_KEY")
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=whisper_base_url)
+    return _client
+
 
-    client = OpenAI(api_key=api_key)
+def async_whisper_client():
+    """
+    AsyncOpenAI client of the running event loop, reusing up to whisper_max_connections
+    pooled connections.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=whisper_max_connections, max_keepalive_connections=whisper_max_connections)
+        client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"), base_url=whisper_base_url,
+            http_client=httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600, connect=10))
+        )
+        _async_clients[loop] = client
+    return client
 
+
+def mime_type_for(filename):
     # Determine the MIME type based on the file extension. this helps to run on more browsers and potentially on mobile(needs further testing)
     if filename.lower().endswith(".ogg"):
-        mime_type = "audio/ogg"
+        return "audio/ogg"
     elif filename.lower().endswith(".wav"):
-        mime_type = "audio/wav"
-    else:
-        mime_type = "audio/webm"
+        return "audio/wav"
+    return "audio/webm"
+
+
+def audio_processing(file_buffer, filename="audio.webm"):
+    """
+    Transcribes an audio file using whisper-1 and returns the detected text.
+    Blocking; async callers use transcribe_audio.
+    """
+    # Reset the file buffer so we read from the beginning.
+    file_buffer.seek(0)
 
     # Create transcription using the audio file.
-    transcript = client.audio.transcriptions.create(
+    transcript = whisper_client().audio.transcriptions.create(
         model="whisper-1",
-        file=(filename, file_buffer, mime_type)
+        file=(filename, file_buffer, mime_type_for(filename))
     )
-    
+
     print(transcript)
     print("Recording complete")
     return transcript
+
+
+def silence_cut_points(audio, chunk_ms, search_ms, min_silence_ms, silence_thresh):
+    """
+    Offsets (ms) at which to split audio into chunks of at most chunk_ms. Each cut is
+    placed in the middle of the last silence within the search_ms before the limit, or
+    at the limit if that stretch has no silence. Only those stretches are scanned.
+    """
+    cuts = []
+    start = 0
+    while len(audio) - start > chunk_ms:
+        limit = start + chunk_ms
+        window_start = max(start + 1, limit - search_ms)
+        silences = detect_silence(audio[window_start:limit], min_silence_ms, silence_thresh, seek_step=10)
+        cut = window_start + (silences[-1][0] + silences[-1][1]) // 2 if silences else limit
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+
+def split_at_silence(audio, chunk_secs=whisper_chunk_secs):
+    """
+    Splits a recording into chunks of at most chunk_secs, cutting in pauses of speech
+    where possible (see silence_cut_points).
+    """
+    silence_thresh = audio.dBFS - whisper_silence_offset_db
+    cuts = silence_cut_points(
+        audio, int(chunk_secs * 1000), int(whisper_silence_search_secs * 1000), whisper_min_silence_ms,
+        silence_thresh
+    )
+    bounds = [0] + cuts + [len(audio)]
+    return [audio[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def decode_chunks(audio_bytes, filename, chunk_secs):
+    """
+    WAV bytes of each chunk of a recording longer than chunk_secs (mono, 16 kHz, which is
+    what Whisper works at), or None if it is shorter or cannot be decoded here (e.g. no
+    ffmpeg for webm), in which case it is sent as it is.
+    """
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=os.path.splitext(filename)[1][1:] or None)
+    except (CouldntDecodeError, OSError):
+        return None
+    if audio.duration_seconds <= chunk_secs:
+        return None
+    chunks = []
+    for segment in split_at_silence(audio.set_channels(1).set_frame_rate(16000), chunk_secs):
+        out = io.BytesIO()
+        segment.export(out, format="wav")
+        chunks.append(out.getvalue())
+    return chunks
+
+
+async def transcribe_audio(file_buffer, filename="audio.webm", chunk_secs=whisper_chunk_secs):
+    """
+    Transcribes a recording without blocking the event loop and returns {"text", "chunks"}.
+    Recordings longer than chunk_secs are split at silences, the chunks are transcribed
+    concurrently over the pooled client and their texts joined in order.
+    """
+    file_buffer.seek(0)
+    audio_bytes = file_buffer.read()
+    client = async_whisper_client()
+    chunks = await asyncio.to_thread(decode_chunks, audio_bytes, filename, chunk_secs)
+    if chunks is None:
+        transcript = await client.audio.transcriptions.create(
+            model="whisper-1", file=(filename, audio_bytes, mime_type_for(filename))
+        )
+        print("Recording complete")
+        return {"text": transcript.text, "chunks": 1}
+
+    transcripts = await asyncio.gather(*[
+        client.audio.transcriptions.create(model="whisper-1", file=(f"chunk_{i}.wav", chunk, "audio/wav"))
+        for i, chunk in enumerate(chunks)
+    ])
+    text = " ".join(t.text.strip() for t in transcripts if t.text.strip())
+    print("Recording complete")
+    return {"text": text, "chunks": len(chunks)}
@@ -0,0 +1,215 @@
+import heapq
+from config import machines
+from occupancy import OccupancyIndex, to_time_str
+from optimizer import DEADLINE_MINS, eligible_machines, earliest_start
+
+
+class CascadeRepair:
+    """
+    Makes room for the maintenance blocks and Priority 0 scans of a schedule by moving only
+    the bookings they displace. Maintenance blocks never move; each P0 scan keeps its
+    start, or waits for the scans already running on its machine. The bookings they
+    overlap (on their machine, or of a P0 scan's patient) are moved one at a time in
+    chronological order. A displaced booking goes to the earliest start, not before its
+    current one, that is free on its machine or on a sibling machine of its modality (see
+    optimizer.eligible_machines), clear of its patient's other bookings and inside the
+    P4/P5 start window. On its own machine it may overlap later bookings, which are then
+    displaced in turn; on a sibling it only takes a free gap. The cascade stops as soon as
+    a move displaces nothing, so every booking that is not moved keeps its slot.
+    Pinned bookings (e.g. the locked ones) never move either: blocks and P0 scans wait
+    for them. With triggers, only the maintenance blocks and P0 scans among those
+    scan_ids are made room for, and the other triggers are moved the same way if they
+    overlap a booking, so a merge only cascades from what it added.
+    """
+
+    def __init__(self, schedule, index, deadlines=None, pinned=(), triggers=None):
+        self.by_id = {entry["scan_id"]: entry for entry in schedule}
+        self.index = index
+        # Latest start per scan_id in minutes since EPOCH, where the check-in is known
+        self.deadlines = deadlines or {}
+        self.pinned = set(pinned)
+        self.triggers = set(self.by_id) if triggers is None else set(triggers)
+        self.patients = {}
+        for entry in schedule:
+            self.patients.setdefault(entry["patient_id"], []).append(entry["scan_id"])
+        self.settled = set()
+        self.queued = set()
+        self.queue = []
+        self.moved = {}
+        self.late = []
+
+    def fixed(self, s_id):
+        entry = self.by_id[s_id]
+        return entry["scan_type"] == "maintenance" or int(entry["priority"]) == 0
+
+    def immovable(self, s_id):
+        return s_id in self.pinned or self.fixed(s_id)
+
+    def key(self, s_id):
+        _, start, _, seq = self.index.entries[s_id]
+        return start, seq
+
+    def latest_start(self, s_id, start):
+        """
+        The scan's deadline. The store keeps no check-in times, so a booking from an
+        earlier batch may move up to its priority's deadline past its booked start.
+        """
+        if s_id in self.deadlines:
+            return self.deadlines[s_id]
+        deadline = DEADLINE_MINS.get(int(self.by_id[s_id]["priority"]))
+        return None if deadline is None else start + deadline
+
+    def displace(self, s_id):
+        if s_id not in self.settled and s_id not in self.queued:
+            self.queued.add(s_id)
+            heapq.heappush(self.queue, self.key(s_id) + (s_id,))
+
+    def patient_conflicts(self, s_id, start, end):
+        for other in self.patients[self.by_id[s_id]["patient_id"]]:
+            if other != s_id and other in self.index:
+                _, o_start, o_end, _ = self.index.entries[other]
+                if o_start < end and start < o_end:
+                    yield other
+
+    def earliest_fit(self, s_id, machine, after, blocking, patient_blocking):
+        """
+        Earliest start >= after for s_id on machine that overlaps no blocking booking of the
+        machine and no patient_blocking booking of the patient, with the machine's bookings
+        it would overlap there.
+        """
+        _, start, end, _ = self.index.entries[s_id]
+        duration = end - start
+        priority = int(self.by_id[s_id]["priority"])
+        t = after
+        while True:
+            t = earliest_start(t, priority)
+            overlapping = [o for o in self.index.overlaps(machine, t, t + duration) if o != s_id]
+            blocked = [o for o in overlapping if blocking(o)]
+            blocked += [o for o in self.patient_conflicts(s_id, t, t + duration) if patient_blocking(o)]
+            if not blocked:
+                return t, overlapping
+            t = max(self.index.entries[o][2] for o in blocked)
+
+    def settle_maintenance(self, s_id):
+        """
+        Displaces the bookings a maintenance block overlaps on its machine.
+        """
+        machine, start, end, _ = self.index.entries[s_id]
+        self.settled.add(s_id)
+        for other in self.index.overlaps(machine, start, end):
+            if other != s_id and not self.immovable(other):
+                self.displace(other)
+
+    def settle_priority_zero(self, s_id):
+        """
+        Keeps a P0 scan at its start unless scans that started before it, or bookings that
+        cannot move, are still running there (on its machine or for its patient), and
+        displaces the bookings it overlaps.
+        """
+        machine, start, end, _ = self.index.entries[s_id]
+
+        def started_before(o):
+            # P0 scans still to be settled come later and wait for this one
+            return o in self.settled or o in self.pinned or (self.fixed(o) and o not in self.triggers) or (
+                o not in self.queued and self.index.entries[o][1] < start)
+
+        t, overlapping = self.earliest_fit(s_id, machine, start, started_before, started_before)
+        if t != start:
+            self.move(s_id, machine, t)
+        self.settled.add(s_id)
+        # P0 scans not yet settled wait for this one when their turn comes
+        for other in overlapping + list(self.patient_conflicts(s_id, t, t + end - start)):
+            if not self.immovable(other):
+                self.displace(other)
+
+    def place(self, s_id):
+        """
+        Moves a displaced booking to the best of its options: the earliest start in time for
+        its deadline, then one that displaces nothing, then its own machine.
+        """
+        machine, start, _, _ = self.index.entries[s_id]
+        entry = self.by_id[s_id]
+        key = self.key(s_id)
+        siblings = []
+        if entry["scan_type"] in machines:
+            siblings = [m for m in eligible_machines(entry["scan_type"], int(entry["priority"])) if m != machine]
+
+        def ahead(o):
+            return o in self.settled or self.immovable(o) or self.key(o) < key
+
+        t, displaced = self.earliest_fit(s_id, machine, start, ahead, lambda o: True)
+        options = [(t, bool(displaced), 0, machine, displaced)]
+        for rank, m in enumerate(siblings, start=1):
+            t, _ = self.earliest_fit(s_id, m, start, lambda o: True, lambda o: True)
+            options.append((t, False, rank, m, []))
+        deadline = self.latest_start(s_id, start)
+        in_time = [option for option in options if deadline is None or option[0] <= deadline]
+        if not in_time:
+            self.late.append(s_id)
+        t, _, _, m, displaced = min(in_time or options)
+        if (t, m) != (start, machine):
+            self.move(s_id, m, t)
+        self.settled.add(s_id)
+        for other in displaced:
+            self.displace(other)
+
+    def move(self, s_id, machine, start):
+        old_machine, old_start, old_end, _ = self.index.entries[s_id]
+        end = start + old_end - old_start
+        if machine == old_machine:
+            self.index.move(s_id, start, end)
+        else:
+            self.index.insert(s_id, machine, start, end)
+        entry = self.by_id[s_id]
+        entry["machine"] = machine
+        entry["start_time"] = to_time_str(start)
+        entry["end_time"] = to_time_str(end)
+        if s_id not in self.moved:
+            self.moved[s_id] = (old_machine, old_start)
+
+    def run(self):
+        triggers = [s_id for s_id in self.triggers if s_id in self.by_id and s_id in self.index]
+        for s_id in triggers:
+            if self.by_id[s_id]["scan_type"] == "maintenance":
+                self.settle_maintenance(s_id)
+        # The solver only avoids the locked bookings, so a new booking may overlap a later one
+        for s_id in triggers:
+            if not self.immovable(s_id):
+                machine, start, end, _ = self.index.entries[s_id]
+                if any(o != s_id for o in self.index.overlaps(machine, start, end)):
+                    self.displace(s_id)
+        priority_zero = sorted(
+            (self.index.entries[s_id][1], self.index.entries[s_id][3], s_id) for s_id in triggers
+            if int(self.by_id[s_id]["priority"]) == 0 and self.by_id[s_id]["scan_type"] != "maintenance"
+        )
+        for _, _, s_id in priority_zero:
+            self.settle_priority_zero(s_id)
+        while self.queue:
+            _, _, s_id = heapq.heappop(self.queue)
+            if s_id not in self.settled:
+                self.place(s_id)
+        return [self.by_id[s_id] for s_id in self.index.ordered_ids()]
+
+
+def repair_priority_zero(schedule, index=None, deadlines=None, stats=None, pinned=(), triggers=None):
+    """
+    Applies a CascadeRepair for the maintenance blocks and Priority 0 scans of schedule
+    and returns the repaired schedule. index is an OccupancyIndex holding exactly the schedule's entries (built if
+    not given); moved bookings are moved in it. deadlines maps scan_ids to their latest
+    start in minutes since EPOCH; pinned and triggers are as in CascadeRepair. The number
+    of moves, how many went to a sibling machine and the scans that could only be placed
+    past their deadline are recorded in stats.
+    """
+    if index is None:
+        index = OccupancyIndex.from_schedule(schedule)
+    repair = CascadeRepair(schedule, index, deadlines, pinned, triggers)
+    repaired = repair.run()
+    if repair.late:
+        print(f"Priority 0 repair: no slot before the deadline for {', '.join(map(str, repair.late))}")
+    if stats is not None:
+        stats["p0_repair"] = {
+            "moved": len(repair.moved),
+            "to_sibling": sum(1 for s_id, (m, _) in repair.moved.items() if index.entries[s_id][0] != m),
+            "late": repair.late,
+        }
+    return repaired
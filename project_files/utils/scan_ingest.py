@@ -0,0 +1,144 @@
+import csv
+import json
+import codecs
+from datetime import datetime
+from config import machines, ingest_max_scans, ingest_max_errors
+
+# Columns of a scan request, in the order optimize_scan_scheduling reads them
+SCAN_FIELDS = ["scan_id", "scan_type", "duration", "priority", "patient_id", "check_in_date", "check_in_time"]
+PRIORITIES = range(0, 6)
+# Patient ids are stored as SQLite integers (64-bit signed)
+PATIENT_IDS = range(0, 2 ** 63)
+
+
+class IngestError(ValueError):
+    """
+    An upload that cannot be read at all (unknown format, missing columns).
+    """
+
+
+class UploadTooLarge(IngestError):
+    """
+    An upload with more scans than allowed.
+    """
+
+
+def validate_scan(record):
+    """
+    Checks one scan request and returns it with every field as the text the optimizer
+    reads. Raises ValueError naming the first problem.
+    """
+    missing = [f for f in SCAN_FIELDS if record.get(f) is None or str(record[f]).strip() == ""]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    scan = {f: str(record[f]).strip() for f in SCAN_FIELDS}
+    if scan["scan_type"] not in machines:
+        raise ValueError(f"unknown scan_type {scan['scan_type']!r}")
+    try:
+        duration, priority, patient_id = int(scan["duration"]), int(scan["priority"]), int(scan["patient_id"])
+    except ValueError:
+        raise ValueError("duration, priority and patient_id must be whole numbers")
+    if duration <= 0:
+        raise ValueError(f"duration must be positive, got {duration}")
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be {PRIORITIES.start}-{PRIORITIES.stop - 1}, got {priority}")
+    if patient_id not in PATIENT_IDS:
+        raise ValueError(f"patient_id must be {PATIENT_IDS.start}-{PATIENT_IDS.stop - 1}, got {patient_id}")
+    try:
+        check_in = datetime.strptime(f"{scan['check_in_date']} {scan['check_in_time']}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        raise ValueError("check_in_date/check_in_time must be YYYY-MM-DD and HH:MM")
+    scan.update(duration=str(duration), priority=str(priority), patient_id=str(patient_id),
+                check_in_date=check_in.strftime("%Y-%m-%d"), check_in_time=check_in.strftime("%H:%M"))
+    return scan
+
+
+class ScanIngestor:
+    """
+    Incremental parser and validator of a bulk upload of scan requests, fed one line at
+    a time, so an upload is never held in memory as a whole. "csv" uploads start with a
+    header naming at least SCAN_FIELDS (fields may not span lines); "ndjson" uploads hold
+    one JSON object per line. Valid scans are kept in upload order; rejected lines are
+    counted and the first max_errors of them reported with their line number. The solve
+    books one scan per patient, so a second scan for a patient is rejected like a
+    duplicate scan_id rather than making the whole upload infeasible.
+    """
+
+    def __init__(self, fmt, max_scans=ingest_max_scans, max_errors=ingest_max_errors):
+        if fmt not in ("csv", "ndjson"):
+            raise IngestError(f"Unknown upload format: {fmt}")
+        self.format = fmt
+        self.max_scans = max_scans
+        self.max_errors = max_errors
+        self.header = None
+        self.line_number = 0
+        self.scans = []
+        self.scan_ids = set()
+        self.patient_ids = set()
+        self.rejected = 0
+        self.errors = []
+
+    def add_line(self, line):
+        self.line_number += 1
+        if not line.strip():
+            return
+        if self.format == "csv":
+            values = next(csv.reader([line]))
+            if self.header is None:
+                self.header = [v.strip() for v in values]
+                missing = [f for f in SCAN_FIELDS if f not in self.header]
+                if missing:
+                    raise IngestError(f"CSV header lacks {', '.join(missing)}")
+                return
+            if len(values) > len(self.header):
+                return self.reject(f"{len(values)} fields for a {len(self.header)}-column header")
+            record = dict(zip(self.header, values))
+        else:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                return self.reject(f"invalid JSON: {e}")
+            if not isinstance(record, dict):
+                return self.reject("not a JSON object")
+        try:
+            scan = validate_scan(record)
+        except ValueError as e:
+            return self.reject(str(e), record.get("scan_id"))
+        if scan["scan_id"] in self.scan_ids:
+            return self.reject("duplicate scan_id", scan["scan_id"])
+        if scan["patient_id"] in self.patient_ids:
+            return self.reject(f"patient_id {scan['patient_id']} already has a scan in this upload", scan["scan_id"])
+        if len(self.scans) >= self.max_scans:
+            raise UploadTooLarge(f"More than {self.max_scans} scans in one upload")
+        self.scan_ids.add(scan["scan_id"])
+        self.patient_ids.add(scan["patient_id"])
+        self.scans.append(scan)
+
+    def reject(self, error, scan_id=None):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": self.line_number, "scan_id": scan_id, "error": error})
+
+    def summary(self):
+        return {"accepted": len(self.scans), "rejected": self.rejected, "errors": self.errors}
+
+
+async def ingest_stream(chunks, fmt, max_scans=ingest_max_scans, max_errors=ingest_max_errors):
+    """
+    Feeds an async iterator of byte chunks (e.g. Request.stream()) to a ScanIngestor line
+    by line as the chunks arrive, and returns it. A UTF-8 byte order mark is skipped.
+    """
+    ingestor = ScanIngestor(fmt, max_scans, max_errors)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        # The last piece is the start of a line that continues in the next chunk
+        pending = lines.pop()
+        for line in lines:
+            ingestor.add_line(line)
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        ingestor.add_line(pending)
+    return ingestor
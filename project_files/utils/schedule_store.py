@@ -0,0 +1,384 @@
+import os
+import sys
+import uuid
+import hashlib
+import sqlite3
+import threading
+import tempfile
+from contextlib import closing
+from datetime import timedelta
+import pandas as pd
+
+SCHEDULE_COLUMNS = ["scan_id", "patient_id", "scan_type", "machine", "start_time", "end_time", "priority", "duration"]
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+UPSERT = (
+    f"INSERT OR REPLACE INTO schedule ({', '.join(SCHEDULE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(SCHEDULE_COLUMNS))})"
+)
+
+# Serializes writers within this process so that version checks and writes are atomic
+_store_lock = threading.Lock()
+# Open stores by absolute path
+_stores = {}
+
+
+def open_store(path):
+    """
+    Schedule store for a path: SQLite for .db/.sqlite/.sqlite3 files, the CSV file otherwise.
+    """
+    path = os.path.abspath(path)
+    with _store_lock:
+        if path not in _stores:
+            if path.endswith((".db", ".sqlite", ".sqlite3")):
+                _stores[path] = SqliteScheduleStore(path)
+            else:
+                _stores[path] = CsvScheduleStore(path)
+        return _stores[path]
+
+
+def schedule_version(path):
+    """
+    Version token of the stored schedule. It changes whenever the schedule is rewritten,
+    including by another process; "0" means no schedule has been stored yet.
+    """
+    return open_store(path).version()
+
+
+def is_superseded(path, version):
+    """
+    True if the schedule a client holds (identified by its version) is no longer the stored one.
+    """
+    return version != schedule_version(path)
+
+
+def load_schedule_frame(path, since=None):
+    """
+    The stored schedule as a DataFrame, or None if nothing has been stored yet. With since
+    (a string in TIME_FORMAT) only the rows ending after it and, on each machine, the rows
+    from its last maintenance block before since on (all of them if it has none), which
+    the maintenance count of the next block starts from (see maintenance.insert_maintenance_blocks).
+    """
+    return open_store(path).load_frame(since)
+
+
+def apply_changes(path, rows, removed_ids=(), expected_version=None):
+    """
+    Upserts rows and deletes the removed_ids in one write, leaving the other stored rows
+    alone. With expected_version the write only happens if the store is still at that
+    version. Returns the new version (the current one if there was nothing to change), or
+    None if the store had moved on.
+    """
+    return open_store(path).apply(rows, removed_ids, expected_version)
+
+
+def time_window(start, hours=None, days=None):
+    """
+    (start, end) strings of a window starting at the datetime `start`, for range queries.
+    """
+    end = start + timedelta(hours=hours or 0, days=days or 0)
+    return start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+
+
+class CsvScheduleStore:
+    """
+    The schedule as one CSV file, rewritten in full on every change: the CSV is written to
+    a temporary file next to it and renamed into place, so readers never see a half-written file.
+    The version is a counter in a sidecar file (path + VERSION_SUFFIX) that every write
+    bumps; a CSV the store has never written is versioned by a hash of its content.
+    """
+
+    VERSION_SUFFIX = ".version"
+
+    def __init__(self, path):
+        self.path = path
+        self.version_path = path + self.VERSION_SUFFIX
+
+    def version(self):
+        if not os.path.exists(self.path):
+            return "0"
+        try:
+            with open(self.version_path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            with open(self.path, "rb") as f:
+                return "sha-" + hashlib.sha256(f.read()).hexdigest()[:16]
+
+    def next_version(self):
+        """
+        The version after the current one: the counter plus one, under the token that
+        tells this store's counter from one of an earlier file at the same path.
+        """
+        token, _, counter = self.version().partition("-")
+        if token in ("0", "sha") or not counter.isdigit():
+            return f"{uuid.uuid4().hex[:8]}-1"
+        return f"{token}-{int(counter) + 1}"
+
+    def load_frame(self, since=None):
+        if not os.path.exists(self.path):
+            return None
+        df = pd.read_csv(self.path)
+        if since is None:
+            return df
+        blocks = df[(df["scan_type"] == "maintenance") & (df["start_time"] < since)]
+        last_block = df["machine"].map(blocks.groupby("machine")["start_time"].max()).fillna("")
+        return df[(df["end_time"] > since) | (df["start_time"] >= last_block)].reset_index(drop=True)
+
+    def rows_between(self, start, end, machine=None):
+        """
+        Rows starting in [start, end) (strings in TIME_FORMAT), optionally on one machine.
+        """
+        df = self.load_frame()
+        if df is None:
+            return []
+        mask = (df["start_time"] >= start) & (df["start_time"] < end)
+        if machine is not None:
+            mask &= df["machine"] == machine
+        return df[mask].sort_values(["machine", "start_time"]).to_dict("records")
+
+    def publish(self, schedule, expected_version=None):
+        with _store_lock:
+            if expected_version is not None and self.version() != expected_version:
+                return None
+            return self._write(pd.DataFrame(schedule))
+
+    def upsert(self, rows, expected_version=None):
+        """
+        Inserts or replaces rows by scan_id. Returns the new version, or None if the
+        store had moved on from expected_version.
+        """
+        return self.apply(rows, (), expected_version)
+
+    def apply(self, rows, removed_ids=(), expected_version=None):
+        """
+        Inserts or replaces rows by scan_id and deletes removed_ids (see apply_changes).
+        """
+        with _store_lock:
+            if expected_version is not None and self.version() != expected_version:
+                return None
+            if not rows and not removed_ids:
+                return self.version()
+            df = self.load_frame()
+            new_df = pd.DataFrame(rows, columns=None if rows else SCHEDULE_COLUMNS)
+            if df is not None:
+                dropped = set(new_df["scan_id"].astype(str)) | set(str(s) for s in removed_ids)
+                df = df[~df["scan_id"].astype(str).isin(dropped)]
+                new_df = pd.concat([df, new_df], ignore_index=True) if rows else df
+            return self._write(new_df)
+
+    def _write(self, df):
+        """
+        Replaces the CSV with df and bumps the version (callers hold _store_lock).
+        Returns the new version.
+        """
+        version = self.next_version()
+        replace_file(self.path, ".csv", lambda f: df.to_csv(f, index=False))
+        replace_file(self.version_path, ".version", lambda f: f.write(version))
+        return version
+
+
+def replace_file(path, suffix, write):
+    """
+    Writes a file through write(f) into a temporary file next to path and renames it into place.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class SqliteScheduleStore:
+    """
+    The schedule in an embedded SQLite database, indexed by scan_id, by machine and start
+    time, and by start time. Writes run in one IMMEDIATE transaction that checks the
+    version first, so concurrent writers (threads or processes) cannot clobber each
+    other, and only rows that actually changed are written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # patient_id has no declared type: it holds numbers and "Maintenance"
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schedule (scan_id TEXT PRIMARY KEY, patient_id, scan_type TEXT, "
+                "machine TEXT, start_time TEXT, end_time TEXT, priority INTEGER, duration INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS schedule_machine_start ON schedule (machine, start_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS schedule_start ON schedule (start_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS schedule_end ON schedule (end_time)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS schedule_type_machine_start ON schedule (scan_type, machine, start_time)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+
+    def _connect(self):
+        # Autocommit mode; transactions are opened explicitly
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _version(self, conn):
+        return str(conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def version(self):
+        with closing(self._connect()) as conn:
+            return self._version(conn)
+
+    def load_frame(self, since=None):
+        query = f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM schedule"
+        with closing(self._connect()) as conn:
+            # One read transaction, so the rows belong to a single version
+            conn.execute("BEGIN")
+            try:
+                if self._version(conn) == "0":
+                    return None
+                if since is None:
+                    return pd.read_sql_query(query, conn)
+                # Every query below is answered from an index, so the history before the
+                # window is never scanned
+                frames = [pd.read_sql_query(query + " WHERE end_time > ?", conn, params=[since])]
+                machine = conn.execute("SELECT MIN(machine) FROM schedule").fetchone()[0]
+                while machine is not None:
+                    last_block = conn.execute(
+                        "SELECT MAX(start_time) FROM schedule "
+                        "WHERE scan_type = 'maintenance' AND machine = ? AND start_time < ?", (machine, since)
+                    ).fetchone()[0]
+                    frames.append(pd.read_sql_query(
+                        query + " WHERE machine = ? AND start_time >= ? AND end_time <= ?", conn,
+                        params=[machine, last_block or "", since]
+                    ))
+                    next_machine = conn.execute("SELECT MIN(machine) FROM schedule WHERE machine > ?", (machine,))
+                    machine = next_machine.fetchone()[0]
+                return pd.concat(frames, ignore_index=True)
+            finally:
+                conn.execute("COMMIT")
+
+    def rows_between(self, start, end, machine=None):
+        """
+        Rows starting in [start, end) (strings in TIME_FORMAT), optionally on one machine,
+        answered from the start-time indexes.
+        """
+        query = f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM schedule WHERE start_time >= ? AND start_time < ?"
+        params = [start, end]
+        if machine is not None:
+            query += " AND machine = ?"
+            params.append(machine)
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(query + " ORDER BY machine, start_time", params)
+            return [dict(zip(SCHEDULE_COLUMNS, row)) for row in cursor]
+
+    def _write(self, expected_version, changes):
+        """
+        Runs changes(conn) in a write transaction if the store is at expected_version
+        (or always without one) and bumps the version. Returns the new version or None.
+        """
+        with _store_lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if expected_version is not None and self._version(conn) != expected_version:
+                    conn.execute("ROLLBACK")
+                    return None
+                changes(conn)
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+                version = self._version(conn)
+                conn.execute("COMMIT")
+                return version
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def publish(self, schedule, expected_version=None):
+        """
+        Makes the stored schedule equal to `schedule`: new and changed rows are upserted,
+        rows missing from it are deleted, unchanged rows are left alone. Meant for whole
+        schedules (import_csv); a schedule read earlier would delete the rows written since,
+        so changes to part of it go through apply.
+        """
+        rows = {str(row["scan_id"]): db_row(row) for row in schedule}
+
+        def changes(conn):
+            stored = {
+                row[0]: row for row in conn.execute(f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM schedule")
+            }
+            removed = [(s_id,) for s_id in stored if s_id not in rows]
+            changed = [row for s_id, row in rows.items() if s_id not in stored or not same_row(stored[s_id], row)]
+            conn.executemany("DELETE FROM schedule WHERE scan_id = ?", removed)
+            conn.executemany(UPSERT, changed)
+
+        return self._write(expected_version, changes)
+
+    def upsert(self, rows, expected_version=None):
+        """
+        Inserts or replaces rows by scan_id. Returns the new version, or None if the
+        store had moved on from expected_version.
+        """
+        return self.apply(rows, (), expected_version)
+
+    def apply(self, rows, removed_ids=(), expected_version=None):
+        """
+        Inserts or replaces rows by scan_id and deletes removed_ids in one transaction
+        (see apply_changes).
+        """
+        if not rows and not removed_ids:
+            version = self.version()
+            return version if expected_version is None or version == expected_version else None
+
+        def changes(conn):
+            conn.executemany("DELETE FROM schedule WHERE scan_id = ?", [(str(s),) for s in removed_ids])
+            conn.executemany(UPSERT, [db_row(row) for row in rows])
+
+        return self._write(expected_version, changes)
+
+    def delete(self, scan_ids, expected_version=None):
+        return self._write(
+            expected_version,
+            lambda conn: conn.executemany("DELETE FROM schedule WHERE scan_id = ?", [(str(s),) for s in scan_ids])
+        )
+
+
+def db_row(row):
+    """
+    Schedule entry as a tuple of plain Python values in SCHEDULE_COLUMNS order.
+    """
+    values = []
+    for column in SCHEDULE_COLUMNS:
+        value = row.get(column)
+        if hasattr(value, "item"):
+            value = value.item()
+        if isinstance(value, float) and value != value:
+            value = None
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        values.append(value)
+    values[0] = str(values[0])
+    return tuple(values)
+
+
+def same_row(stored, row):
+    # Compared as text: a value read back from SQLite may differ in type, not in content
+    return [str(v) for v in stored] == [str(v) for v in row]
+
+
+def import_csv(csv_path, db_path, replace=False):
+    """
+    One-shot import of a CSV schedule into a SQLite store. Refuses to overwrite a store
+    that already holds a schedule unless replace is set. Returns the number of rows imported.
+    """
+    store = open_store(db_path)
+    if not isinstance(store, SqliteScheduleStore):
+        raise ValueError(f"Not a SQLite store path: {db_path}")
+    if store.version() != "0" and not replace:
+        raise ValueError(f"{db_path} already holds a schedule")
+    rows = pd.read_csv(csv_path).to_dict("records")
+    store.publish(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python schedule_store.py <schedule.csv> <schedule.db>")
+        sys.exit(1)
+    print(f"Imported {import_csv(sys.argv[1], sys.argv[2])} rows into {sys.argv[2]}")
@@ -0,0 +1,122 @@
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from config import machines, solve_cache_size
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a size cap and an optional time to live,
+    counting hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, valid=None):
+        """
+        The value under key, or None. Entries past their time to live, or for which
+        valid(value) is false, are dropped and count as misses.
+        """
+        with self.lock:
+            item = self.entries.get(key)
+            expired = item is not None and self.ttl_seconds is not None and time.monotonic() - item[0] > self.ttl_seconds
+            if item is not None and (expired or (valid is not None and not valid(item[1]))):
+                del self.entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def best(self, score, min_score):
+        """
+        The live value with the highest score(value), if that is at least min_score, or
+        None; counted and refreshed like get.
+        """
+        with self.lock:
+            now = time.monotonic()
+            best_key, best_score = None, min_score
+            for key, (stored, value) in self.entries.items():
+                if self.ttl_seconds is not None and now - stored > self.ttl_seconds:
+                    continue
+                value_score = score(value)
+                if value_score >= best_score:
+                    best_key, best_score = key, value_score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            return self.entries[best_key][1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def counters(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Merged schedules of recent solves, keyed by solve_key
+solve_cache = LRUCache(solve_cache_size)
+
+
+def solve_key(scans_data_all, settings, options):
+    """
+    Canonical hash of a request: the requested scans, the machines config, the solver
+    settings and the engine options. The stored schedule is not part of it; a cached
+    entry is only served while the store is still at the version its solve published
+    (see cached_schedule), so a retry matches even when the merge moved locked bookings.
+    """
+    scans = sorted(
+        (str(s["scan_id"]), str(s["scan_type"]), int(s["duration"]), int(s["priority"]),
+         str(s["patient_id"]), str(s["check_in_datetime"]))
+        for s in scans_data_all
+    )
+    payload = json.dumps([scans, machines, settings, options], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_schedule(key, store_version):
+    """
+    The merged schedule stored under key, if the schedule store has not changed since
+    that solve published it. Entries from an older store version are dropped.
+    """
+    return solve_cache.get(key, lambda entry: entry["version"] == store_version)
+
+
+def remember_schedule(key, store_version, schedule, stats):
+    """
+    Stores the merged schedule a solve published at store_version.
+    """
+    solve_cache.put(key, {"version": store_version, "schedule": schedule, "stats": dict(stats)})
@@ -3,11 +3,18 @@ from langchain_openai import OpenAIEmbeddings
 from langchain_community.chat_models import ChatOpenAI
 from langchain_pinecone import PineconeVectorStore
 import io
+import re
 import csv
 import os
 import random
+import threading
+import numpy as np
 from dotenv import load_dotenv
 from langchain.chains import ConversationalRetrievalChain
+from config import rag_cache_size, rag_cache_ttl_secs, rag_semantic_threshold
+from config import rag_retriever, local_index_dir, local_index_nprobe, rag_embeddings, rag_llm_base_url
+from local_vector_index import LocalVectorIndex, HashingEmbeddings
+from solve_cache import LRUCache
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 pc_key  =  os.getenv("PINECONE_API_KEY")
@@ -53,31 +60,9 @@ def convert_output_to_csv(old_output):
     print(output.getvalue())
     return output.getvalue()
 
-def search_with_rag(index_name, input_text):
-    
-    """
-    stateful rag function
-    Inputs: string pinecone index name for target and string prompt text.
-    Output: Generated CSV string.
-    """
-    load_dotenv()
-    api_key = os.getenv("OPENAI_API_KEY")
-    pc_key  =  os.getenv("PINECONE_API_KEY")
-    chat_history = []
-    embeddings = OpenAIEmbeddings(api_key=api_key)
-    vectorstore = PineconeVectorStore(
-        index_name=index_name,
-        embedding=embeddings,
-        pinecone_api_key=pc_key
-    )
-
-    chat = ChatOpenAI(verbose=True, temperature=0, model_name="gpt-4o-mini", api_key=api_key)
-
-    qa = ConversationalRetrievalChain.from_llm(
-        llm=chat, chain_type="stuff", retriever=vectorstore.as_retriever()
-    )
-    #prompt was improved using gpt to run faster and more reliably for the new whisper api
-    prompt = (
+#prompt was improved using gpt to run faster and more reliably for the new whisper api
+# The fixed instructions come first and the transcript last, so every request shares the same prompt prefix
+EXTRACTION_PROMPT = (
     "Extract the following information from the provided text: \n"
     "1. Condition location (e.g., head, torso, etc.)\n"
     "2. Condition description\n"
@@ -90,17 +75,128 @@ def search_with_rag(index_name, input_text):
     "Head,Acute stroke,P1,24,MRI\n\n"
     "Only return the extracted values in this format, with no extra text or explanations.\n"
     "Input text:\n"
-    )
-    prompt += input_text
+)
 
-    res = qa({"question": prompt, "chat_history": chat_history})
-    
-    old_output = res["answer"]
+_embeddings = None
+# ConversationalRetrievalChain per index name
+_chains = {}
+_chain_lock = threading.Lock()
+# Extracted answers by (index_name, normalized transcript)
+answer_cache = LRUCache(rag_cache_size, rag_cache_ttl_secs)
+# {"index_name", "vector", "tokens", "answer"} by (index_name, normalized transcript), matched by embedding
+# similarity among the entries with the same critical_tokens
+semantic_cache = LRUCache(rag_cache_size, rag_cache_ttl_secs)
+
+
+def embeddings():
+    global _embeddings
+    with _chain_lock:
+        if _embeddings is None:
+            _embeddings = HashingEmbeddings() if rag_embeddings == "hashing" else OpenAIEmbeddings(api_key=api_key)
+        return _embeddings
+
+
+def rag_chain(index_name):
+    """
+    Retrieval chain over the Pinecone index index_name, or over the local copy of it in
+    local_index_dir/<index_name> with rag_retriever = "local"; built on first use and shared
+    by all requests.
+    """
+    embedding = embeddings()
+    with _chain_lock:
+        if index_name not in _chains:
+            if rag_retriever == "local":
+                directory = os.path.join(local_index_dir, index_name)
+                retriever = LocalVectorIndex(directory, local_index_nprobe).as_retriever(embedding)
+            else:
+                vectorstore = PineconeVectorStore(
+                    index_name=index_name,
+                    embedding=embedding,
+                    pinecone_api_key=pc_key
+                )
+                retriever = vectorstore.as_retriever()
+            chat = ChatOpenAI(
+                verbose=True, temperature=0, model_name="gpt-4o-mini", api_key=api_key, base_url=rag_llm_base_url
+            )
+            _chains[index_name] = ConversationalRetrievalChain.from_llm(
+                llm=chat, chain_type="stuff", retriever=retriever
+            )
+        return _chains[index_name]
+
+
+def normalize_transcript(text):
+    """
+    Lower-cased transcript without punctuation and with single spaces, so dictations that
+    differ only in Whisper's punctuation or spacing share a cache entry.
+    """
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text.lower())).strip()
+
+
+# Spoken numbers Whisper may write out instead of digits
+NUMBER_WORDS = {
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve",
+    "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen", "twenty", "thirty",
+    "forty", "fifty", "sixty", "seventy", "eighty", "ninety", "hundred", "half", "quarter",
+}
+
+
+def critical_tokens(normalized):
+    """
+    The tokens of a normalized transcript that carry a priority, a wait time or another
+    number ("p1", "24", "twelve"), in order. Embeddings barely tell these apart, so a
+    semantic cache hit is only accepted when they match exactly.
+    """
+    return [t for t in normalized.split() if t in NUMBER_WORDS or any(c.isdigit() for c in t)]
+
+
+def unit_vector(text):
+    vector = np.asarray(embeddings().embed_query(text), dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def rag_cache_counters():
+    return {"exact": answer_cache.counters(), "semantic": semantic_cache.counters()}
+
+
+def search_with_rag(index_name, input_text):
     
-    csv_result = convert_output_to_csv(old_output)
+    """
+    stateful rag function
+    Inputs: string pinecone index name for target and string prompt text.
+    Output: Generated CSV string.
+    The extracted answer is reused for a transcript seen before (after normalize_transcript)
+    or, with rag_semantic_threshold set, for one whose embedding is at least that similar
+    to a cached one and whose critical_tokens are the same; only other transcripts go to
+    the LLM.
+    """
+    key = (index_name, normalize_transcript(input_text))
+    old_output = answer_cache.get(key)
+    vector = None
+    if old_output is None and rag_semantic_threshold is not None:
+        vector = unit_vector(key[1])
+        tokens = critical_tokens(key[1])
+        match = semantic_cache.best(
+            lambda entry: float(entry["vector"] @ vector)
+            if entry["index_name"] == index_name and entry["tokens"] == tokens else -1.0,
+            rag_semantic_threshold
+        )
+        if match is not None:
+            old_output = match["answer"]
+
+    if old_output is None:
+        res = rag_chain(index_name)({"question": EXTRACTION_PROMPT + input_text, "chat_history": []})
+        old_output = res["answer"]
+        csv_result = convert_output_to_csv(old_output)
+        # Cached only once it converted, so a malformed answer is asked again next time
+        answer_cache.put(key, old_output)
+        if vector is not None:
+            semantic_cache.put(key, {"index_name": index_name, "vector": vector, "tokens": tokens,
+                                     "answer": old_output})
+    else:
+        answer_cache.put(key, old_output)
+        csv_result = convert_output_to_csv(old_output)
     print("\nCSV Output:")
     print((old_output).__class__)
     print("\nCSV Output complete:")
     
     return csv_result
-
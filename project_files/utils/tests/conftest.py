@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of utils import each other by their flat names (see the Procfile)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,97 @@
+import pytest
+from batch_queue import BatchRequest, OptimizationQueue, read_scans
+
+HEADER = "scan_id,scan_type,duration,priority,patient_id,check_in_date,check_in_time"
+
+
+def scans(*ids):
+    """
+    Request CSV with one scan per (scan_id, patient_id) pair.
+    """
+    return HEADER + "\n" + "".join(f"{s},CT,30,2,{p},2030-01-07,09:00\n" for s, p in ids)
+
+
+class FakeSolver:
+    def __init__(self, fail=None):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, scans_csv, solver_overrides, stats, progress):
+        rows, _ = read_scans(scans_csv)
+        self.calls.append(([row["scan_id"] for row in rows], solver_overrides))
+        if self.fail:
+            raise self.fail
+        if progress is not None:
+            progress({"objective": 1})
+        stats["status"] = "OPTIMAL"
+        # The last scan of every batch is left unplaced
+        return [{"scan_id": row["scan_id"], "machine": "CT-1"} for row in rows[:-1]]
+
+
+def queued(optimization_queue, *requests):
+    """
+    Puts the requests ((scans_csv, solver_overrides) pairs) in the queue without starting
+    its thread, so batches are formed from exactly these requests.
+    """
+    batch_requests = [BatchRequest(csv, overrides) for csv, overrides in requests]
+    for request in batch_requests:
+        optimization_queue.requests.put(request)
+    return batch_requests
+
+
+def batch_ids(batch):
+    return [request.scan_ids for request in batch]
+
+
+def test_waiting_requests_are_solved_as_one_batch():
+    solver = FakeSolver()
+    optimization_queue = OptimizationQueue(solver, window_secs=0.05)
+    first, second = queued(optimization_queue, (scans(("A", 1), ("B", 2)), None), (scans(("C", 3)), None))
+    optimization_queue.solve_batch(optimization_queue.next_batch())
+    assert solver.calls == [(["A", "B", "C"], None)]
+    assert first.future.result() == {
+        "schedule": [{"scan_id": "A", "machine": "CT-1"}, {"scan_id": "B", "machine": "CT-1"}],
+        "unplaced": [], "stats": {"status": "OPTIMAL"}, "batch": {"requests": 2, "scans": 3},
+    }
+    assert second.future.result()["schedule"] == []
+    assert second.future.result()["unplaced"] == ["C"]
+    assert optimization_queue.counters() == {"queued": 0, "batches": 1, "requests": 2}
+
+
+@pytest.mark.parametrize("second", [
+    (scans(("C", 1)), None),  # the same patient
+    (scans(("A", 3)), None),  # the same scan_id
+    (scans(("C", 3)), {"max_time_in_seconds": 5}),  # other solver settings
+    (scans(("C", 3), ("D", 4), ("E", 5)), None),  # over max_batch_scans
+])
+def test_requests_that_do_not_fit_wait_for_the_next_batch(second):
+    optimization_queue = OptimizationQueue(FakeSolver(), window_secs=0.05, max_batch_scans=4)
+    queued(optimization_queue, (scans(("A", 1), ("B", 2)), None), second, (scans(("F", 6)), None))
+    assert batch_ids(optimization_queue.next_batch()) == [["A", "B"]]
+    assert optimization_queue.counters()["queued"] == 2
+    # The request held back starts the next batch, ahead of later ones
+    assert batch_ids(optimization_queue.next_batch())[0] == [row["scan_id"] for row in read_scans(second[0])[0]]
+
+
+def test_a_failed_solve_fails_every_request_of_the_batch():
+    error = RuntimeError("solver crashed")
+    optimization_queue = OptimizationQueue(FakeSolver(fail=error), window_secs=0.05)
+    requests = queued(optimization_queue, (scans(("A", 1)), None), (scans(("B", 2)), None))
+    optimization_queue.solve_batch(optimization_queue.next_batch())
+    for request in requests:
+        with pytest.raises(RuntimeError, match="solver crashed"):
+            request.future.result()
+    assert optimization_queue.counters()["batches"] == 0
+
+
+def test_submitted_requests_are_solved_by_the_queue_thread():
+    solver = FakeSolver()
+    optimization_queue = OptimizationQueue(solver, window_secs=0.5)
+    updates = []
+    first = optimization_queue.submit(scans(("A", 1), ("B", 2)), progress=updates.append)
+    second = optimization_queue.submit(scans(("C", 3), ("D", 4)))
+    assert first.result(timeout=10)["schedule"] == [{"scan_id": "A", "machine": "CT-1"},
+                                                    {"scan_id": "B", "machine": "CT-1"}]
+    assert second.result(timeout=10)["unplaced"] == ["D"]
+    assert solver.calls == [(["A", "B", "C", "D"], None)]
+    assert updates == [{"objective": 1}]
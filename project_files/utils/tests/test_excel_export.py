@@ -0,0 +1,50 @@
+import openpyxl
+from excel_export import FIRST_ROW, CONFLICT_FILL, create_machine_agenda_excel
+
+DAY = "2030-01-07"
+
+
+def entry(scan_id, patient_id, scan_type, machine, start, end):
+    return {"scan_id": scan_id, "patient_id": patient_id, "scan_type": scan_type, "machine": machine,
+            "start_time": f"{DAY} {start}", "end_time": f"{DAY} {end}", "priority": 2}
+
+
+def row(clock):
+    hours, minutes = map(int, clock.split(":"))
+    return hours * 60 + minutes + FIRST_ROW
+
+
+def test_overlapping_bookings_are_shown_at_their_true_start(tmp_path):
+    path = str(tmp_path / "agenda.xlsx")
+    create_machine_agenda_excel([
+        entry("S0", 10, "CT", "CT-1", "10:00", "10:30"), entry("S1", 11, "CT", "CT-1", "10:20", "10:50"),
+        entry("S2", 12, "CT", "CT-1", "10:25", "10:40"), entry("S3", 13, "CT", "CT-1", "11:00", "11:30"),
+        entry("M0", 14, "MRI", "MRI-1", "10:00", "10:30"),
+    ], path)
+    sheet = openpyxl.load_workbook(path)[DAY]
+    assert [cell.value for cell in sheet[1]] == ["Time", "CT-1", "MRI-1", "Conflicts", "Conflicts"]
+    # Each overlapping booking gets a conflict lane, starting and ending on its own rows
+    assert sheet[f"D{row('10:20')}"].value == "CT-1: 11 (CT)"
+    assert sheet[f"E{row('10:25')}"].value == "CT-1: 12 (CT)"
+    assert sheet[f"B{row('10:00')}"].value == "10 (CT)"
+    assert sheet[f"A{row('10:20')}"].value == "10:20"
+    merged = set(str(r) for r in sheet.merged_cells.ranges)
+    assert {f"B{row('10:00')}:B{row('10:29')}", f"D{row('10:20')}:D{row('10:49')}",
+            f"E{row('10:25')}:E{row('10:39')}", f"B{row('11:00')}:B{row('11:29')}"} <= merged
+
+    fill = CONFLICT_FILL.fgColor.rgb
+    for cell in (f"B{row('10:00')}", f"D{row('10:20')}", f"E{row('10:25')}"):
+        assert sheet[cell].fill.fgColor.rgb == fill
+    for cell in (f"B{row('11:00')}", f"C{row('10:00')}"):
+        assert sheet[cell].fill.fgColor.rgb != fill
+
+
+def test_bookings_over_midnight_continue_on_the_next_sheet(tmp_path):
+    path = str(tmp_path / "agenda.xlsx")
+    overnight = dict(entry("S0", 10, "CT", "CT-1", "23:30", "23:59"), end_time="2030-01-08 00:30")
+    create_machine_agenda_excel([overnight], path)
+    workbook = openpyxl.load_workbook(path)
+    assert workbook.sheetnames == [DAY, "2030-01-08"]
+    assert workbook[DAY][f"B{row('23:30')}"].value == "10 (CT)"
+    assert f"B{row('23:30')}:B{row('23:59')}" in set(str(r) for r in workbook[DAY].merged_cells.ranges)
+    assert f"B{row('00:00')}:B{row('00:29')}" in set(str(r) for r in workbook["2030-01-08"].merged_cells.ranges)
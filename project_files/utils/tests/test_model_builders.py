@@ -0,0 +1,32 @@
+from optimizer import load_scan_requests, planning_horizon, solve_placements, schedule_objective
+
+HEADER = "scan_id,scan_type,duration,priority,patient_id,check_in_date,check_in_time\n"
+
+
+def solve_both(rows, soft):
+    scans, _ = load_scan_requests(HEADER + rows)
+    horizon = planning_horizon(scans)
+    results = {}
+    for builder in ("classic", "lean"):
+        stats = {}
+        placements = solve_placements(scans, [], horizon, stats=stats, builder=builder, soft=soft,
+                                      settings={"num_search_workers": 1, "max_time_in_seconds": 10})
+        results[builder] = (stats["objective"], schedule_objective(scans, placements, soft=soft))
+    return results
+
+
+def test_soft_builders_agree_when_a_priority_zero_scan_stays_unplaced():
+    # A and B share a patient, so one of the two P0 scans stays unplaced
+    results = solve_both(
+        "A,CT,30,0,7,2025-03-25,10:00\nB,CT,30,0,7,2025-03-25,12:00\n"
+        "C,MRI,30,2,8,2025-03-25,11:00\nD,MRI,30,4,9,2025-03-25,23:00\n", soft=True
+    )
+    assert results["classic"] == results["lean"]
+    assert results["lean"][0] == results["lean"][1]
+
+
+def test_builders_agree():
+    results = solve_both(
+        "A,CT,30,0,7,2025-03-25,10:00\nC,MRI,30,2,8,2025-03-25,11:00\nD,MRI,30,4,9,2025-03-25,23:00\n", soft=False
+    )
+    assert results["classic"] == results["lean"]
@@ -0,0 +1,83 @@
+import random
+import pytest
+from occupancy import OccupancyIndex, to_minutes, to_time_str
+
+DAY = to_minutes("2030-01-07 08:00")
+
+
+def entry(scan_id, machine, start, end):
+    return {"scan_id": scan_id, "machine": machine, "start_time": to_time_str(start), "end_time": to_time_str(end)}
+
+
+def test_overlaps_bounds():
+    index = OccupancyIndex.from_schedule([
+        entry("long", "CT-1", DAY, DAY + 240), entry("a", "CT-1", DAY + 240, DAY + 270),
+        entry("b", "CT-1", DAY + 270, DAY + 300), entry("other", "CT-2", DAY + 250, DAY + 260),
+    ])
+    # Touching intervals do not overlap; a long booking that started well before the query does
+    assert index.overlaps("CT-1", DAY + 230, DAY + 240) == ["long"]
+    assert index.overlaps("CT-1", DAY + 240, DAY + 270) == ["a"]
+    assert index.overlaps("CT-1", DAY + 239, DAY + 271) == ["long", "a", "b"]
+    assert index.overlaps("CT-1", DAY + 300, DAY + 330) == []
+    assert index.overlaps("CT-3", DAY, DAY + 1440) == []
+    assert index.next_free_gap("CT-1", DAY + 10, 30) == DAY + 300
+    assert index.next_free_gap("CT-2", DAY + 230, 20) == DAY + 230
+
+
+def test_duplicate_scan_ids_are_rejected():
+    with pytest.raises(ValueError, match="Duplicate scan_ids in schedule: a"):
+        OccupancyIndex.from_schedule([entry("a", "CT-1", DAY, DAY + 30), entry("a", "CT-2", DAY, DAY + 30)])
+
+
+def test_ties_keep_insertion_order_and_moves_keep_it():
+    index = OccupancyIndex.from_schedule([entry("a", "CT-1", DAY, DAY + 30), entry("b", "CT-1", DAY, DAY + 15)])
+    index.insert("c", "CT-1", DAY, DAY + 30)
+    index.insert("block", "CT-1", DAY, DAY + 60, first=True)
+    assert index.ids["CT-1"] == ["block", "a", "b", "c"]
+    index.move("a", DAY + 60, DAY + 90)
+    index.move("a", DAY, DAY + 30)
+    assert index.ids["CT-1"] == ["block", "a", "b", "c"]
+    assert index.overlapping_neighbours("CT-1") == [("block", "a"), ("a", "b"), ("b", "c")]
+    # Inserting a stored scan_id replaces its entry
+    index.insert("b", "CT-2", DAY, DAY + 15)
+    assert index.ids["CT-1"] == ["block", "a", "c"] and index.entries["b"][0] == "CT-2"
+    index.delete("block")
+    assert index.ordered_ids() == ["a", "c", "b"]
+
+
+def test_copies_are_independent():
+    index = OccupancyIndex.from_schedule([entry("a", "CT-1", DAY, DAY + 30)])
+    copy = index.copy()
+    copy.insert("b", "CT-1", DAY + 30, DAY + 60)
+    copy.move("a", DAY + 60, DAY + 90)
+    assert index.ids["CT-1"] == ["a"] and index.entries["a"][1] == DAY
+    assert copy.ids["CT-1"] == ["b", "a"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_queries_match_a_scan_of_every_interval(seed):
+    rng = random.Random(seed)
+    intervals = {}
+    index = OccupancyIndex()
+    for i in range(300):
+        s_id = f"S{rng.randrange(200)}"
+        machine = rng.choice(["CT-1", "CT-2"])
+        start = DAY + rng.randrange(2000)
+        end = start + rng.choice([5, 15, 30, 240])
+        if rng.random() < 0.2 and s_id in intervals:
+            index.delete(s_id)
+            del intervals[s_id]
+        elif rng.random() < 0.3 and s_id in intervals:
+            index.move(s_id, start, end)
+            intervals[s_id] = (intervals[s_id][0], start, end)
+        else:
+            index.insert(s_id, machine, start, end)
+            intervals[s_id] = (machine, start, end)
+        machine = rng.choice(["CT-1", "CT-2"])
+        q_start = DAY + rng.randrange(2000)
+        q_end = q_start + rng.randrange(1, 120)
+        expected = {s for s, (m, a, b) in intervals.items() if m == machine and a < q_end and b > q_start}
+        assert set(index.overlaps(machine, q_start, q_end)) == expected
+    for machine in ("CT-1", "CT-2"):
+        assert [index.entries[s][1] for s in index.ids[machine]] == sorted(
+            a for m, a, _ in intervals.values() if m == machine)
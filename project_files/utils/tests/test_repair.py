@@ -0,0 +1,162 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from config import machines
+from occupancy import to_minutes, to_time_str
+from optimizer import (
+    merge_and_save, optimize_scan_scheduling, load_existing_schedule, eligible_machines, earliest_start
+)
+
+DAY = to_minutes("2030-01-07 06:00")
+
+
+def entry(scan_id, patient_id, scan_type, machine, start, duration, priority):
+    return {
+        "scan_id": scan_id, "patient_id": patient_id, "scan_type": scan_type, "machine": machine,
+        "start_time": to_time_str(start), "end_time": to_time_str(start + duration), "priority": priority,
+        "duration": duration,
+    }
+
+
+def intervals(schedule, key):
+    groups = {}
+    for e in schedule:
+        groups.setdefault(e[key], []).append((to_minutes(e["start_time"]), to_minutes(e["end_time"]), e["scan_id"]))
+    return groups
+
+
+def overlaps(schedule, key):
+    found = []
+    for group in intervals(schedule, key).values():
+        group.sort()
+        for (_, end, id1), (start, _, id2) in zip(group, group[1:]):
+            if start < end:
+                found.append((id1, id2))
+    return found
+
+
+def random_schedule(n, seed):
+    """
+    n bookings spread over the machines, mostly back to back and with repeated patients,
+    plus Priority 0 scans dropped on top of booked time.
+    """
+    rng = random.Random(seed)
+    free = {m: DAY for ms in machines.values() for m in ms}
+    patient_free = {}
+    schedule = []
+    for i in range(n):
+        scan_type = rng.choice(list(machines))
+        priority = rng.choice([1, 2, 3, 4, 5])
+        machine = rng.choice(eligible_machines(scan_type, priority))
+        duration = rng.choice([15, 20, 30, 45])
+        patient_id = rng.randrange(n // 3 + 1)
+        start = max(free[machine] + rng.choice([0, 0, 0, 5, 30]), patient_free.get(patient_id, 0))
+        start = earliest_start(start, priority)
+        free[machine] = patient_free[patient_id] = start + duration
+        schedule.append(entry(f"S{i}", patient_id, scan_type, machine, start, duration, priority))
+    for k in range(n // 20):
+        hit = rng.choice(schedule)
+        start = to_minutes(hit["start_time"]) + rng.choice([0, 5])
+        schedule.append(entry(f"P{k}", 10 ** 6 + k, hit["scan_type"], hit["machine"], start, 30, 0))
+    return schedule
+
+
+def test_maintenance_blocks_do_not_overlap_bookings(tmp_path):
+    new = [entry(f"S{i}", i, "MRI", "MRI-1", DAY + 30 * i, 30, 2) for i in range(1, 23)]
+    merged = merge_and_save([], new, str(tmp_path / "schedule.csv"))
+
+    assert overlaps(merged, "machine") == []
+    maintenance = [e for e in merged if e["scan_type"] == "maintenance"]
+    assert [(e["machine"], e["start_time"]) for e in maintenance] == [("MRI-1", to_time_str(DAY + 30 * 21))]
+    # The two scans after the block were moved past it, not dropped
+    assert sorted(e["scan_id"] for e in merged if e["scan_type"] != "maintenance") == sorted(e["scan_id"] for e in new)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_repair_keeps_machine_patient_and_window_rules(tmp_path, seed):
+    original = random_schedule(200, seed)
+    booked = {e["scan_id"]: (e["machine"], e["start_time"]) for e in original}
+    stats = {}
+    merged = merge_and_save([], [dict(e) for e in original], str(tmp_path / "schedule.csv"), stats=stats)
+
+    assert overlaps(merged, "machine") == []
+    assert overlaps([e for e in merged if e["scan_type"] != "maintenance"], "patient_id") == []
+    for e in merged:
+        if e["scan_type"] == "maintenance":
+            continue
+        priority = int(e["priority"])
+        start = to_minutes(e["start_time"])
+        assert e["machine"] in machines[e["scan_type"]]
+        if priority != 0:
+            assert e["machine"] == booked[e["scan_id"]][0] or e["machine"] in eligible_machines(e["scan_type"], priority)
+        assert earliest_start(start, priority) == start
+        assert start >= to_minutes(booked[e["scan_id"]][1])
+    assert stats["p0_repair"]["moved"] > 0
+
+
+@pytest.mark.parametrize("engine, builder", [("cpsat", "classic"), ("cpsat", "lean"), ("greedy", "classic")])
+def test_solver_and_repair_share_the_p4_p5_window(tmp_path, engine, builder):
+    # Check-ins late in the day: the 240-1199 window is the time on the clock, not an
+    # offset from the batch's first check-in
+    scans = "scan_id,scan_type,duration,priority,patient_id,check_in_date,check_in_time\n" + "".join(
+        f"L{i},CT,30,{4 + i % 2},{i},2030-01-07,{18 + i % 5}:{15 * (i % 4):02}\n" for i in range(12)
+    )
+    stats = {}
+    merged = optimize_scan_scheduling(scans, str(tmp_path / "schedule.csv"), engine=engine, builder=builder,
+                                      stats=stats, use_cache=False, solver_overrides={"num_search_workers": 1})
+    assert len(merged) == 12
+    for e in merged:
+        start = to_minutes(e["start_time"])
+        assert 240 <= start % 1440 <= 1199
+        assert earliest_start(start, int(e["priority"])) == start
+    assert stats["p0_repair"]["moved"] == 0
+
+
+def scan_rows(n, seed, prefix, first_day, days):
+    rng = random.Random(seed)
+    rows = ["scan_id,scan_type,duration,priority,patient_id,check_in_date,check_in_time"]
+    for i in range(n):
+        t = first_day + timedelta(minutes=rng.randrange(days * 1440))
+        rows.append(f"{prefix}{i},{rng.choice(list(machines))},{rng.choice([15, 30, 45, 60])},"
+                    f"{rng.choice([0, 1, 2, 2, 3, 4, 5])},{prefix}{i},{t:%Y-%m-%d},{t:%H:%M}")
+    return "\n".join(rows) + "\n"
+
+
+def stored_schedule(path):
+    existing_schedule, _, locked_ids, _ = load_existing_schedule(path, datetime.now())
+    return existing_schedule, locked_ids
+
+
+def build_store(path):
+    three_days_ago = datetime.now().replace(second=0, microsecond=0) - timedelta(days=3)
+    for i in range(3):
+        optimize_scan_scheduling(scan_rows(150, i, f"B{i}_", three_days_ago, 6), path, engine="greedy",
+                                 use_cache=False)
+
+
+def test_merging_no_new_scans_changes_nothing(tmp_path):
+    path = str(tmp_path / "schedule.csv")
+    build_store(path)
+    before, locked_ids = stored_schedule(path)
+    assert any(e["scan_type"] == "maintenance" for e in before)
+    for _ in range(3):
+        stats = {}
+        merge_and_save([dict(e) for e in before], [], path, stats=stats, locked_ids=locked_ids)
+        after, _ = stored_schedule(path)
+        assert sorted(map(str, after)) == sorted(map(str, before))
+        assert stats["p0_repair"]["moved"] == 0
+
+
+def test_a_merge_moves_no_locked_or_past_bookings(tmp_path):
+    path = str(tmp_path / "schedule.csv")
+    build_store(path)
+    before, locked_ids = stored_schedule(path)
+    now = datetime.now().replace(second=0, microsecond=0)
+    stats = {}
+    optimize_scan_scheduling(scan_rows(80, 9, "N", now - timedelta(days=1), 3), path, engine="greedy",
+                             use_cache=False, stats=stats)
+    after = {e["scan_id"]: e for e in stored_schedule(path)[0]}
+    moved = [e["scan_id"] for e in before if e["scan_id"] in locked_ids and
+             (after[e["scan_id"]]["machine"], after[e["scan_id"]]["start_time"]) != (e["machine"], e["start_time"])]
+    assert moved == []
+    assert stats["p0_repair"]["moved"] > 0
@@ -0,0 +1,102 @@
+import json
+import asyncio
+import pytest
+from scan_ingest import SCAN_FIELDS, ScanIngestor, IngestError, UploadTooLarge, ingest_stream
+
+HEADER = ",".join(SCAN_FIELDS)
+
+
+def ingest(lines, fmt="csv", **limits):
+    ingestor = ScanIngestor(fmt, **limits)
+    for line in lines:
+        ingestor.add_line(line)
+    return ingestor
+
+
+def errors(ingestor):
+    return [(e["line"], e["scan_id"], e["error"]) for e in ingestor.errors]
+
+
+def test_valid_scans_are_kept_in_upload_order_as_text():
+    ingestor = ingest([HEADER, "S1, CT ,30,1,7,2030-01-07,9:05", "", "S2,MRI,45.0,2,8,2030-01-07,10:00",
+                       "S3,X-Ray,15,0,9,2030-1-7,11:30"])
+    assert [s["scan_id"] for s in ingestor.scans] == ["S1", "S3"]
+    assert ingestor.scans[0] == {"scan_id": "S1", "scan_type": "CT", "duration": "30", "priority": "1",
+                                 "patient_id": "7", "check_in_date": "2030-01-07", "check_in_time": "09:05"}
+    assert ingestor.scans[1]["check_in_date"] == "2030-01-07"
+    assert errors(ingestor) == [(4, "S2", "duration, priority and patient_id must be whole numbers")]
+
+
+def test_duplicate_scan_ids_are_rejected():
+    ingestor = ingest([HEADER, "S1,CT,30,1,7,2030-01-07,09:00", "S1,MRI,30,2,8,2030-01-07,10:00"])
+    assert [s["scan_id"] for s in ingestor.scans] == ["S1"]
+    assert errors(ingestor) == [(3, "S1", "duplicate scan_id")]
+
+
+def test_unknown_scan_types_are_rejected():
+    ingestor = ingest([HEADER, "S1,PET,30,1,7,2030-01-07,09:00"])
+    assert not ingestor.scans
+    assert errors(ingestor) == [(2, "S1", "unknown scan_type 'PET'")]
+
+
+@pytest.mark.parametrize("patient_id, error", [
+    ("abc", "duration, priority and patient_id must be whole numbers"),
+    ("-1", "patient_id must be 0-9223372036854775807, got -1"),
+    (str(2 ** 63), f"patient_id must be 0-9223372036854775807, got {2 ** 63}"),
+    ("", "missing patient_id"),
+])
+def test_bad_patient_ids_are_rejected(patient_id, error):
+    ingestor = ingest([HEADER, f"S1,CT,30,1,{patient_id},2030-01-07,09:00"])
+    assert not ingestor.scans
+    assert errors(ingestor) == [(2, "S1", error)]
+
+
+def test_a_second_scan_for_a_patient_is_rejected():
+    ingestor = ingest([HEADER, "S1,CT,30,1,7,2030-01-07,09:00", "S2,MRI,30,2,07,2030-01-08,10:00"])
+    assert [s["scan_id"] for s in ingestor.scans] == ["S1"]
+    assert errors(ingestor) == [(3, "S2", "patient_id 7 already has a scan in this upload")]
+
+
+def test_bad_values_are_rejected():
+    ingestor = ingest([
+        HEADER, "S1,CT,0,1,1,2030-01-07,09:00", "S2,CT,30,6,2,2030-01-07,09:00", "S3,CT,30,1,3,2030-13-07,09:00",
+        "S4,CT,30,1,4,2030-01-07,09:00,extra",
+    ])
+    assert not ingestor.scans
+    assert [e[2] for e in errors(ingestor)] == [
+        "duration must be positive, got 0", "priority must be 0-5, got 6",
+        "check_in_date/check_in_time must be YYYY-MM-DD and HH:MM", "8 fields for a 7-column header",
+    ]
+
+
+def test_uploads_that_cannot_be_read_raise():
+    with pytest.raises(IngestError, match="CSV header lacks priority, patient_id"):
+        ingest(["scan_id,scan_type,duration,check_in_date,check_in_time"])
+    with pytest.raises(IngestError, match="Unknown upload format"):
+        ScanIngestor("xml")
+    with pytest.raises(UploadTooLarge):
+        ingest([HEADER] + [f"S{i},CT,30,1,{i},2030-01-07,09:00" for i in range(3)], max_scans=2)
+
+
+def test_ndjson_uploads_and_the_error_cap():
+    lines = [json.dumps({"scan_id": "S1", "scan_type": "CT", "duration": 30, "priority": 1, "patient_id": 7,
+                         "check_in_date": "2030-01-07", "check_in_time": "09:00"}), "[1, 2]", "{not json"]
+    lines += [json.dumps({"scan_id": f"B{i}"}) for i in range(5)]
+    ingestor = ingest(lines, "ndjson", max_errors=3)
+    assert [s["scan_id"] for s in ingestor.scans] == ["S1"]
+    assert ingestor.summary()["rejected"] == 7
+    reported = [e[2] for e in errors(ingestor)]
+    assert len(reported) == 3
+    assert reported[0] == "not a JSON object" and reported[1].startswith("invalid JSON")
+
+
+def test_ingest_stream_joins_lines_split_across_chunks():
+    upload = ("\ufeff" + HEADER + "\nS1,CT,30,1,7,2030-01-07,09:00\nS2,MRI,30,2,8,2030-01-07,10:00").encode()
+
+    async def chunks():
+        for i in range(0, len(upload), 7):
+            yield upload[i:i + 7]
+
+    ingestor = asyncio.run(ingest_stream(chunks(), "csv"))
+    assert [s["scan_id"] for s in ingestor.scans] == ["S1", "S2"]
+    assert ingestor.summary() == {"accepted": 2, "rejected": 0, "errors": []}
@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+import pytest
+import optimizer
+from occupancy import to_minutes, to_time_str
+from schedule_store import open_store, apply_changes, schedule_version, load_schedule_frame
+from optimizer import merge_and_save, load_existing_schedule, retry_on_conflict
+
+DAY = to_minutes("2030-01-07 08:00")
+
+
+def entry(scan_id, machine, start, duration=30, patient_id=None, priority=3):
+    return {
+        "scan_id": scan_id, "patient_id": patient_id if patient_id is not None else scan_id, "scan_type": "CT",
+        "machine": machine, "start_time": to_time_str(start), "end_time": to_time_str(start + duration),
+        "priority": priority, "duration": duration,
+    }
+
+
+def stored(path):
+    df = load_schedule_frame(path)
+    return {} if df is None else {str(row["scan_id"]): (row["machine"], row["start_time"])
+                                  for row in df.to_dict("records")}
+
+
+@pytest.fixture(params=["schedule.csv", "schedule.db"])
+def path(request, tmp_path):
+    optimizer.published_occupancy.clear()
+    return str(tmp_path / request.param)
+
+
+def test_a_write_against_an_old_version_is_rejected(path):
+    store = open_store(path)
+    version = store.publish([entry("A", "CT-1", DAY), entry("B", "CT-1", DAY + 30)])
+    # Another writer gets in between the read and the write
+    newer = store.upsert([entry("C", "CT-2", DAY)], version)
+    assert newer is not None and newer != version
+    assert store.upsert([entry("D", "CT-2", DAY + 30)], version) is None
+    assert apply_changes(path, [entry("A", "CT-3", DAY)], ["B"], version) is None
+    assert store.publish([entry("A", "CT-1", DAY)], version) is None
+    assert schedule_version(path) == newer
+    assert stored(path) == {"A": ("CT-1", to_time_str(DAY)), "B": ("CT-1", to_time_str(DAY + 30)),
+                            "C": ("CT-2", to_time_str(DAY))}
+
+
+def test_apply_writes_only_the_changes(path):
+    store = open_store(path)
+    version = store.publish([entry("A", "CT-1", DAY), entry("B", "CT-1", DAY + 30), entry("C", "CT-2", DAY)])
+    version = apply_changes(path, [entry("A", "CT-1", DAY + 60), entry("D", "CT-3", DAY)], ["B"], version)
+    assert version is not None
+    assert stored(path) == {"A": ("CT-1", to_time_str(DAY + 60)), "C": ("CT-2", to_time_str(DAY)),
+                            "D": ("CT-3", to_time_str(DAY))}
+    # Nothing to change: no new version
+    assert apply_changes(path, [], [], version) == version
+
+
+def test_window_load_reads_the_rows_still_running(path):
+    block = dict(entry("maintenance_CT-1", "CT-1", DAY - 60, 30, "Maintenance", 0), scan_type="maintenance")
+    open_store(path).publish([entry("old", "CT-1", DAY - 1440), block, entry("running", "CT-2", DAY - 15),
+                              entry("new", "CT-1", DAY + 60)])
+    rows = load_schedule_frame(path, to_time_str(DAY))
+    assert sorted(rows["scan_id"]) == ["maintenance_CT-1", "new", "running"]
+    assert len(load_schedule_frame(path)) == 4
+
+
+def test_window_load_reads_the_scans_since_each_machines_last_block(path):
+    block = dict(entry("maintenance_CT-1", "CT-1", DAY - 600, 60, "Maintenance", 0), scan_type="maintenance")
+    open_store(path).publish([entry("before", "CT-1", DAY - 700), block, entry("counted", "CT-1", DAY - 500),
+                              entry("other", "CT-2", DAY - 500), entry("new", "CT-1", DAY + 60)])
+    rows = load_schedule_frame(path, to_time_str(DAY))
+    # CT-2 has no block yet, so all of its scans count
+    assert sorted(rows["scan_id"]) == ["counted", "maintenance_CT-1", "new", "other"]
+
+
+def test_sqlite_publish_upserts_changed_rows_and_deletes_missing_ones(tmp_path):
+    path = str(tmp_path / "schedule.db")
+    store = open_store(path)
+    first = store.publish([entry("A", "CT-1", DAY), entry("B", "CT-1", DAY + 30), entry("C", "CT-2", DAY)])
+    second = store.publish([entry("A", "CT-1", DAY), entry("B", "CT-3", DAY + 30), entry("E", "CT-2", DAY + 30)],
+                           first)
+    assert int(second) == int(first) + 1
+    assert stored(path) == {"A": ("CT-1", to_time_str(DAY)), "B": ("CT-3", to_time_str(DAY + 30)),
+                            "E": ("CT-2", to_time_str(DAY + 30))}
+
+
+def test_a_merge_loses_to_a_concurrent_writer_and_keeps_its_rows(path):
+    store = open_store(path)
+    history = [entry(f"H{i}", "CT-1", DAY - 2880 + 30 * i) for i in range(4)]
+    history.append(dict(entry("H4", "CT-1", DAY - 2760, 60, "Maintenance", 0), scan_type="maintenance"))
+    version = store.publish(history + [entry("A", "CT-1", DAY)])
+    since = datetime(2030, 1, 7)
+    existing_schedule, _, locked_ids, _ = load_existing_schedule(path, since, since)
+    assert sorted(e["scan_id"] for e in existing_schedule) == ["A", "H4"]
+
+    concurrent = store.upsert([entry("W", "CT-2", DAY)])
+    stats = {}
+    merged = merge_and_save([dict(e) for e in existing_schedule], [entry("N", "CT-1", DAY + 30)], path, version,
+                            stats, base_version=version, locked_ids=locked_ids)
+    assert merged is None and stats["store_conflict"]
+    assert schedule_version(path) == concurrent
+    assert sorted(stored(path)) == ["A", "H0", "H1", "H2", "H3", "H4", "W"]
+
+    # Read again and merged against the new version, the write goes through and only
+    # touches the window; the history before it is left as stored
+    existing_schedule, _, locked_ids, _ = load_existing_schedule(path, since, since)
+    stats = {}
+    merged = merge_and_save([dict(e) for e in existing_schedule], [entry("N", "CT-1", DAY + 30)], path, concurrent,
+                            stats, base_version=concurrent, locked_ids=locked_ids)
+    assert merged is not None and "store_conflict" not in stats
+    assert sorted(e["scan_id"] for e in merged) == ["A", "H4", "N", "W"]
+    assert sorted(stored(path)) == ["A", "H0", "H1", "H2", "H3", "H4", "N", "W"]
+
+
+def test_retry_on_conflict_runs_again_until_the_write_goes_through():
+    calls = []
+
+    def attempt(stats):
+        calls.append(dict(stats))
+        if len(calls) < 2:
+            stats["store_conflict"] = True
+            return None
+        return ["schedule"]
+
+    stats = {}
+    assert retry_on_conflict(attempt, stats) == ["schedule"]
+    assert stats == {"attempts": 2}
+    # Every attempt starts from clean stats
+    assert calls == [{}, {}]
+
+
+def test_retry_on_conflict_gives_up(monkeypatch):
+    monkeypatch.setattr(optimizer, "store_write_attempts", 2)
+    stats = {}
+    assert retry_on_conflict(lambda s: s.update(store_conflict=True), stats) is None
+    assert stats["attempts"] == 2
+
+
+def test_the_optimizer_solves_again_after_losing_its_write(path, monkeypatch):
+    start = datetime.now().replace(second=0, microsecond=0) + timedelta(days=3)
+    scans = ("scan_id,scan_type,duration,priority,patient_id,check_in_date,check_in_time\n"
+             f"N1,CT,30,3,1,{start:%Y-%m-%d},{start:%H:%M}\n")
+    open_store(path).publish([entry("A", "CT-1", DAY)])
+    real_merge = optimizer.merge_and_save
+    writes = []
+
+    def merge_after_a_concurrent_write(*args, **kwargs):
+        if not writes:
+            # Another writer publishes while the first pass is solving
+            writes.append(open_store(path).upsert([entry("W", "CT-2", DAY)]))
+        return real_merge(*args, **kwargs)
+
+    monkeypatch.setattr(optimizer, "merge_and_save", merge_after_a_concurrent_write)
+    stats = {}
+    schedule = optimizer.optimize_scan_scheduling(scans, path, engine="greedy", use_cache=False, stats=stats)
+    assert stats["attempts"] == 2
+    assert "N1" in [e["scan_id"] for e in schedule]
+    assert {"A", "W", "N1"} <= set(stored(path))
@@ -0,0 +1,77 @@
+import io
+import csv
+import random
+from datetime import datetime, timedelta
+import pytest
+import optimizer
+from solve_cache import solve_cache, solve_key, cached_schedule, remember_schedule
+
+FIELDS = ["scan_id", "scan_type", "duration", "priority", "patient_id", "check_in_date", "check_in_time"]
+
+
+def scan_csv(n, seed, prefix):
+    rng = random.Random(seed)
+    start = datetime.now().replace(second=0, microsecond=0)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for i in range(n):
+        t = start + timedelta(minutes=rng.randrange(3 * 1440))
+        writer.writerow([f"{prefix}{i}", rng.choice(["CT", "MRI", "X-Ray"]), rng.choice([15, 30, 45]),
+                         rng.choice([0, 1, 2, 3, 4, 5]), f"{prefix}{i}", t.strftime("%Y-%m-%d"), t.strftime("%H:%M")])
+    return out.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    solve_cache.clear()
+    optimizer.last_solution.clear()
+    optimizer.published_occupancy.clear()
+    yield
+    solve_cache.clear()
+
+
+def optimize(scans, path):
+    stats = {}
+    schedule = optimizer.optimize_scan_scheduling(scans, path, engine="greedy", stats=stats)
+    return schedule, stats
+
+
+def test_entries_only_serve_the_version_they_were_published_at():
+    remember_schedule("key", "v1", [{"scan_id": "A"}], {"status": "OPTIMAL"})
+    assert cached_schedule("key", "v1")["schedule"] == [{"scan_id": "A"}]
+    assert cached_schedule("key", "v2") is None
+    # The stale entry was dropped
+    assert cached_schedule("key", "v1") is None
+
+
+def test_key_depends_on_the_request_only():
+    scans, _ = optimizer.load_scan_requests(scan_csv(5, 0, "A"))
+    assert solve_key(scans, {"x": 1}, ["greedy"]) == solve_key(list(reversed(scans)), {"x": 1}, ["greedy"])
+    assert solve_key(scans, {"x": 1}, ["greedy"]) != solve_key(scans, {"x": 2}, ["greedy"])
+    assert solve_key(scans, {"x": 1}, ["greedy"]) != solve_key(scans[1:], {"x": 1}, ["greedy"])
+
+
+def test_identical_retries_hit_after_the_merge_moved_bookings(tmp_path):
+    path = str(tmp_path / "schedule.csv")
+    optimize(scan_csv(150, 1, "B"), path)
+    request = scan_csv(40, 2, "R")
+
+    first, stats = optimize(request, path)
+    assert stats["cache"] == "miss"
+    version = stats["schedule_version"]
+    for _ in range(3):
+        retry, stats = optimize(request, path)
+        assert stats["cache"] == "hit"
+        assert retry == first
+    assert optimizer.schedule_version(path) == version
+
+
+def test_a_version_bump_invalidates_the_entry(tmp_path):
+    path = str(tmp_path / "schedule.csv")
+    request = scan_csv(20, 3, "R")
+    optimize(request, path)
+    optimize(scan_csv(5, 4, "O"), path)
+
+    _, stats = optimize(request, path)
+    assert stats["cache"] == "miss"
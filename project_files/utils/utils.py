@@ -1,6 +1,6 @@
-from datetime import datetime, timedelta
-import pandas as pd
-import os
+from datetime import timedelta
+from schedule_store import open_store
+from occupancy import OccupancyIndex
 
 def time_to_minutes(t_str):
     h, m = map(int, t_str.split(":"))
@@ -23,34 +23,34 @@ def print_schedule(schedule):
               f"({entry['scan_type']}) from {entry['start_time']} to {entry['end_time']} "
               f"(Priority {int(entry['priority'])})")
 
-def append_new_scans_to_schedule(cleaned_schedule, schedule_csv_path):
-    if os.path.exists(schedule_csv_path):
-        existing_df = pd.read_csv(schedule_csv_path)
-        existing_ids = set(existing_df['scan_id'].astype(str))
-        new_df = pd.DataFrame(cleaned_schedule)
-        new_df = new_df[~new_df['scan_id'].astype(str).isin(existing_ids)]
-        final_df = pd.concat([existing_df, new_df], ignore_index=True)
-    else:
-        final_df = pd.DataFrame(cleaned_schedule)
-
-    final_df.to_csv(schedule_csv_path, index=False)
-
-def check_for_overlaps(schedule):
-    from collections import defaultdict
-
-    machine_sched = defaultdict(list)
-    for entry in schedule:
-        start = datetime.strptime(entry['start_time'], "%Y-%m-%d %H:%M")
-        end = datetime.strptime(entry['end_time'], "%Y-%m-%d %H:%M")
-        machine_sched[entry["machine"]].append((start, end, entry['patient_id'], entry['scan_id']))
-
-    for machine, times in machine_sched.items():
-        times.sort()
-        for i in range(len(times) - 1):
-            _, end1, _, id1 = times[i]
-            start2, _, _, id2 = times[i + 1]
-            if start2 < end1:
-                print(f"Problem: Overlap on {machine}: Scan {id1} overlaps with {id2}")
+def append_new_scans_to_schedule(cleaned_schedule, schedule_csv_path, attempts=5):
+    """
+    Adds the entries whose scan_id is not stored yet; stored entries are left as they are.
+    Returns the new store version, or None if other writers got in between on every attempt.
+    """
+    store = open_store(schedule_csv_path)
+    for _ in range(attempts):
+        version = store.version()
+        existing_df = store.load_frame()
+        existing_ids = set(existing_df['scan_id'].astype(str)) if existing_df is not None else set()
+        new_entries = [entry for entry in cleaned_schedule if str(entry['scan_id']) not in existing_ids]
+        new_version = store.upsert(new_entries, version)
+        if new_version is not None:
+            return new_version
+        # Another writer got in between; retry against the schedule it stored
+    print(f"Could not append to {schedule_csv_path}: the schedule kept changing")
+    return None
+
+def check_for_overlaps(schedule, index=None):
+    """
+    Prints every pair of consecutive bookings on a machine that overlap. index is an
+    OccupancyIndex of the schedule (built if not given).
+    """
+    if index is None:
+        index = OccupancyIndex.from_schedule(schedule)
+    for machine in index.machines():
+        for id1, id2 in index.overlapping_neighbours(machine):
+            print(f"Problem: Overlap on {machine}: Scan {id1} overlaps with {id2}")
 
 def is_non_peak(minute_of_day):
     """
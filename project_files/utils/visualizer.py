@@ -1,97 +1,257 @@
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+import io
+import os
 import sys
+import json
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib import rc_context
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from compact_schedule import as_compact, minute_strings
+from config import plot_workers, plot_cache_size, machines as config_machines
+from solve_cache import LRUCache
 sys.dont_write_bytecode = True
 
-def plot_schedule_by_day(schedule):
+MANIFEST = "visual_schedule_manifest.json"
+# Part of every day's hash: change it when the drawing changes so all days are redrawn
+RENDER_VERSION = 1
+
+# --- Priority color mapping ---
+priority_colors = {
+    0: "purple",  # Priority 0
+    1: "red",  # Priority 1
+    2: "orange",  # Priority 2
+    3: "yellow",  # Priority 3
+    4: "green",  # Priority 4
+    5: "blue"  # Priority 5
+}
+
+
+def day_rows(schedule):
+    """
+    Groups the schedule (a CompactSchedule or entry dicts) by day (based on the date in
+    'start_time') as compact rows (machine, start, end, scan_type, priority, patient_id),
+    with start and end in minutes since that day's midnight, sorted so equal content gives
+    equal rows. Grouping and sorting work on the integer columns.
+    """
+    schedule = as_compact(schedule, ["scan_type", "priority", "patient_id"])
+    if not len(schedule):
+        return {}
+    machine_names, machine_ranks = np.unique(schedule.machine_names().astype(str), return_inverse=True)
+    type_names, type_ranks = np.unique(schedule.scan_type_names().astype(str), return_inverse=True)
+    patients, patient_ranks = np.unique([str(p) for p in schedule.patient_ids.tolist()], return_inverse=True)
+    starts = schedule.table["start"]
+    midnights = starts - starts % 1440
+    order = np.lexsort((patient_ranks, schedule.table["priority"], type_ranks, schedule.table["end"], starts,
+                        machine_ranks, midnights))
+    midnights = midnights[order]
+    rows = zip(
+        machine_names[machine_ranks[order]].tolist(), (starts[order] - midnights).tolist(),
+        (schedule.table["end"][order] - midnights).tolist(), type_names[type_ranks[order]].tolist(),
+        schedule.table["priority"][order].tolist(), patients[patient_ranks[order]].tolist()
+    )
+    # Days start where the midnight changes along the sorted order
+    bounds = np.flatnonzero(np.diff(midnights)) + 1
+    day_starts = np.concatenate([[0], bounds]).tolist()
+    day_ends = bounds.tolist() + [len(order)]
+    rows = list(rows)
+    day_names = minute_strings(midnights[day_starts])
+    return {name[:10]: rows[a:b] for name, a, b in zip(day_names, day_starts, day_ends)}
+
+
+def content_hash(rows):
+    return hashlib.sha256(json.dumps([RENDER_VERSION, rows]).encode()).hexdigest()
+
+
+def plot_schedule_by_day(schedule, output_dir=".", max_workers=plot_workers, force=False):
     """
-    Groups the schedule by day (based on the date in 'start_time')
-    and generates a separate visual agenda for each day, saving each as "visual_schedule_<day>.png".
+    Generates a separate visual agenda for each day, saving each as "visual_schedule_<day>.png"
+    in output_dir. A day is only drawn again when its bookings changed since the last
+    render (content hashes in MANIFEST) or its PNG is missing; the days to draw are
+    spread over a process pool. Returns the days drawn and the days skipped.
     """
-    schedule_by_day = {}
-    for entry in schedule:
-        day = entry["start_time"].split()[0]
-        schedule_by_day.setdefault(day, []).append(entry)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
 
-    for day, day_schedule in schedule_by_day.items():
-        plot_day_schedule(day_schedule, day)
+    jobs = []
+    skipped = []
+    for day, rows in day_rows(schedule).items():
+        digest = content_hash(rows)
+        path = os.path.join(output_dir, f"visual_schedule_{day}.png")
+        if not force and manifest.get(day) == digest and os.path.exists(path):
+            skipped.append(day)
+            continue
+        jobs.append((rows, day, path, digest))
 
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        for rows, day, path, _ in jobs:
+            plot_day_schedule(rows, day, path)
+    else:
+        # Spawned, not forked: the server's threads may hold locks at fork time
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            for future in [executor.submit(plot_day_schedule, rows, day, path) for rows, day, path, _ in jobs]:
+                future.result()
 
-def plot_day_schedule(day_schedule, day):
+    if jobs:
+        manifest.update({day: digest for _, day, _, digest in jobs})
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    return {"rendered": [day for _, day, _, _ in jobs], "skipped": skipped}
+
+
+class DayCanvas:
     """
-    Plots the schedule for a single day in an agenda view.
+    Figure, axes and gridlines of a day agenda, created once per process and reused for
+    every day it draws: only the ticks, limits, gridline positions, bars and labels change
+    between days. The gridlines are a single collection instead of one line per interval.
     """
-    if not day_schedule:
+
+    def __init__(self):
+        self.fig = Figure(figsize=(12, 16))
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.gridlines = self.ax.hlines([], 0, 1, transform=self.ax.get_yaxis_transform(), color="gray",
+                                        linestyle="--", linewidth=0.5, alpha=0.7)
+        self.ax.invert_yaxis()
+        self.ax.set_ylabel("Time")
+        self.ax.set_xlabel("Machines")
+        self.artists = []
+        self.layout = None
+
+    def draw(self, rows, day, path, window=None, machines=None, fmt=None):
+        """
+        Draws rows (of day_rows) and saves the figure to path (a file name or a binary
+        file, in format fmt). window=(start, end) in minutes of the day fixes the time axis
+        instead of fitting it to the bookings; machines fixes the machine columns.
+        """
+        ax = self.ax
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+
+        # --- Determine the time axis bounds (5-minute intervals) ---
+        if window is None:
+            window = (min(start for _, start, _, _, _, _ in rows), max(end for _, _, end, _, _, _ in rows))
+        first = window[0] // 5 * 5
+        last = (window[1] + 4) // 5 * 5
+        total_intervals = (last - first) // 5 + 1
+        time_labels = [f"{(first + 5 * i) // 60 % 24:02}:{(first + 5 * i) % 60:02}" for i in range(total_intervals)]
+
+        # --- Machine axis ---
+        machines_order = machines or sorted(set(row[0] for row in rows))
+        machine_index = {machine: i for i, machine in enumerate(machines_order)}
+
+        ax.set_yticks(range(total_intervals))
+        ax.set_yticklabels(time_labels, fontsize=9)
+        ax.set_xticks(range(len(machines_order)))
+        ax.set_xticklabels(machines_order, fontsize=12)
+        # The limits autoscaling gave the bars (5% margins), without relimiting
+        pad = 0.05 * (len(machines_order) - 0.2)
+        ax.set_xlim(-0.4 - pad, len(machines_order) - 0.6 + pad)
+        ax.set_ylim(total_intervals, -1)
+        self.gridlines.set_segments([[(0, y), (1, y)] for y in range(total_intervals)])
+
+        ys, heights, lefts, colors = [], [], [], []
+        for machine, start, end, scan_type, priority, patient_id in rows:
+            start_idx = (start - first) // 5
+            duration_blocks = (end - start) // 5
+            color = "black" if scan_type == "maintenance" else priority_colors.get(priority, "gray")
+            ys.append(start_idx)
+            heights.append(duration_blocks)
+            lefts.append(machine_index[machine] - 0.4)
+            colors.append(color)
+            self.artists.append(ax.text(
+                machine_index[machine], start_idx + duration_blocks / 2, f"{patient_id}\n{scan_type}\nP{priority}",
+                ha="center", va="center", fontsize=9, color="white" if color in ["black", "purple"] else "black",
+                weight="bold", clip_on=True
+            ))
+        if ys:
+            bars = ax.barh(ys, width=0.8, height=heights, left=lefts, color=colors, edgecolor="black", alpha=0.75)
+            self.artists.append(bars)
+        ax.set_title(f"Scheduled Scans for {day}")
+
+        # Tick labels only change width with the number of machines
+        if self.layout != len(machines_order):
+            self.fig.tight_layout()
+            # tight_layout leaves a placeholder layout engine, which costs savefig an extra draw
+            self.fig.set_layout_engine(None)
+            self.layout = len(machines_order)
+        # Text stays text in SVG (instead of a path per glyph), which keeps the file small
+        with rc_context({"svg.fonttype": "none"}):
+            self.fig.savefig(path, format=fmt)
+
+
+_canvas = None
+# Matplotlib figures are not thread-safe; server threads take turns on the canvas
+_canvas_lock = threading.Lock()
+
+
+def _reset_canvas():
+    # A process forked while a server thread was drawing must not inherit its canvas or lock
+    global _canvas, _canvas_lock
+    _canvas = None
+    _canvas_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_canvas)
+# Rendered /schedule/plot responses, keyed by ETag (schedule version and request)
+plot_cache = LRUCache(plot_cache_size)
+
+
+def plot_day_schedule(rows, day, path=None, window=None, machines=None, fmt=None):
+    """
+    Plots the schedule for a single day (rows of day_rows) in an agenda view.
+    """
+    global _canvas
+    if not rows and window is None:
         return
+    with _canvas_lock:
+        if _canvas is None:
+            _canvas = DayCanvas()
+        _canvas.draw(rows, day, path or f"visual_schedule_{day}.png", window, machines, fmt)
+
+
+def render_day(schedule, day, fmt="png", window=None, machines=None):
+    """
+    Agenda of the bookings of schedule that start on day as PNG or SVG bytes, drawn in
+    memory. window=(start, end) in minutes of the day and machines limit it like draw.
+    """
+    rows = day_rows(schedule).get(day, [])
+    if machines:
+        rows = [row for row in rows if row[0] in machines]
+    elif not rows:
+        # An empty window still shows the machines
+        machines = [m for machine_list in config_machines.values() for m in machine_list]
+    buffer = io.BytesIO()
+    plot_day_schedule(rows, day, buffer, window, sorted(machines) if machines else None, fmt)
+    return buffer.getvalue()
+
 
-    # --- Determine the time axis bounds ---
-    booked_times = []
-    for entry in day_schedule:
-        st = datetime.strptime(entry["start_time"], "%Y-%m-%d %H:%M")
-        et = datetime.strptime(entry["end_time"], "%Y-%m-%d %H:%M")
-        booked_times.extend([st, et])
-    min_booking = min(booked_times)
-    max_booking = max(booked_times)
-
-    min_booking = min_booking.replace(minute=(min_booking.minute // 5) * 5, second=0, microsecond=0)
-    total_max = max_booking.hour * 60 + max_booking.minute
-    rounded_max = ((total_max + 4) // 5) * 5
-    max_booking = max_booking.replace(hour=rounded_max // 60, minute=rounded_max % 60, second=0, microsecond=0)
-
-    total_intervals = ((max_booking - min_booking).seconds // (5 * 60)) + 1
-    time_intervals = [min_booking + timedelta(minutes=5 * i) for i in range(total_intervals)]
-    time_labels = [t.strftime("%H:%M") for t in time_intervals]
-
-    # --- Machine axis ---
-    machines_order = sorted(set(entry["machine"] for entry in day_schedule))
-
-    fig, ax = plt.subplots(figsize=(12, 16))
-    ax.set_yticks(range(len(time_intervals)))
-    ax.set_yticklabels(time_labels, fontsize=9)
-    ax.set_xticks(range(len(machines_order)))
-    ax.set_xticklabels(machines_order, fontsize=12)
-    ax.set_ylim(-1, len(time_intervals))
-
-    for y in range(len(time_intervals)):
-        ax.axhline(y, color="gray", linestyle="--", linewidth=0.5, alpha=0.7)
-
-    # --- Priority color mapping ---
-    priority_colors = {
-        0: "purple",  # Priority 0
-        1: "red",  # Priority 1
-        2: "orange",  # Priority 2
-        3: "yellow",  # Priority 3
-        4: "green",  # Priority 4
-        5: "blue"  # Priority 5
-    }
-
-    for entry in day_schedule:
-        machine = entry["machine"]
-        machine_index = machines_order.index(machine)
-        st = datetime.strptime(entry["start_time"], "%Y-%m-%d %H:%M")
-        et = datetime.strptime(entry["end_time"], "%Y-%m-%d %H:%M")
-        start_idx = int((st - min_booking).total_seconds() // (5 * 60))
-        duration_blocks = int((et - st).total_seconds() // (5 * 60))
-
-        if entry["scan_type"] == "maintenance":
-            color = "black"
-        else:
-            color = priority_colors.get(int(entry["priority"]), "gray")
-
-        ax.barh(start_idx, width=0.8, height=duration_blocks, left=machine_index - 0.4,
-                color=color, edgecolor="black", alpha=0.75)
-
-        label_text = f"{entry['patient_id']}\n{entry['scan_type']}\nP{int(entry['priority'])}"
-        text_color = "white" if color in ["black", "purple"] else "black"
-
-        ax.text(machine_index, start_idx + duration_blocks / 2,
-                label_text, ha="center", va="center", fontsize=9,
-                color=text_color, weight="bold")
-
-    ax.invert_yaxis()
-    ax.set_ylabel("Time")
-    ax.set_xlabel("Machines")
-    ax.set_title(f"Scheduled Scans for {day}")
-    fig.tight_layout()
-    fig.savefig(f"visual_schedule_{day}.png")
-    plt.close(fig)
+def timeline(schedule):
+    """
+    Bookings as a compact JSON-ready timeline for clients that draw the agenda themselves.
+    """
+    return [
+        {
+            "scan_id": str(entry["scan_id"]),
+            "machine": entry["machine"],
+            "start_time": entry["start_time"],
+            "end_time": entry["end_time"],
+            "scan_type": entry["scan_type"],
+            "priority": int(entry["priority"]),
+            "patient_id": str(entry["patient_id"]),
+        }
+        for entry in sorted(schedule, key=lambda e: (e["machine"], e["start_time"]))
+    ]
@@ -0,0 +1,100 @@
+import io
+import os
+import json
+import time
+import wave
+import asyncio
+import argparse
+import numpy as np
+from aiohttp import web
+from pydub import AudioSegment
+import realtime_whisper
+
+
+def generate_dictation(seconds, seed=0, frame_rate=16000):
+    """
+    Synthetic dictation of about `seconds` seconds: bursts of noisy tone (2-8 s, standing
+    in for speech) separated by pauses (0.3-1.2 s), as a mono 16-bit AudioSegment.
+    """
+    rng = np.random.default_rng(seed)
+    parts = []
+    total = 0
+    while total < seconds * frame_rate:
+        n = int(rng.uniform(2, 8) * frame_rate)
+        t = np.arange(n) / frame_rate
+        speech = 0.3 * np.sin(2 * np.pi * rng.uniform(120, 300) * t) + 0.1 * rng.standard_normal(n)
+        pause = 0.001 * rng.standard_normal(int(rng.uniform(0.3, 1.2) * frame_rate))
+        parts += [speech, pause]
+        total += n + len(pause)
+    samples = np.clip(np.concatenate(parts)[:seconds * frame_rate], -1, 1)
+    return AudioSegment((samples * 32767).astype(np.int16).tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+
+
+def audio_seconds(data):
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            return w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError):
+        return 0.0
+
+
+def stand_in_app(base_latency=0.3, latency_per_sec=0.05):
+    """
+    Local stand-in for the OpenAI transcription endpoint. It answers after base_latency
+    plus latency_per_sec per second of (WAV) audio, like a server whose work grows with
+    the recording, with a text naming the duration it received.
+    """
+    async def transcriptions(request):
+        form = await request.post()
+        seconds = audio_seconds(form["file"].file.read())
+        await asyncio.sleep(base_latency + latency_per_sec * seconds)
+        return web.json_response({"text": f"[{seconds:.1f} s of dictation]"})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post("/v1/audio/transcriptions", transcriptions)
+    return app
+
+
+async def run_cases(durations, chunk_secs, runs, base_latency, latency_per_sec, port):
+    runner = web.AppRunner(stand_in_app(base_latency, latency_per_sec))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    # Point the client at the stand-in; clients are created per event loop on first use
+    realtime_whisper.whisper_base_url = f"http://127.0.0.1:{port}/v1"
+    records = []
+    try:
+        for seconds in durations:
+            buffer = io.BytesIO()
+            generate_dictation(seconds).export(buffer, format="wav")
+            for mode, chunk in (("single", float("inf")), ("chunked", chunk_secs)):
+                for run in range(runs):
+                    start = time.perf_counter()
+                    result = await realtime_whisper.transcribe_audio(buffer, "dictation.wav", chunk)
+                    latency = time.perf_counter() - start
+                    records.append({"seconds": seconds, "mode": mode, "run": run, "chunks": result["chunks"],
+                                    "latency": latency})
+                    print(f"{seconds:>5} s {mode:>8}: {result['chunks']:>3} chunks, {latency:.2f} s")
+    finally:
+        await runner.cleanup()
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcription latency against a local stand-in server")
+    parser.add_argument("--durations", type=int, nargs="+", default=[60, 600])
+    parser.add_argument("--chunk-secs", type=float, default=realtime_whisper.whisper_chunk_secs)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--base-latency", type=float, default=0.3)
+    parser.add_argument("--latency-per-sec", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API_KEY", "stand-in")
+    results = asyncio.run(run_cases(
+        args.durations, args.chunk_secs, args.runs, args.base_latency, args.latency_per_sec, args.port
+    ))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)